@@ -0,0 +1,90 @@
+"""Benchmarks DemuxSummaryParser on synthetic multi-million-line files.
+
+    python benchmarks/bench_demux_summary.py --lines 5000000 --lanes 8
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+
+from flowcell_parser.classes import DemuxSummaryParser
+
+
+def write_demux_summaries(stats_dir, lanes, lines, seed=0):
+    rng = random.Random(seed)
+    bases = 'ACGTN'
+    for lane in range(1, lanes + 1):
+        path = os.path.join(stats_dir, 'DemuxSummaryF1L{0}.txt'.format(lane))
+        with open(path, 'w') as f:
+            f.write("### Most Popular Unknown Index Sequences\n")
+            f.write("### Columns: Index_Sequence Hit_Count\n")
+            batch = []
+            for _ in range(lines):
+                index = ''.join(rng.choice(bases) for _ in range(8))
+                batch.append("{0}\t{1}\n".format(index, rng.randint(1, 10 ** 6)))
+                if len(batch) == 100000:
+                    f.writelines(batch)
+                    batch = []
+            f.writelines(batch)
+
+
+def legacy_parse(stats_dir):
+    """The line by line parser DemuxSummaryParser used to be"""
+    import glob
+    import re
+    result = {}
+    total = {}
+    pattern = re.compile('DemuxSummaryF1L([0-9]).txt')
+    for file in glob.glob(os.path.join(stats_dir, 'DemuxSummaryF1L?.txt')):
+        lane_nb = pattern.search(file).group(1)
+        result[lane_nb] = OrderedDict()
+        total[lane_nb] = 0
+        with open(file, newline='') as f:
+            undeterminePart = False
+            for line in f:
+                if not undeterminePart:
+                    if "### Columns:" in line:
+                        undeterminePart = True
+                else:
+                    components = line.rstrip().split('\t')
+                    if len(result[lane_nb].keys()) < 50:
+                        result[lane_nb][components[0]] = int(components[1])
+                    total[lane_nb] += int(components[1])
+    return result, total
+
+
+def timed(label, func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    print("{0:<24} {1:8.2f}s".format(label, elapsed))
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lines', type=int, default=2000000,
+                        help="undetermined barcodes per lane")
+    parser.add_argument('--lanes', type=int, default=4)
+    parser.add_argument('--top', type=int, default=50)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    stats_dir = tempfile.mkdtemp()
+    try:
+        print("writing {0} lanes x {1} lines".format(args.lanes, args.lines))
+        write_demux_summaries(stats_dir, args.lanes, args.lines)
+        timed("legacy", legacy_parse, stats_dir)
+        timed("streaming, serial", DemuxSummaryParser, stats_dir,
+              top=args.top, workers=1)
+        timed("streaming, {0} workers".format(args.workers), DemuxSummaryParser,
+              stats_dir, top=args.top, workers=args.workers)
+    finally:
+        shutil.rmtree(stats_dir)
+
+
+if __name__ == '__main__':
+    main()
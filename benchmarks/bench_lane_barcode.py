@@ -0,0 +1,109 @@
+"""Benchmarks LaneBarcodeParser against the BeautifulSoup implementation,
+and the memory kept by its list of dicts and columnar results.
+
+    python benchmarks/bench_lane_barcode.py --samples 5000 --lanes 8
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from bs4 import BeautifulSoup
+
+from flowcell_parser.classes import LaneBarcodeParser
+
+
+def write_lane_barcode(path, lanes, samples):
+    with open(path, 'w') as f:
+        f.write("<html><body><table><tr><td><p>FCID</p></td></tr></table>\n"
+                "<h2>Flowcell Summary</h2>\n<table border=\"1\">\n"
+                "<tr><th>Clusters (Raw)</th><th>Clusters(PF)</th>"
+                "<th>Yield (MBases)</th></tr>\n"
+                "<tr><td>4,966,525,440</td><td>3,111,257,766</td>"
+                "<td>939,600</td></tr>\n</table>\n"
+                "<h2>Lane Summary</h2>\n<table border=\"1\">\n<tr>\n")
+        headers = ['Lane', 'Project', 'Sample', 'Barcode sequence',
+                   'PF Clusters', '% of the<br>lane', '% Perfect<br>barcode',
+                   '% One mismatch<br>barcode', 'Yield (Mbases)',
+                   '% PF<br>Clusters', '% &gt;= Q30<br>bases',
+                   'Mean Quality<br>Score']
+        f.write(''.join("<th>{0}</th>\n".format(h) for h in headers))
+        f.write("</tr>\n")
+        for lane in range(1, lanes + 1):
+            for sample in range(samples // lanes):
+                f.write("<tr>\n<td>{0}</td>\n<td>P{1}</td>\n<td>P1_{1:05d}</td>\n"
+                        "<td>ACGTACGT</td>\n<td>1,234,567</td>\n<td>0.12</td>\n"
+                        "<td>95.00</td>\n<td>5.00</td>\n<td>370</td>\n"
+                        "<td>NaN</td>\n<td>91.20</td>\n<td>35.80</td>\n"
+                        "</tr>\n".format(lane, sample))
+        f.write("</table>\n</body></html>\n")
+
+
+def bsoup_parse(path):
+    """The BeautifulSoup parser LaneBarcodeParser used to be"""
+    with open(path, newline='') as htmlfile:
+        bsoup = BeautifulSoup(htmlfile, 'html.parser')
+        flowcell_table = bsoup.find_all('table')[1]
+        lane_table = bsoup.find_all('table')[2]
+        flowcell_data = dict(zip([th.text for th in flowcell_table.find_all('th')],
+                                 [td.text for td in flowcell_table.find_all('td')]))
+        sample_data = []
+        lane_keys = []
+        for row in lane_table.find_all('tr'):
+            if len(row.find_all('th')):
+                for th in row.find_all('th'):
+                    lane_keys.append(th.text.replace('<br/>', ' ').replace('&gt;', '>'))
+            elif len(row.find_all('td')):
+                lane_values = [td.text.replace('NaN', '0') if td.text else '0'
+                               for td in row.find_all('td')]
+                sample_data.append(dict(zip(lane_keys, lane_values)))
+    return flowcell_data, sample_data
+
+
+def timed(label, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    print("{0:<16} {1:8.2f}s".format(label, elapsed))
+    return result, elapsed
+
+
+def retained(label, func, *args):
+    tracemalloc.start()
+    result = func(*args)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print("{0:<16} {1:8.1f} MB kept".format(label, size / 1024.0 / 1024.0))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--samples', type=int, default=5000)
+    parser.add_argument('--lanes', type=int, default=8)
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'laneBarcode.html')
+        write_lane_barcode(path, args.lanes, args.samples)
+        size = os.path.getsize(path) / 1024.0 / 1024.0
+        print("laneBarcode.html: {0} rows, {1:.1f} MB".format(args.samples, size))
+        (flowcell_data, sample_data), bsoup_time = timed("beautifulsoup", bsoup_parse, path)
+        parsed, stream_time = timed("streaming", LaneBarcodeParser, path)
+        assert parsed.flowcell_data == flowcell_data
+        assert parsed.sample_data == sample_data
+        print("{0:.1f} MB/s, {1:.1f}x faster".format(size / stream_time,
+                                                     bsoup_time / stream_time))
+        del parsed, sample_data
+        retained("dict rows", LaneBarcodeParser, path)
+        columnar = retained("columnar", LaneBarcodeParser, path, True)
+        _, records_time = timed("to_records", lambda: columnar.sample_data)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
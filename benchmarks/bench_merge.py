@@ -0,0 +1,99 @@
+"""Benchmark of db.merge against the recursive implementation, merging the
+document of a synthetic run folder into a copy with a few changed fields,
+as update_doc does when a run is uploaded again, and the same on a
+dict-heavy document with per lane and sample metrics.
+
+    python benchmarks/bench_merge.py --samples 2000 --repeat 5
+"""
+import argparse
+import copy
+import json
+import shutil
+import tempfile
+import logging
+import time
+
+from flowcell_parser.classes import RunParser
+from flowcell_parser.db import merge
+
+log = logging.getLogger(__name__)
+
+from synthetic_run import add_spec_arguments, make_run_folder, spec_from_arguments
+
+
+def recursive_merge(d1, d2):
+    """merge as it was before the iterative rewrite"""
+    for key in d2:
+        if key in d1:
+            if isinstance(d1[key], dict) and isinstance(d2[key], dict):
+                recursive_merge(d1[key], d2[key])
+            elif d1[key] == d2[key]:
+                pass  # same leaf value
+            else:
+                log.debug("Values for key {key} in d1 and d2 differ, "
+                          "using d1's value".format(key=key))
+        else:
+            d1[key] = d2[key]
+    return d1
+
+
+def documents(spec):
+    root = tempfile.mkdtemp()
+    try:
+        obj = RunParser(make_run_folder(root, spec)).obj
+    finally:
+        shutil.rmtree(root)
+    # what couchdb would give back
+    remote = json.loads(json.dumps(obj, default=str))
+    new = copy.deepcopy(remote)
+    new['time cycles'].append({'cycle': 'new', 'start': 'now'})
+    new['DemultiplexingStats']['flowcell'] = 'changed'
+    return new, remote
+
+
+def nested_documents(spec):
+    remote = {'name': 'fc', 'lanes': dict(
+        (str(lane), dict(('P1_{0:05d}'.format(sample), dict(
+            ('metric_{0}'.format(metric), sample * metric) for metric in range(10)))
+            for sample in range(spec.samples)))
+        for lane in range(1, spec.lanes + 1))}
+    new = copy.deepcopy(remote)
+    new['lanes']['1']['P1_00000']['metric_1'] = 'changed'
+    return new, remote
+
+
+def measure(function, new, remote, repeat):
+    best = None
+    for _ in range(repeat):
+        d1 = copy.deepcopy(new)
+        start = time.perf_counter()
+        function(d1, remote)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_spec_arguments(parser)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    spec = spec_from_arguments(args)
+    for name, (new, remote) in (('run document', documents(spec)),
+                                ('nested metrics', nested_documents(spec))):
+        changes = []
+        assert (merge(copy.deepcopy(new), remote, changes) ==
+                recursive_merge(copy.deepcopy(new), remote))
+        recursive_time = measure(recursive_merge, new, remote, args.repeat)
+        iterative_time = measure(merge, new, remote, args.repeat)
+        changes_time = measure(lambda d1, d2: merge(d1, d2, []), new, remote, args.repeat)
+        print("{0:<15} recursive {1:8.4f}s  iterative {2:8.4f}s  with changes {3:8.4f}s"
+              "  {4:6.1f}x".format(name, recursive_time, iterative_time, changes_time,
+                                   recursive_time / iterative_time))
+        print("{0:<15} changed: {1}".format(
+            '', ', '.join('.'.join(map(str, path)) for path, _ in changes)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""Times every parser and RunParser end to end on a synthetic run folder,
+and compares the results with a baseline.
+
+    python benchmarks/bench_suite.py --samples 2000 --output results.json
+    python benchmarks/bench_suite.py --samples 2000 --baseline results.json
+
+Each benchmark is timed as the best of --repeat runs, then run once more
+under tracemalloc for its peak memory. Results are saved as json with the
+run folder spec, so that runs at the same scale can be compared. With
+--baseline, benchmarks slower than the baseline by more than --tolerance
+are reported and the exit status is 1.
+"""
+import argparse
+import json
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from flowcell_parser import __version__
+from flowcell_parser.classes import (DEFAULT_STATS_FIELDS, RunParser, StatsParser,
+                                     input_bytes, run_folder_artifacts)
+
+from synthetic_run import add_spec_arguments, make_run_folder, spec_from_arguments
+
+
+def benchmarks(run_path):
+    """(name, callable, input path) of every benchmark, the input path
+    being None for RunParser"""
+    cases = []
+    for attribute, parser_class, path in run_folder_artifacts(run_path):
+        cases.append(("{0}:{1}".format(parser_class.__name__, attribute),
+                      lambda parser_class=parser_class, path=path: parser_class(path), path))
+        if parser_class is StatsParser:
+            cases.append(("StatsParser:json_stats selected fields",
+                          lambda path=path: StatsParser(path, fields=DEFAULT_STATS_FIELDS,
+                                                        top_unknown=50), path))
+    cases.append(("RunParser", lambda: RunParser(run_path), None))
+    cases.append(("RunParser:4 threads", lambda: RunParser(run_path, workers=4), None))
+    cases.append(("RunParser:lazy runinfo",
+                  lambda: RunParser(run_path, lazy=True).runinfo, None))
+    return cases
+
+
+def measure(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'seconds': min(times), 'peak_bytes': peak}
+
+
+def run_suite(spec, repeat, keep=None):
+    root = keep or tempfile.mkdtemp()
+    try:
+        run_path = make_run_folder(root, spec)
+        results = {}
+        for name, function, path in benchmarks(run_path):
+            results[name] = measure(function, repeat)
+            if path is not None:
+                results[name]['input_bytes'] = input_bytes(path)
+            print("{0:<48} {1:9.4f}s {2:9.1f} MB".format(
+                name, results[name]['seconds'], results[name]['peak_bytes'] / 1024.0 / 1024.0))
+    finally:
+        if keep is None:
+            shutil.rmtree(root)
+    return {'version': __version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'spec': spec.as_dict(),
+            'repeat': repeat,
+            'results': results}
+
+
+def compare(report, baseline, tolerance):
+    """Prints the ratios to the baseline, returns the names of the
+    benchmarks that got slower than tolerance allows"""
+    if baseline['spec'] != report['spec']:
+        print("warning: the baseline was run at another scale: {0}".format(baseline['spec']))
+    print("\n{0:<48} {1:>10} {2:>10} {3:>7}".format('vs baseline ' + baseline['version'],
+                                                    'baseline', 'current', 'ratio'))
+    regressions = []
+    for name, result in sorted(report['results'].items()):
+        if name not in baseline['results']:
+            continue
+        reference = baseline['results'][name]['seconds']
+        ratio = result['seconds'] / reference if reference else float('inf')
+        flag = ''
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            flag = '  SLOWER'
+        print("{0:<48} {1:9.4f}s {2:9.4f}s {3:6.2f}x{4}".format(
+            name, reference, result['seconds'], ratio, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_spec_arguments(parser)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help="save the results as json to this file")
+    parser.add_argument('--baseline', help="json results to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="slowdown allowed against the baseline, 0.2 for 20%%")
+    parser.add_argument('--keep', help="write the run folder here and keep it")
+    args = parser.parse_args()
+
+    report = run_suite(spec_from_arguments(args), args.repeat, args.keep)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(report, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,45 @@
+"""Microbenchmarks of the CycleTimes and RunInfo date decoders against
+datetime.strptime.
+
+    python benchmarks/bench_timestamps.py
+"""
+import timeit
+from datetime import datetime
+
+from flowcell_parser.classes import (CYCLE_TIMES_FORMAT, parse_cycle_timestamp,
+                                     run_date_to_yymmdd)
+
+
+def legacy_run_date(date):
+    """The exception driven fallback RunInfoParser used to do"""
+    if len(date) > 6:
+        try:
+            return datetime.strptime(date.split(" ")[0], "%m/%d/%Y").strftime("%y%m%d")
+        except ValueError:
+            return datetime.strptime(date, "%Y-%m-%dT%H:%M:%SZ").strftime("%y%m%d")
+    return date
+
+
+def compare(label, baseline, candidate, number):
+    baseline_time = min(timeit.repeat(baseline, number=number, repeat=3))
+    candidate_time = min(timeit.repeat(candidate, number=number, repeat=3))
+    print("{0:<32} strptime {1:6.2f}us  fast {2:6.2f}us  {3:5.1f}x".format(
+        label, baseline_time / number * 1e6, candidate_time / number * 1e6,
+        baseline_time / candidate_time))
+
+
+def main():
+    number = 100000
+    compare("CycleTimes record",
+            lambda: datetime.strptime('5/20/2019-15:03:22.011', CYCLE_TIMES_FORMAT),
+            lambda: parse_cycle_timestamp('5/20/2019', '15:03:22.011'),
+            number)
+    for date in ('10/17/2017 10:59:16 AM', '2023-05-24T08:12:45Z', '150424'):
+        compare("RunInfo {0}".format(date),
+                lambda: legacy_run_date(date),
+                lambda: run_date_to_yymmdd(date),
+                number // 10)
+
+
+if __name__ == '__main__':
+    main()
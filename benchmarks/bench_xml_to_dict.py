@@ -0,0 +1,84 @@
+"""Scaling benchmark of xml_to_dict against the recursive implementation,
+on synthetic runParameters.xml files with thousands of repeated siblings.
+
+    python benchmarks/bench_xml_to_dict.py --sizes 500 1000 2000 4000
+"""
+import argparse
+import time
+import xml.etree.ElementTree as ET
+
+from flowcell_parser.classes import xml_to_dict
+
+
+def recursive_xml_to_dict(root):
+    """xml_to_dict as it was before the iterative rewrite"""
+    current = None
+    children = list(root)
+    if children:
+        current = {}
+        duplicates = {}
+        for child in children:
+            if len(root.findall(child.tag)) > 1:
+                if child.tag not in duplicates:
+                    duplicates[child.tag] = []
+                lower = recursive_xml_to_dict(child)
+                duplicates[child.tag].extend(list(lower.values()))
+                current.update(duplicates)
+            else:
+                lower = recursive_xml_to_dict(child)
+                current.update(lower)
+    if root.attrib:
+        if current:
+            current.update(root.attrib)
+        else:
+            current = dict(root.attrib)
+    if root.text and root.text.strip() != "":
+        if current:
+            if 'text' not in current:
+                current['text'] = root.text
+            else:
+                current['xml_text'] = root.text
+        else:
+            current = root.text
+    return {root.tag: current}
+
+
+def run_parameters(siblings):
+    """runParameters-like document with repeated consumables, reads and lanes"""
+    parts = ["<RunParameters><Setup><ExperimentName>bench</ExperimentName>"]
+    parts.append("<ConsumableInfo>")
+    parts.extend("<ConsumableInfo><SerialNumber>SN{0}</SerialNumber><Type>Reagent</Type>"
+                 "<Version>1.0</Version></ConsumableInfo>".format(i) for i in range(siblings))
+    parts.append("</ConsumableInfo><Reads>")
+    parts.extend('<Read Number="{0}" NumCycles="151" IsIndexedRead="N"/>'.format(i)
+                 for i in range(siblings))
+    parts.append("</Reads><Lanes>")
+    parts.extend("<Lane><Number>{0}</Number><Yield>{0}</Yield></Lane>".format(i)
+                 for i in range(siblings))
+    parts.append("</Lanes></Setup></RunParameters>")
+    return ET.fromstring(''.join(parts))
+
+
+def timed(function, root):
+    start = time.perf_counter()
+    result = function(root)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[500, 1000, 2000, 4000],
+                        help="number of repeated siblings per block")
+    args = parser.parse_args()
+    for siblings in args.sizes:
+        root = run_parameters(siblings)
+        expected, recursive_time = timed(recursive_xml_to_dict, root)
+        result, iterative_time = timed(xml_to_dict, root)
+        assert result == expected
+        print("{0:>7} siblings  recursive {1:8.3f}s  iterative {2:8.3f}s  {3:7.1f}x".format(
+            siblings, recursive_time, iterative_time, recursive_time / iterative_time))
+
+
+if __name__ == '__main__':
+    main()
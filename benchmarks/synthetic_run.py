@@ -0,0 +1,244 @@
+"""Writes synthetic run folders with every file RunParser reads, at a
+configurable scale, for the benchmarks.
+
+    python benchmarks/synthetic_run.py /tmp/runs --lanes 8 --samples 2000
+"""
+import argparse
+import json
+import os
+import random
+from datetime import datetime, timedelta
+
+FLOWCELL = 'HSYNTHCCX'
+INSTRUMENT = 'ST-E00214'
+BASES = 'ACGT'
+
+
+class RunFolderSpec(object):
+    """Scale of a synthetic run folder.
+
+    samples are spread over the lanes, unknown_barcodes is the number of
+    lines of each DemuxSummary file and of undetermined barcodes per lane
+    in Stats.json, and cycles the number of cycles in CycleTimes.txt.
+    """
+    def __init__(self, lanes=8, samples=96, cycles=318, unknown_barcodes=1000,
+                 tiles=24, read_length=151, index_length=8, seed=0):
+        self.lanes = lanes
+        self.samples = samples
+        self.cycles = cycles
+        self.unknown_barcodes = unknown_barcodes
+        self.tiles = tiles
+        self.read_length = read_length
+        self.index_length = index_length
+        self.seed = seed
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+def make_run_folder(root, spec):
+    """Writes a run folder under root, returns its path"""
+    rng = random.Random(spec.seed)
+    name = '150424_{0}_0001_A{1}'.format(INSTRUMENT, FLOWCELL)
+    path = os.path.join(root, name)
+    reports_dir = os.path.join(path, 'Demultiplexing', 'Reports', 'html', FLOWCELL,
+                               'all', 'all', 'all')
+    stats_dir = os.path.join(path, 'Demultiplexing', 'Stats')
+    for folder in (os.path.join(path, 'Logs'), reports_dir, stats_dir):
+        os.makedirs(folder)
+    samples = make_samples(spec, rng)
+    write_run_info(os.path.join(path, 'RunInfo.xml'), name, spec)
+    write_run_parameters(os.path.join(path, 'runParameters.xml'), spec)
+    write_sample_sheet(os.path.join(path, 'SampleSheet.csv'), samples)
+    write_cycle_times(os.path.join(path, 'Logs', 'CycleTimes.txt'), spec)
+    write_lane_barcode(os.path.join(reports_dir, 'laneBarcode.html'), samples)
+    # samples go round-robin over the lanes, one row per lane
+    write_lane_barcode(os.path.join(reports_dir, 'lane.html'), samples[:spec.lanes])
+    unknown = dict((lane, unknown_barcodes(spec, rng)) for lane in range(1, spec.lanes + 1))
+    write_demux_summaries(stats_dir, unknown)
+    write_stats_json(os.path.join(stats_dir, 'Stats.json'), name, samples, unknown)
+    write_demultiplexing_stats(os.path.join(stats_dir, 'DemultiplexingStats.xml'), samples)
+    return path
+
+
+def random_index(rng, length):
+    return ''.join(rng.choice(BASES) for _ in range(length))
+
+
+def make_samples(spec, rng):
+    """One dict per sample and lane"""
+    samples = []
+    for number in range(spec.samples):
+        lane = number % spec.lanes + 1
+        reads = rng.randint(10 ** 5, 10 ** 7)
+        samples.append({'lane': lane,
+                        'project': 'P{0}'.format(number % 7 + 1),
+                        'sample': 'P{0}_{1:05d}'.format(number % 7 + 1, number),
+                        'index': random_index(rng, spec.index_length),
+                        'reads': reads,
+                        'perfect': int(reads * 0.95)})
+    return samples
+
+
+def unknown_barcodes(spec, rng):
+    counts = {}
+    while len(counts) < spec.unknown_barcodes:
+        counts[random_index(rng, spec.index_length)] = rng.randint(1, 10 ** 6)
+    return sorted(counts.items(), key=lambda item: -item[1])
+
+
+def reads_xml(spec):
+    return ''.join('<Read Number="{0}" NumCycles="{1}" IsIndexedRead="{2}" />'.format(
+        number, cycles, indexed) for number, cycles, indexed in (
+            (1, spec.read_length, 'N'), (2, spec.index_length, 'Y'), (3, spec.read_length, 'N')))
+
+
+def write_run_info(path, name, spec):
+    tiles = ''.join('<Tile>{0}_{1}</Tile>'.format(lane, 1101 + tile)
+                    for lane in range(1, spec.lanes + 1) for tile in range(spec.tiles))
+    with open(path, 'w') as f:
+        f.write('<?xml version="1.0"?>\n<RunInfo Version="3"><Run Id="{0}" Number="1">'
+                '<Flowcell>{1}</Flowcell><Instrument>{2}</Instrument><Date>150424</Date>'
+                '<Reads>{3}</Reads><FlowcellLayout LaneCount="{4}" SurfaceCount="2" '
+                'SwathCount="2" TileCount="{5}"><TileSet><Tiles>{6}</Tiles></TileSet>'
+                '</FlowcellLayout></Run></RunInfo>\n'.format(
+                    name, FLOWCELL, INSTRUMENT, reads_xml(spec), spec.lanes, spec.tiles,
+                    tiles))
+
+
+def write_run_parameters(path, spec):
+    with open(path, 'w') as f:
+        f.write('<?xml version="1.0"?>\n<RunParameters><Setup><ExperimentName>{0}'
+                '</ExperimentName><ScannerID>{1}</ScannerID><Reads>{2}</Reads></Setup>'
+                '</RunParameters>\n'.format(FLOWCELL, INSTRUMENT, reads_xml(spec)))
+
+
+def write_sample_sheet(path, samples):
+    with open(path, 'w') as f:
+        f.write("[Header]\nInvestigator Name,bench\nExperiment Name,{0}\nDate,2015-04-23\n"
+                "[Data]\nLane,SampleID,SampleName,SamplePlate,SampleWell,index,Project\n"
+                .format(FLOWCELL))
+        for sample in samples:
+            f.write("{lane},Sample_{sample},{sample},plate,A1,{index},{project}\n".format(
+                **sample))
+
+
+def write_cycle_times(path, spec):
+    time = datetime(2019, 5, 20, 15, 3, 22, 11000)
+    with open(path, 'w') as f:
+        f.write("Date\tTime\tBarcode\tCycle\tInfo\n")
+        for cycle in range(1, spec.cycles + 1):
+            for step in ('Start Imaging', 'End Imaging', 'Start Chemistry', 'End Chemistry'):
+                f.write("{0}/{1}/{2}\t{3}\t{4}\t{5}\t{6}\n".format(
+                    time.month, time.day, time.year, time.strftime('%H:%M:%S.%f')[:-3],
+                    FLOWCELL, cycle, step))
+                time += timedelta(seconds=37)
+
+
+def write_lane_barcode(path, samples):
+    headers = ['Lane', 'Project', 'Sample', 'Barcode sequence', 'PF Clusters',
+               '% of the<br>lane', '% Perfect<br>barcode', '% One mismatch<br>barcode',
+               'Yield (Mbases)', '% PF<br>Clusters', '% &gt;= Q30<br>bases',
+               'Mean Quality<br>Score']
+    with open(path, 'w') as f:
+        f.write("<html><body><table><tr><td><p>{0}</p></td></tr></table>\n"
+                "<h2>Flowcell Summary</h2>\n<table border=\"1\">\n"
+                "<tr><th>Clusters (Raw)</th><th>Clusters(PF)</th><th>Yield (MBases)</th></tr>\n"
+                "<tr><td>4,966,525,440</td><td>3,111,257,766</td><td>939,600</td></tr>\n"
+                "</table>\n<h2>Lane Summary</h2>\n<table border=\"1\">\n<tr>\n".format(FLOWCELL))
+        f.write(''.join("<th>{0}</th>\n".format(header) for header in headers))
+        f.write("</tr>\n")
+        for sample in samples:
+            f.write("<tr>\n<td>{lane}</td>\n<td>{project}</td>\n<td>{sample}</td>\n"
+                    "<td>{index}</td>\n<td>{reads:,}</td>\n<td>0.12</td>\n<td>95.00</td>\n"
+                    "<td>5.00</td>\n<td>370</td>\n<td>NaN</td>\n<td>91.20</td>\n"
+                    "<td>35.80</td>\n</tr>\n".format(**sample))
+        f.write("</table>\n</body></html>\n")
+
+
+def write_demux_summaries(stats_dir, unknown):
+    for lane, barcodes in unknown.items():
+        with open(os.path.join(stats_dir, 'DemuxSummaryF1L{0}.txt'.format(lane)), 'w') as f:
+            f.write("### Most Popular Unknown Index Sequences\n")
+            f.write("### Columns: Index_Sequence Hit_Count\n")
+            f.writelines("{0}\t{1}\n".format(index, count) for index, count in barcodes)
+
+
+def write_stats_json(path, name, samples, unknown):
+    conversion_results = []
+    for lane in sorted(unknown):
+        demux_results = [{'SampleId': 'Sample_' + sample['sample'],
+                          'SampleName': sample['sample'],
+                          'IndexMetrics': [{'IndexSequence': sample['index'],
+                                            'MismatchCounts': {'0': sample['perfect'],
+                                                               '1': sample['reads'] -
+                                                               sample['perfect']}}],
+                          'NumberReads': sample['reads'],
+                          'Yield': sample['reads'] * 302,
+                          'ReadMetrics': [{'ReadNumber': read,
+                                           'Yield': sample['reads'] * 151,
+                                           'YieldQ30': sample['reads'] * 130,
+                                           'QualityScoreSum': sample['reads'] * 5000,
+                                           'TrimmedBases': 0} for read in (1, 2)]}
+                         for sample in samples if sample['lane'] == lane]
+        conversion_results.append({'LaneNumber': lane,
+                                   'TotalClustersRaw': 620815680,
+                                   'TotalClustersPF': 395451350,
+                                   'Yield': 119426,
+                                   'DemuxResults': demux_results,
+                                   'Undetermined': {'NumberReads': 43813954,
+                                                    'Yield': 13232,
+                                                    'ReadMetrics': []}})
+    stats = {'Flowcell': FLOWCELL,
+             'RunNumber': 1,
+             'RunId': name,
+             'ConversionResults': conversion_results,
+             'UnknownBarcodes': [{'Lane': lane, 'Barcodes': dict(barcodes)}
+                                 for lane, barcodes in sorted(unknown.items())]}
+    with open(path, 'w') as f:
+        json.dump(stats, f, indent=2)
+
+
+def write_demultiplexing_stats(path, samples):
+    with open(path, 'w') as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n<Stats>\n'
+                '<Flowcell flowcell-id="{0}">\n'.format(FLOWCELL))
+        for sample in samples:
+            f.write('<Project name="{project}"><Sample name="{sample}">'
+                    '<Barcode name="{index}"><Lane number="{lane}">'
+                    '<BarcodeCount>{reads}</BarcodeCount>'
+                    '<PerfectBarcodeCount>{perfect}</PerfectBarcodeCount>'
+                    '<OneMismatchBarcodeCount>0</OneMismatchBarcodeCount>'
+                    '</Lane></Barcode></Sample></Project>\n'.format(**sample))
+        f.write('</Flowcell>\n</Stats>\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('root', help="folder to write the run folder in")
+    add_spec_arguments(parser)
+    args = parser.parse_args()
+    print(make_run_folder(args.root, spec_from_arguments(args)))
+
+
+def add_spec_arguments(parser):
+    defaults = RunFolderSpec()
+    parser.add_argument('--lanes', type=int, default=defaults.lanes)
+    parser.add_argument('--samples', type=int, default=defaults.samples,
+                        help="samples over all lanes")
+    parser.add_argument('--cycles', type=int, default=defaults.cycles)
+    parser.add_argument('--unknown-barcodes', type=int, default=defaults.unknown_barcodes,
+                        help="undetermined barcodes per lane")
+    parser.add_argument('--tiles', type=int, default=defaults.tiles,
+                        help="tiles per lane in RunInfo.xml")
+    parser.add_argument('--seed', type=int, default=defaults.seed)
+
+
+def spec_from_arguments(args):
+    return RunFolderSpec(lanes=args.lanes, samples=args.samples, cycles=args.cycles,
+                         unknown_barcodes=args.unknown_barcodes, tiles=args.tiles,
+                         seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
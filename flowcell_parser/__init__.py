@@ -1,3 +1,3 @@
 """ Main flowcell_parser module
 """
-__version__ = '1.0.4'
+__version__ = '1.25.14'
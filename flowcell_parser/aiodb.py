@@ -0,0 +1,271 @@
+"""Asyncio variant of flowcell_parser.db, for syncing many documents at once.
+
+AsyncCouchDB talks to one database through an aiohttp session limited to
+max_connections keep-alive connections; aiohttp is an optional dependency,
+installed with the `async` extra. update_docs() keeps up to `concurrency`
+update_doc style operations (view query, merge, write) in flight, and
+retries the writes rejected with a 409 conflict after re-reading the
+document, backing off between attempts.
+
+    statuses = sync_docs(conf, 'x_flowcells', docs, concurrency=20)
+
+A client belongs to the event loop it is first used in.
+"""
+import asyncio
+import json
+import logging
+import random
+import uuid
+
+from urllib.parse import quote, unquote, urlencode, urlsplit, urlunsplit
+
+from flowcell_parser.db import HASH_FIELD, NAME_HASH_VIEW, apply_diff, doc_diff, doc_hash
+
+try:
+    import aiohttp
+    import yarl
+except ImportError:
+    # pip install flowcell_parser[async]
+    aiohttp = None
+
+log = logging.getLogger(__name__)
+
+
+class CouchError(Exception):
+    """Unexpected reply from CouchDB"""
+    def __init__(self, status, body):
+        super(CouchError, self).__init__("{0}: {1}".format(status, body))
+        self.status = status
+        self.body = body
+
+
+class AsyncCouchDB(object):
+    """One CouchDB database, reached through at most max_connections
+    keep-alive connections.
+
+    Every write is conditional, on the _rev of the document or on a new
+    _id chosen here, so a request sent again after its connection dropped
+    gets a 409 instead of being applied twice. Such requests are sent
+    again once.
+
+    .requests : number of requests sent
+    .connections : number of connections opened
+    """
+    def __init__(self, url, name, max_connections=10, timeout=60):
+        if aiohttp is None:
+            raise ImportError("AsyncCouchDB needs aiohttp, "
+                              "install flowcell_parser[async]")
+        parts = urlsplit(url)
+        self.name = name
+        netloc = parts.hostname + (':{0}'.format(parts.port) if parts.port else '')
+        self.url = urlunsplit((parts.scheme, netloc, parts.path.rstrip('/'), '', '')) + \
+            '/' + quote(name, safe='')
+        self.auth = None
+        if parts.username:
+            self.auth = aiohttp.BasicAuth(unquote(parts.username),
+                                          unquote(parts.password or ''))
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.requests = 0
+        self.connections = 0
+        self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self):
+        if self._session is None:
+            trace = aiohttp.TraceConfig()
+
+            async def connection_created(session, context, params):
+                self.connections += 1
+
+            trace.on_connection_create_end.append(connection_created)
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                auth=self.auth, timeout=aiohttp.ClientTimeout(total=self.timeout),
+                trace_configs=[trace])
+        return self._session
+
+    async def request(self, method, path='', body=None, query=None):
+        """Sends a request below the database url, returns (status, json body)"""
+        url = self.url + ('/' + path if path else '')
+        if query:
+            url += '?' + urlencode(query)
+        url = yarl.URL(url, encoded=True)
+        session = self._get_session()
+        for attempt in (1, 2):
+            self.requests += 1
+            try:
+                async with session.request(method, url, json=body,
+                                           headers={'Accept': 'application/json'}) as response:
+                    data = await response.read()
+                    break
+            except (aiohttp.ServerDisconnectedError, aiohttp.ClientOSError):
+                # most likely a keep-alive connection the server closed
+                if attempt == 2:
+                    raise
+        return response.status, json.loads(data.decode('utf-8')) if data else None
+
+    async def view(self, name, key=None, keys=None):
+        """Rows of a design/view, optionally of one key or a list of keys"""
+        design, view = name.split('/')
+        path = '_design/{0}/_view/{1}'.format(quote(design, safe=''), quote(view, safe=''))
+        if keys is not None:
+            status, body = await self.request('POST', path, body={'keys': keys})
+        elif key is not None:
+            status, body = await self.request('GET', path, query={'key': json.dumps(key)})
+        else:
+            status, body = await self.request('GET', path)
+        if status != 200:
+            raise CouchError(status, body)
+        return body['rows']
+
+    async def get(self, doc_id):
+        """The document, None if there is none with that id"""
+        status, body = await self.request('GET', doc_path(doc_id))
+        if status == 404:
+            return None
+        if status != 200:
+            raise CouchError(status, body)
+        return body
+
+    async def save(self, doc):
+        """Writes a document, giving it a new id if it has none. Returns
+        (status, body): 201 or 202 on success, 409 on a conflict."""
+        if '_id' not in doc:
+            doc = dict(doc, _id=uuid.uuid4().hex)
+        return await self.request('PUT', doc_path(doc['_id']), body=doc)
+
+
+def doc_path(doc_id):
+    if doc_id.startswith('_design/'):
+        return '_design/' + quote(doc_id[len('_design/'):], safe='')
+    return quote(doc_id, safe='')
+
+
+async def update_doc(db, obj, over_write_db_entry=False, skip_unchanged=False,
+                     retries=5, backoff=0.1):
+    """Same as flowcell_parser.db.update_doc on an AsyncCouchDB.
+
+    A write rejected with a 409 conflict is retried up to `retries` times,
+    reading the document again and merging into it, after waiting
+    backoff * 2 ** attempt seconds with jitter.
+    Returns the status, as bulk_update_docs does.
+    """
+    obj[HASH_FIELD] = doc_hash(obj)
+    name = obj['name']
+    for attempt in range(retries + 1):
+        if attempt:
+            delay = backoff * 2 ** (attempt - 1)
+            await asyncio.sleep(delay + random.uniform(0, delay))
+        try:
+            status = await _write_once(db, obj, over_write_db_entry, skip_unchanged)
+        except (CouchError, aiohttp.ClientError, OSError, asyncio.TimeoutError) as e:
+            log.error("could not write {0}: {1}".format(name, e))
+            return 'error'
+        if status != 'conflict':
+            return status
+        log.debug("conflict when writing {0}, attempt {1}".format(name, attempt + 1))
+    log.warning("conflict when writing {0}".format(name))
+    return 'conflict'
+
+
+async def _write_once(db, obj, over_write_db_entry, skip_unchanged):
+    """Writes obj once, leaving it as it is for the retries"""
+    obj = dict(obj)
+    name = obj['name']
+    action = None
+    if skip_unchanged:
+        try:
+            hash_rows = await db.view(NAME_HASH_VIEW, key=name)
+        except CouchError as e:
+            if e.status != 404:
+                raise
+            log.warning("{0} is missing in {1}, comparing whole documents "
+                        "instead".format(NAME_HASH_VIEW, db.name))
+            hash_rows = []
+        if len(hash_rows) == 1:
+            if hash_rows[0]['value'][HASH_FIELD] == obj[HASH_FIELD]:
+                log.debug("{0} is unchanged".format(name))
+                return 'unchanged'
+            if over_write_db_entry:
+                obj['_id'] = hash_rows[0]['id']
+                obj['_rev'] = hash_rows[0]['value']['_rev']
+                action = 'updated'
+    if action is None:
+        rows = await db.view('info/name', key=name)
+        if len(rows) == 1:
+            remote_doc = rows[0]['value']
+            # remove id and rev for comparison
+            doc_id = remote_doc.pop('_id')
+            doc_rev = remote_doc.pop('_rev')
+            if remote_doc == obj:
+                return 'unchanged'
+            if not over_write_db_entry:
+                # merge(obj, remote_doc) without changing obj, sharing the
+                # unchanged parts instead of copying the whole document
+                obj = apply_diff(remote_doc, doc_diff(remote_doc, obj))
+            obj['_id'] = doc_id
+            obj['_rev'] = doc_rev
+            action = 'updated'
+        elif len(rows) == 0:
+            action = 'saved'
+        else:
+            log.warning("more than one row with name {0} found".format(name))
+            return 'duplicate'
+    status, body = await db.save(obj)
+    if status == 409:
+        return 'conflict'
+    if status not in (200, 201, 202):
+        raise CouchError(status, body)
+    log.info("{0} {1}".format("updating" if action == 'updated' else "saving", name))
+    return action
+
+
+async def update_docs(db, objs, over_write_db_entry=False, skip_unchanged=False,
+                      concurrency=10, retries=5, backoff=0.1):
+    """Runs update_doc for all objs, at most `concurrency` at a time.
+    Documents with the same name are written one after the other, so that
+    they are merged and not saved twice. Returns a dict name -> status."""
+    slots = asyncio.Semaphore(concurrency)
+    name_locks = {}
+    status = {}
+
+    async def one(obj):
+        name_lock = name_locks.setdefault(obj['name'], asyncio.Lock())
+        async with name_lock, slots:
+            status[obj['name']] = await update_doc(
+                db, obj, over_write_db_entry=over_write_db_entry,
+                skip_unchanged=skip_unchanged, retries=retries, backoff=backoff)
+
+    await asyncio.gather(*[one(obj) for obj in objs])
+    return status
+
+
+def setupAsyncDB(conf, name, max_connections=10):
+    """AsyncCouchDB for a database of the statusdb server of conf, as
+    flowcell_parser.db.setupServer"""
+    db_conf = conf['statusdb']
+    url = "https://{0}:{1}@{2}".format(
+        quote(db_conf['username'], safe=''),
+        quote(db_conf['password'], safe=''),
+        db_conf['url'])
+    return AsyncCouchDB(url, name, max_connections=max_connections)
+
+
+def sync_docs(conf, name, objs, concurrency=10, **kwargs):
+    """Blocking entry point: uploads objs to a database of the statusdb
+    server of conf with update_docs, returns a dict name -> status"""
+    async def run():
+        async with setupAsyncDB(conf, name, max_connections=concurrency) as db:
+            return await update_docs(db, objs, concurrency=concurrency, **kwargs)
+    return asyncio.run(run())
@@ -0,0 +1,295 @@
+"""Batch ingestion of many run folders.
+
+Run folders are parsed with RunParser on a process pool and the resulting
+documents are streamed to a sink as soon as each one is ready.
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+import time
+import traceback
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from io import open
+
+import yaml
+
+from flowcell_parser import db
+from flowcell_parser.classes import RunParser
+from flowcell_parser.index import RunFolderIndex
+
+log = logging.getLogger(__name__)
+
+
+class JsonLinesSink(object):
+    """Writes one json document per line to a file"""
+    def __init__(self, path):
+        self.path = path
+        self.handle = open(path, 'w', encoding='utf-8')
+
+    def write(self, obj):
+        self.handle.write(json.dumps(obj, sort_keys=True) + u'\n')
+
+    def close(self):
+        self.handle.close()
+
+
+class DirectorySink(object):
+    """Writes each document to <directory>/<name>.json"""
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def write(self, obj):
+        doc_path = os.path.join(self.path, "{0}.json".format(obj['name']))
+        with open(doc_path, 'w', encoding='utf-8') as handle:
+            handle.write(json.dumps(obj, sort_keys=True, indent=2))
+
+    def close(self):
+        pass
+
+
+# upload statuses of the documents that made it to the database
+UPLOADED = ('saved', 'updated', 'unchanged')
+
+
+class CouchDBSink(object):
+    """Uploads the documents in batches with flowcell_parser.db.bulk_update_docs
+
+    .status : a dict name -> upload status, see bulk_update_docs, 'error'
+              for all the documents of a batch whose upload raised
+    .errors : a dict name -> error message, for the batches that raised
+    """
+    def __init__(self, database, over_write_db_entry=False, batch_size=100,
+                 skip_unchanged=False):
+        self.database = database
+        self.over_write_db_entry = over_write_db_entry
+        self.batch_size = batch_size
+        self.skip_unchanged = skip_unchanged
+        self.pending = []
+        self.status = {}
+        self.errors = {}
+
+    def write(self, obj):
+        self.pending.append(obj)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        try:
+            self.status.update(db.bulk_update_docs(self.database, self.pending,
+                                                   self.over_write_db_entry,
+                                                   self.batch_size,
+                                                   self.skip_unchanged))
+        except Exception:
+            error = traceback.format_exc()
+            log.error("failed to upload {0} documents:\n{1}".format(len(self.pending), error))
+            for obj in self.pending:
+                self.status[obj['name']] = 'error'
+                self.errors[obj['name']] = error
+        self.pending = []
+
+    def close(self):
+        self.flush()
+
+
+class CouchDBPatchSink(object):
+    """Uploads each document as its changes from the previous upload of
+    the same document, with flowcell_parser.db.patch_doc, for documents
+    written again and again such as those of the watch mode"""
+    def __init__(self, database, over_write_db_entry=False):
+        self.database = database
+        self.over_write_db_entry = over_write_db_entry
+        # name -> document as stored
+        self.previous = {}
+
+    def write(self, obj):
+        stored = db.patch_doc(self.database, obj, self.previous.get(obj['name']),
+                              self.over_write_db_entry)
+        if stored is None:
+            self.previous.pop(obj['name'], None)
+        else:
+            self.previous[obj['name']] = stored
+
+    def close(self):
+        pass
+
+
+def expand_run_folders(patterns):
+    """Expands globs and keeps the order in which folders were given.
+    A folder given more than once, even as another path to it such as
+    run/ and ./run, is only kept the first time."""
+    run_folders = []
+    seen = set()
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        for run_folder in matches:
+            real_path = os.path.realpath(run_folder)
+            if real_path not in seen:
+                seen.add(real_path)
+                run_folders.append(run_folder)
+    return run_folders
+
+
+def parse_run_folder(path, index_path=None):
+    """Worker function, returns (path, document, error, elapsed time)"""
+    start = time.perf_counter()
+    index = RunFolderIndex(index_path) if index_path else None
+    try:
+        obj = RunParser(path, index=index).obj
+        error = None
+    except Exception:
+        obj = None
+        error = traceback.format_exc()
+    finally:
+        if index is not None:
+            index.close()
+    return path, obj, error, time.perf_counter() - start
+
+
+def ingest(run_folders, sink, workers=None, index_path=None):
+    """Parses run folders on a process pool and writes their documents
+    to the sink as they complete.
+
+    With index_path, the given folders, run folders or sequencer roots,
+    are first scanned into that run folder index (see
+    flowcell_parser.index) and the workers look the files up in it.
+
+    Sinks buffering documents, such as CouchDBSink, are flushed before the
+    report is made, and the documents their .status reports as not
+    uploaded are counted as failures.
+
+    Returns a report with the number of runs written, the failures by run
+    folder and the throughput in runs per second per core.
+    """
+    run_folders = expand_run_folders(run_folders)
+    if index_path:
+        index = RunFolderIndex(index_path)
+        try:
+            run_folders = expand_run_folders(
+                [run_folder for root in run_folders for run_folder in index.scan(root)])
+        finally:
+            index.close()
+    workers = workers or os.cpu_count() or 1
+    report = {'runs': len(run_folders),
+              'written': 0,
+              'failures': {},
+              'parse_seconds': {}}
+    start = time.perf_counter()
+    # (name, run folder) of the documents given to the sink
+    written = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(parse_run_folder, run_folder, index_path)
+                   for run_folder in run_folders]
+        for future in as_completed(futures):
+            path, obj, error, elapsed = future.result()
+            report['parse_seconds'][path] = elapsed
+            if error is None:
+                try:
+                    sink.write(obj)
+                except Exception:
+                    error = traceback.format_exc()
+            if error is None:
+                written.append((obj['name'], path))
+            else:
+                report['failures'][path] = error
+                log.error("failed to ingest {0}:\n{1}".format(path, error))
+    try:
+        if hasattr(sink, 'flush'):
+            sink.flush()
+    except Exception:
+        error = traceback.format_exc()
+        for _, path in written:
+            report['failures'][path] = error
+        written = []
+    status = getattr(sink, 'status', {})
+    errors = getattr(sink, 'errors', {})
+    for name, path in written:
+        if name in status and status[name] not in UPLOADED:
+            report['failures'][path] = errors.get(name) or "{0} when uploading {1}".format(
+                status[name], name)
+            log.error("failed to upload {0}: {1}".format(path, status[name]))
+        else:
+            report['written'] += 1
+            log.info("ingested {0}".format(path))
+    elapsed = time.perf_counter() - start
+    report['elapsed'] = elapsed
+    report['workers'] = workers
+    report['runs_per_core_second'] = (len(run_folders) / (elapsed * workers)
+                                      if elapsed else 0.0)
+    return report
+
+
+def add_sink_arguments(parser):
+    sinks = parser.add_mutually_exclusive_group(required=True)
+    sinks.add_argument('--jsonl', help="write the documents to this json lines file")
+    sinks.add_argument('--outdir', help="write one json file per document in this directory")
+    sinks.add_argument('--couchdb', metavar='CONFIG',
+                       help="upload to statusdb, using the statusdb section of this yaml config")
+    parser.add_argument('--database', default='x_flowcells',
+                        help="couchdb database to upload to")
+    parser.add_argument('--over-write', action='store_true',
+                        help="do not merge with the documents already in the database")
+    parser.add_argument('--skip-unchanged', action='store_true',
+                        help="skip the documents whose content hash did not change")
+    parser.add_argument('--patch', action='store_true',
+                        help="upload the documents as their changes from the stored ones, "
+                        "not with --skip-unchanged")
+
+
+def sink_from_arguments(args):
+    """Sink of the add_sink_arguments options. Raises ValueError for
+    options that do not go together"""
+    if args.skip_unchanged and args.patch:
+        raise ValueError("--skip-unchanged cannot be used with --patch")
+    if args.jsonl:
+        return JsonLinesSink(args.jsonl)
+    if args.outdir:
+        return DirectorySink(args.outdir)
+    with open(args.couchdb) as conf_file:
+        conf = yaml.safe_load(conf_file)
+    database = db.setupServer(conf)[args.database]
+    if args.skip_unchanged:
+        db.install_hash_view(database)
+    if args.patch:
+        return CouchDBPatchSink(database, args.over_write)
+    return CouchDBSink(database, args.over_write, skip_unchanged=args.skip_unchanged)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Parse many run folders and stream their documents to a sink")
+    parser.add_argument('run_folders', nargs='+',
+                        help="run folders or glob patterns")
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help="number of parser processes, defaults to the number of cores")
+    add_sink_arguments(parser)
+    parser.add_argument('--report', help="write the ingestion report as json to this file")
+    parser.add_argument('--index', metavar='FILE',
+                        help="scan the given folders, run folders or sequencer roots, "
+                        "into this run folder index and parse the run folders from it")
+    args = parser.parse_args(args)
+    logging.basicConfig(level=logging.INFO)
+
+    try:
+        sink = sink_from_arguments(args)
+    except ValueError as e:
+        parser.error(str(e))
+    try:
+        report = ingest(args.run_folders, sink, args.workers, args.index)
+    finally:
+        sink.close()
+
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as report_file:
+            report_file.write(json.dumps(report, indent=2, sort_keys=True))
+    print("{written}/{runs} runs ingested in {elapsed:.1f}s "
+          "({runs_per_core_second:.2f} runs/s/core)".format(**report))
+    for path, error in sorted(report['failures'].items()):
+        print("FAILED {0}: {1}".format(path, error.strip().splitlines()[-1]))
+    return 1 if report['failures'] else 0
@@ -0,0 +1,122 @@
+"""Persistent parse cache for run folders.
+
+Parsed results are stored in a SQLite file, keyed on the parsed file, the
+parser class and the options it was run with. An entry is reused as long as the file's mtime and size
+and the flowcell_parser version are the same as when it was parsed.
+"""
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+from flowcell_parser import __version__
+
+log = logging.getLogger(__name__)
+
+
+def file_fingerprint(path):
+    """(mtime_ns, size) of a file. For a folder, the entries it contains are
+    folded into the fingerprint so that any new or changed file shows up."""
+    stat = os.stat(path)
+    if not os.path.isdir(path):
+        return stat.st_mtime_ns, stat.st_size
+    mtime = stat.st_mtime_ns
+    size = 0
+    for entry in os.scandir(path):
+        if entry.is_file():
+            entry_stat = entry.stat()
+            mtime = max(mtime, entry_stat.st_mtime_ns)
+            size += entry_stat.st_size
+    return mtime, size
+
+
+def parser_key(parser_class, options=None):
+    """Identifies a parser class and the options it was run with"""
+    if not options:
+        return parser_class.__name__
+    return "{0}:{1}".format(parser_class.__name__, json.dumps(options, sort_keys=True))
+
+
+class ParseCache(object):
+    """SQLite backed cache of parser objects.
+
+    .hits, .misses : lookup counters since the cache was opened
+    """
+    def __init__(self, path, version=__version__):
+        self.path = path
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS parsed ("
+                " path TEXT NOT NULL,"
+                " parser TEXT NOT NULL,"
+                " version TEXT NOT NULL,"
+                " mtime_ns INTEGER NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " payload BLOB NOT NULL,"
+                " last_used REAL NOT NULL,"
+                " PRIMARY KEY (path, parser))")
+
+    def get(self, parser_class, path, options=None):
+        """Returns (parser, fingerprint). The parser is None on a miss, and
+        the fingerprint is None when the file does not exist."""
+        path = os.path.abspath(path)
+        key = parser_key(parser_class, options)
+        try:
+            fingerprint = file_fingerprint(path)
+        except OSError:
+            return None, None
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT version, mtime_ns, size, payload FROM parsed"
+                " WHERE path = ? AND parser = ?",
+                (path, key)).fetchone()
+            if row is None or tuple(row[:3]) != (self.version,) + fingerprint:
+                self.misses += 1
+                return None, fingerprint
+            with self._connection:
+                self._connection.execute(
+                    "UPDATE parsed SET last_used = ? WHERE path = ? AND parser = ?",
+                    (time.time(), path, key))
+            self.hits += 1
+        return pickle.loads(row[3]), fingerprint
+
+    def put(self, parser, path, fingerprint, options=None):
+        """Stores a parser object with the fingerprint taken before parsing"""
+        path = os.path.abspath(path)
+        payload = pickle.dumps(parser, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO parsed VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (path, parser_key(type(parser), options), self.version, fingerprint[0],
+                 fingerprint[1], sqlite3.Binary(payload), time.time()))
+
+    def evict(self, max_age=None):
+        """Drops the entries of files that no longer exist, and those not
+        used in the last max_age seconds. Returns the number of entries dropped."""
+        with self._lock, self._connection:
+            rows = self._connection.execute("SELECT path, parser, last_used FROM parsed").fetchall()
+            now = time.time()
+            stale = [(path, parser) for path, parser, last_used in rows
+                     if not os.path.exists(path) or
+                     (max_age is not None and now - last_used > max_age)]
+            self._connection.executemany(
+                "DELETE FROM parsed WHERE path = ? AND parser = ?", stale)
+        if stale:
+            log.info("evicted {0} entries from {1}".format(len(stale), self.path))
+        return len(stale)
+
+    def stats(self):
+        with self._lock:
+            entries = self._connection.execute("SELECT COUNT(*) FROM parsed").fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries}
+
+    def close(self):
+        self._connection.close()
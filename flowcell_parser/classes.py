@@ -1,16 +1,32 @@
 import re
 import os
+import sys
 import csv
 import xml.etree.ElementTree as ET
 import logging
 import glob
 import json
+import heapq
+import itertools
+import time
+import tracemalloc
+from array import array
 from datetime import datetime
 
 from collections import OrderedDict
-from bs4 import BeautifulSoup  # html parser
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from html.parser import HTMLParser
 from io import open
 
+from flowcell_parser import jsonstream
+
+try:
+    import resource
+except ImportError:
+    # not available on windows
+    resource = None
+
 
 class RunParser(object):
     """Parses an Illumina run folder. It generates data for statusdb
@@ -20,140 +36,431 @@ class RunParser(object):
     :RunParametersParser runparameters: see RunParametersParser
     :SampleSheetParser samplesheet: see SampleSheetParser
     :LaneBarcodeParser lanebarcodes: see LaneBarcodeParser
+    :dict timings: seconds spent parsing each file, by attribute
+    :dict metrics: what parsing each file cost and produced, see parse
+    :ParseCache cache: optional cache of the parsed files, see flowcell_parser.cache
+    :RunFolderIndex index: optional index of the run folders, see flowcell_parser.index
+
+    parser_options maps parser attributes to extra keyword arguments for
+    their parser, e.g. {'json_stats': {'fields': DEFAULT_STATS_FIELDS}}.
+
+    In lazy mode nothing is parsed up front: each parser attribute is
+    parsed on first access and kept, and obj is only built, from the
+    given sections (parser attributes) or all of them, when accessed.
+
+    metrics_hook is called with .metrics each time files have been parsed,
+    to export them. With trace_memory, the peak memory allocated by each
+    parser is traced with tracemalloc, which slows parsing down.
     """
-    def __init__(self, path):
+    def __init__(self, path, workers=1, use_processes=False, cache=None,
+                 lazy=False, sections=None, parser_options=None, index=None,
+                 metrics_hook=None, trace_memory=False):
         if os.path.exists(path):
             self.log = logging.getLogger(__name__)
             self.path = path
-            self.parse()
-            self.create_db_obj()
+            self.workers = workers
+            self.use_processes = use_processes
+            self.cache = cache
+            self.index = index
+            self.lazy = lazy
+            self.sections = sections
+            self.parser_options = parser_options or {}
+            self.timings = {}
+            self.metrics = {'run': path, 'seconds': 0.0, 'parsers': {}}
+            self.metrics_hook = metrics_hook
+            self.trace_memory = trace_memory
+            if lazy:
+                self._artifacts, self._missing, self._fingerprints = \
+                    self._run_folder_artifacts()
+            else:
+                self.parse()
+                self.create_db_obj(sections)
         else:
             raise os.error("Flowcell cannot be found at {0}".format(path))
 
+    def __getattr__(self, name):
+        # only called for attributes not set yet, which in lazy mode are
+        # the parsers that have not been accessed and obj
+        lazy_artifacts = self.__dict__.get('_artifacts')
+        if lazy_artifacts is None:
+            raise AttributeError(name)
+        if name == 'obj':
+            self.create_db_obj(self.sections)
+            return self.obj
+        for artifact in lazy_artifacts:
+            if artifact[0] == name:
+                self._parse_artifacts([artifact], self._missing, self._fingerprints)
+                return self.__dict__[name]
+        raise AttributeError(name)
+
     def parse(self, demultiplexing_dir='Demultiplexing'):
-        """Tries to parse as many files as possible from a run folder"""
-        pattern = r'(\d{6,8})_([ST-]*\w+\d+)_\d+_([AB]?)([A-Z0-9\-]+)'
-        m = re.match(pattern, os.path.basename(os.path.abspath(self.path)))
-        instrument = m.group(2)
-        # NextSeq2000 has a different FC ID pattern that ID contains the first position letter
-        if "VH" in instrument:
-            fc_name = m.group(3) + m.group(4)
-        else:
-            fc_name = m.group(4)
-        # For MiSeq we parse the samplesheet "run_folder/SampleSheet_copy.csv"
-        if "M0" in instrument:
-            samplesheet_path = os.path.join(self.path, 'SampleSheet_copy.csv')
+        """Tries to parse as many files as possible from a run folder
+
+        With more than one worker the files are parsed concurrently, in
+        threads or in processes if use_processes is set. The wall-clock
+        time spent on each file is stored in .timings
+        With a cache (see flowcell_parser.cache.ParseCache), only the files
+        that changed since they were cached are parsed again.
+        With an index (see flowcell_parser.index.RunFolderIndex), the files
+        are looked up in it instead of on disk, and the missing ones are
+        not opened at all.
+
+        .metrics['parsers'] has, by attribute, the wall-clock seconds, the
+        bytes of input, the number of records produced (see count_records),
+        the source: 'parsed', 'cache', 'missing' or, after update(),
+        'updated', process_peak_rss, the peak resident memory of the whole
+        process that ran the parser during its lifetime, which says little
+        of one parser in a long-lived process, and, with trace_memory,
+        peak_memory, the peak of the memory allocated while the parser ran.
+        Parsers running in threads share their allocations, so peak_memory
+        is only traced when parsing one file at a time or in processes.
+        .metrics['seconds'] is the total time spent parsing.
+        The bytes of input come from the index or the cache when there is
+        one, instead of a stat of each file.
+        """
+        self._parse_artifacts(*self._run_folder_artifacts(demultiplexing_dir))
+
+    def update(self, attributes, demultiplexing_dir='Demultiplexing'):
+        """Parses again the files of the given parser attributes, looked up
+        on disk, e.g. after they changed, and rebuilds obj if it was built.
+        Parsers following their file, such as CycleTimesParser, are kept
+        and only read what was appended to it, with the source 'updated'
+        in .metrics."""
+        artifacts = []
+        for artifact in run_folder_artifacts(self.path, demultiplexing_dir):
+            if artifact[0] in attributes and not self._follow(*artifact):
+                artifacts.append(artifact)
+        if artifacts:
+            self._parse_artifacts(artifacts)
         else:
-            samplesheet_path = os.path.join(self.path, 'SampleSheet.csv')
-        run_info_path = os.path.join(self.path, 'RunInfo.xml')
-        run_parameters_path = os.path.join(self.path, 'runParameters.xml')
-        cycle_times_log = os.path.join(self.path, 'Logs', "CycleTimes.txt")
-
-        # These three are generated post-demultiplexing and could thus
-        # potentially be replaced by reading from stats.json
-        lanebarcode_path = os.path.join(self.path,
-                               demultiplexing_dir,
-                               'Reports',
-                               'html',
-                               fc_name,
-                               'all', 'all', 'all',
-                               'laneBarcode.html')
-        lane_path = os.path.join(self.path,
-                               demultiplexing_dir,
-                               'Reports',
-                               'html',
-                               fc_name,
-                               'all', 'all', 'all',
-                               'lane.html')
-        undet_stats_dir = os.path.join(self.path,
-                                            demultiplexing_dir,
-                                           "Stats")
-        demux_stats_path = os.path.join(self.path,
-                                 demultiplexing_dir,
-                                 "Stats",
-                                 "Stats.json")
+            self._export_metrics()
+        if 'obj' in self.__dict__:
+            self.create_db_obj(self.sections)
 
+    def _follow(self, attribute, parser_class, path):
+        """Updates the parser of attribute from the end of its file, returns
+        False if it has to be parsed again instead"""
+        parser = self.__dict__.get(attribute)
+        if (not isinstance(parser, parser_class) or not hasattr(parser, 'update') or
+                parser.path != path):
+            return False
+        start = time.perf_counter()
+        offset = parser.offset
         try:
-            self.runinfo = RunInfoParser(run_info_path)
-        except OSError as e:
-            self.log.info(str(e))
-            self.runinfo = None
-        try:
-            self.runparameters = RunParametersParser(run_parameters_path)
-        except OSError as e:
-            self.log.info(str(e))
-            self.runparameters = None
-        try:
-            self.samplesheet = SampleSheetParser(samplesheet_path)
-        except OSError as e:
-            self.log.info(str(e))
-            self.samplesheet = None
-        try:
-            self.lanebarcodes = LaneBarcodeParser(lanebarcode_path)
-        except OSError as e:
-            self.log.info(str(e))
-            self.lanebarcodes = None
-        try:
-            self.lanes = LaneBarcodeParser(lane_path)
-        except OSError as e:
-            self.log.info(str(e))
-            self.lanes = None
-        try:
-            self.undet = DemuxSummaryParser(undet_stats_dir)
-        except OSError as e:
-            self.log.info(str(e))
-            self.undet = None
-        try:
-            self.time_cycles = CycleTimesParser(cycle_times_log)
-        except OSError as e:
-            self.log.info(str(e))
-            self.time_cycles = None
-        try:
-            self.json_stats = StatsParser(demux_stats_path)
-        except OSError as e:
-            self.log.info(str(e))
-            self.json_stats = None
+            records = parser.update()
+        except OSError:
+            return False
+        elapsed = time.perf_counter() - start
+        # the offset starts over when the file was replaced
+        read = parser.offset - offset if parser.offset >= offset else parser.offset
+        self.timings[attribute] = elapsed
+        self.metrics['parsers'][attribute] = parse_metrics('updated', elapsed, read, records)
+        self.metrics['seconds'] += elapsed
+        return True
+
+    def _run_folder_artifacts(self, demultiplexing_dir='Demultiplexing'):
+        """(artifacts, attributes known to be missing, fingerprints of the
+        files known to be present)"""
+        if self.index is not None and self.index.demultiplexing_dir == demultiplexing_dir:
+            return self.index.artifacts(self.path)
+        return run_folder_artifacts(self.path, demultiplexing_dir), set(), {}
+
+    def _parse_artifacts(self, artifacts, missing=(), known_fingerprints=None):
+        start = time.perf_counter()
+        results = {}
+        for attribute, _, path in artifacts:
+            if attribute in missing:
+                results[attribute] = (None, "{0} cannot be found".format(path),
+                                      parse_metrics('missing'))
+        fingerprints = {}
+        options = dict((attribute, self.parser_options.get(attribute, {}))
+                       for attribute, _, _ in artifacts)
+        if self.cache is not None:
+            for attribute, parser_class, path in artifacts:
+                if attribute in results:
+                    continue
+                cache_start = time.perf_counter()
+                parser, fingerprints[attribute] = self.cache.get(parser_class, path,
+                                                                 options[attribute])
+                if parser is not None:
+                    results[attribute] = (parser, None, parse_metrics(
+                        'cache', time.perf_counter() - cache_start, records=count_records(parser)))
+        to_parse = [artifact for artifact in artifacts if artifact[0] not in results]
+        # (mtime_ns, size) from the index or the cache, not to stat the files again
+        sizes = {}
+        for attribute, _, path in to_parse:
+            fingerprint = (known_fingerprints or {}).get(path) or fingerprints.get(attribute)
+            sizes[attribute] = fingerprint[1] if fingerprint else None
+        if self.workers > 1 and len(to_parse) > 1:
+            trace_memory = self.trace_memory and self.use_processes
+            if self.use_processes:
+                pool = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                pool = ThreadPoolExecutor(max_workers=self.workers)
+            with pool as executor:
+                futures = [executor.submit(run_parser, parser_class, path, options[attribute],
+                                           sizes[attribute], trace_memory)
+                           for attribute, parser_class, path in to_parse]
+                parsed = [future.result() for future in futures]
+        else:
+            parsed = [run_parser(parser_class, path, options[attribute], sizes[attribute],
+                                 self.trace_memory)
+                      for attribute, parser_class, path in to_parse]
+        for (attribute, _, path), result in zip(to_parse, parsed):
+            results[attribute] = result
+            if result[0] is not None and fingerprints.get(attribute):
+                self.cache.put(result[0], path, fingerprints[attribute], options[attribute])
+        for attribute, _, _ in artifacts:
+            parser, error, metrics = results[attribute]
+            if error:
+                self.log.info(error)
+            setattr(self, attribute, parser)
+            self.timings[attribute] = metrics['seconds']
+            self.metrics['parsers'][attribute] = metrics
+        self.metrics['seconds'] += time.perf_counter() - start
+        self._export_metrics()
+
+    def _export_metrics(self):
+        if self.metrics_hook is not None:
+            try:
+                self.metrics_hook(self.metrics)
+            except Exception as e:
+                self.log.warning("metrics hook failed for {0}: {1}".format(self.path, e))
+
+    def create_db_obj(self, sections=None):
+        """Builds the statusdb document, from the given parser attributes
+        only if sections is set"""
+        def section(attribute):
+            if sections is None or attribute in sections:
+                return getattr(self, attribute)
+            return None
 
-    def create_db_obj(self):
         self.obj = {}
         bits = os.path.basename(os.path.abspath(self.path)).split('_')
         name = "{0}_{1}".format(bits[0], bits[-1])
         self.obj['name'] = name
-        if self.runinfo:
-            self.obj['RunInfo'] = self.runinfo.data
-            if self.runinfo.recipe:
-                self.obj['run_setup'] = self.runinfo.recipe
-        if self.runparameters:
-            self.obj.update(self.runparameters.data)
-            if self.runparameters.recipe:
-                self.obj['run_setup'] = self.runparameters.recipe
-        if self.samplesheet:
-            self.obj['samplesheet_csv'] = self.samplesheet.data
-        if self.lanebarcodes:
+        runinfo = section('runinfo')
+        if runinfo:
+            self.obj['RunInfo'] = runinfo.data
+            if runinfo.recipe:
+                self.obj['run_setup'] = runinfo.recipe
+        runparameters = section('runparameters')
+        if runparameters:
+            self.obj.update(runparameters.data)
+            if runparameters.recipe:
+                self.obj['run_setup'] = runparameters.recipe
+        samplesheet = section('samplesheet')
+        if samplesheet:
+            self.obj['samplesheet_csv'] = samplesheet.data
+        lanebarcodes = section('lanebarcodes')
+        if lanebarcodes:
             self.obj['illumina'] = {}
             self.obj['illumina']['Demultiplex_Stats'] = {}
             self.obj['illumina']['Demultiplex_Stats']['Barcode_lane_statistics'] = \
-                self.lanebarcodes.sample_data
+                lanebarcodes.sample_data
             self.obj['illumina']['Demultiplex_Stats']['Flowcell_stats'] = \
-                self.lanebarcodes.flowcell_data
-            if self.lanes:
+                lanebarcodes.flowcell_data
+            lanes = section('lanes')
+            if lanes:
                 self.obj['illumina']['Demultiplex_Stats']['Lanes_stats'] = \
-                    self.lanes.sample_data
-        if self.undet:
-            self.obj['Undetermined'] = self.undet.result
-        if self.time_cycles:
-            for cycle in self.time_cycles.cycles:
-                for k, v in cycle.items():
-                    cycle[k] = str(v)
-            self.obj['time cycles'] = self.time_cycles.cycles
-        if self.json_stats:
-            self.obj['Json_Stats'] = self.json_stats.data
+                    lanes.sample_data
+        undet = section('undet')
+        if undet:
+            self.obj['Undetermined'] = undet.result
+        time_cycles = section('time_cycles')
+        if time_cycles:
+            self.obj['time cycles'] = [dict((k, str(v)) for k, v in cycle.items())
+                                       for cycle in time_cycles.cycles]
+        json_stats = section('json_stats')
+        if json_stats:
+            self.obj['Json_Stats'] = json_stats.data
+        demultiplexing_stats = section('demultiplexing_stats')
+        if demultiplexing_stats:
+            self.obj['DemultiplexingStats'] = demultiplexing_stats.data
+
+
+RUN_FOLDER_PATTERN = r'(\d{6,8})_([ST-]*\w+\d+)_\d+_([AB]?)([A-Z0-9\-]+)'
+
+
+def parse_run_folder_name(name):
+    """Date, instrument, instrument type and flowcell of a run folder name,
+    None if the name does not look like a run folder"""
+    m = re.match(RUN_FOLDER_PATTERN, name)
+    if m is None:
+        return None
+    instrument = m.group(2)
+    # NextSeq2000 has a different FC ID pattern that ID contains the first position letter
+    if "VH" in instrument:
+        fc_name = m.group(3) + m.group(4)
+        instrument_type = 'NextSeq2000'
+    else:
+        fc_name = m.group(4)
+        if "M0" in instrument:
+            instrument_type = 'MiSeq'
+        elif instrument.startswith('ST-'):
+            instrument_type = 'HiSeqX'
+        else:
+            instrument_type = None
+    return {'date': m.group(1),
+            'instrument': instrument,
+            'instrument_type': instrument_type,
+            'flowcell': fc_name}
+
+
+def run_folder_artifacts(path, demultiplexing_dir='Demultiplexing', exists=os.path.exists):
+    """Lists the files RunParser reads from a run folder, as
+    (attribute, parser class, path) tuples.
+    exists is used where the location of a file depends on what is on disk."""
+    run_folder = parse_run_folder_name(os.path.basename(os.path.abspath(path)))
+    if run_folder is None:
+        raise AttributeError("{0} is not a run folder name".format(path))
+    fc_name = run_folder['flowcell']
+    # For MiSeq we parse the samplesheet "run_folder/SampleSheet_copy.csv"
+    if "M0" in run_folder['instrument']:
+        samplesheet_path = os.path.join(path, 'SampleSheet_copy.csv')
+    else:
+        samplesheet_path = os.path.join(path, 'SampleSheet.csv')
+    run_info_path = os.path.join(path, 'RunInfo.xml')
+    run_parameters_path = os.path.join(path, 'runParameters.xml')
+    cycle_times_log = os.path.join(path, 'Logs', "CycleTimes.txt")
+
+    # These three are generated post-demultiplexing and could thus
+    # potentially be replaced by reading from stats.json
+    reports_dir = os.path.join(path,
+                               demultiplexing_dir,
+                               'Reports',
+                               'html',
+                               fc_name,
+                               'all', 'all', 'all')
+    lanebarcode_path = os.path.join(reports_dir, 'laneBarcode.html')
+    lane_path = os.path.join(reports_dir, 'lane.html')
+    undet_stats_dir = os.path.join(path,
+                                   demultiplexing_dir,
+                                   "Stats")
+    demux_stats_path = os.path.join(undet_stats_dir, "Stats.json")
+    # bcl2fastq writes DemultiplexingStats.xml in the Stats folder, older
+    # runs have it at the root of the run folder
+    demultiplexing_stats_path = os.path.join(undet_stats_dir, 'DemultiplexingStats.xml')
+    if not exists(demultiplexing_stats_path):
+        demultiplexing_stats_path = os.path.join(path, 'DemultiplexingStats.xml')
+
+    return [('runinfo', RunInfoParser, run_info_path),
+            ('runparameters', RunParametersParser, run_parameters_path),
+            ('samplesheet', SampleSheetParser, samplesheet_path),
+            ('lanebarcodes', LaneBarcodeParser, lanebarcode_path),
+            ('lanes', LaneBarcodeParser, lane_path),
+            ('undet', DemuxSummaryParser, undet_stats_dir),
+            ('time_cycles', CycleTimesParser, cycle_times_log),
+            ('json_stats', StatsParser, demux_stats_path),
+            ('demultiplexing_stats', DemultiplexingStatsParser, demultiplexing_stats_path)]
+
+
+def run_parser(parser_class, path, options=None, size=None, trace_memory=False):
+    """Runs a single parser, returns (parser, error message, metrics), see
+    RunParser.parse for the metrics.
+    A missing file gives no parser and the error message to log.
+    size is the input size when already known, the file is looked at
+    otherwise. With trace_memory the peak memory allocated while parsing
+    is traced, which is only meaningful when no other thread allocates."""
+    started_tracing = False
+    if trace_memory:
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        else:
+            tracemalloc.start()
+            started_tracing = True
+        traced_before = tracemalloc.get_traced_memory()[0]
+    peak_memory = None
+    start = time.perf_counter()
+    try:
+        parser = parser_class(path, **(options or {}))
+        error = None
+    except OSError as e:
+        parser = None
+        error = str(e)
+    finally:
+        elapsed = time.perf_counter() - start
+        if trace_memory:
+            peak_memory = tracemalloc.get_traced_memory()[1] - traced_before
+            if started_tracing:
+                tracemalloc.stop()
+    if parser is None:
+        return parser, error, parse_metrics('missing', elapsed)
+    if size is None:
+        size = input_bytes(path)
+    return parser, error, parse_metrics(
+        'parsed', elapsed, size, count_records(parser), peak_rss(), peak_memory)
+
+
+def parse_metrics(source, seconds=0.0, input_bytes=0, records=0, process_peak_rss=None,
+                  peak_memory=None):
+    return {'source': source,
+            'seconds': seconds,
+            'bytes': input_bytes,
+            'records': records,
+            'process_peak_rss': process_peak_rss,
+            'peak_memory': peak_memory}
+
+
+def peak_rss():
+    """Peak resident memory of the process over its lifetime in bytes, None
+    where the resource module is not available"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def input_bytes(path):
+    """Size of a file, or of the files directly in a folder"""
+    try:
+        if not os.path.isdir(path):
+            return os.path.getsize(path)
+        with os.scandir(path) as entries:
+            return sum(entry.stat().st_size for entry in entries if entry.is_file())
+    except OSError:
+        return 0
+
+
+def count_records(parser):
+    """Number of records a parser produced: rows, reads, cycles..."""
+    if isinstance(parser, RunInfoParser):
+        return len(parser.data.get('Reads', []))
+    if isinstance(parser, SampleSheetParser):
+        return len(parser.data)
+    if isinstance(parser, LaneBarcodeParser):
+        if parser.columns is not None:
+            return parser.columns.rows
+        return len(parser.sample_data)
+    if isinstance(parser, DemuxSummaryParser):
+        return sum(len(indexes) for indexes in parser.result.values())
+    if isinstance(parser, CycleTimesParser):
+        return len(parser.cycles)
+    if isinstance(parser, DemultiplexingStatsParser):
+        return len(parser.data['columns']['lane'])
+    if isinstance(parser, StatsParser):
+        return len((parser.data or {}).get('ConversionResults', []))
+    return 1
 
 
 class DemuxSummaryParser(object):
-    def __init__(self, path):
+    """Parses the DemuxSummaryF1L?.txt files of a bcl2fastq Stats folder.
+
+    .result : a dict lane -> OrderedDict of the `top` most frequent
+              undetermined index sequences, most frequent first
+    .TOTAL : a dict lane -> total number of undetermined reads
+
+    Lanes are read in parallel worker processes when `workers` is larger
+    than one, which is left to the caller, e.g. with
+    RunParser(parser_options={'undet': {'workers': 4}}): the parser may
+    already run in a process pool or next to other threads.
+    """
+    def __init__(self, path, top=50, workers=1):
         if os.path.exists(path):
             self.path = path
+            self.top = top
+            self.workers = workers
             self.result = {}
             self.TOTAL = {}
             self.parse()
@@ -161,68 +468,304 @@ class DemuxSummaryParser(object):
             raise os.error("DemuxSummary folder {0} cannot be found".format(path))
 
     def parse(self):
-        # will only save the 50 more frequent indexes
         pattern = re.compile('DemuxSummaryF1L([0-9]).txt')
-        for file in glob.glob(os.path.join(self.path, 'DemuxSummaryF1L?.txt')):
-            lane_nb = pattern.search(file).group(1)
-            self.result[lane_nb] = OrderedDict()
-            self.TOTAL[lane_nb] = 0
-            with open(file, newline='') as f:
-                undeterminePart = False
-                for line in f:
-                    if not undeterminePart:
-                        if "### Columns:" in line:
-                            undeterminePart = True
+        files = sorted(glob.glob(os.path.join(self.path, 'DemuxSummaryF1L?.txt')))
+        lanes = [pattern.search(file).group(1) for file in files]
+        workers = min(self.workers, len(files))
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                summaries = list(executor.map(parse_demux_summary,
+                                              files, [self.top] * len(files)))
+        else:
+            summaries = [parse_demux_summary(file, self.top) for file in files]
+        for lane_nb, (top_indexes, total) in zip(lanes, summaries):
+            self.result[lane_nb] = top_indexes
+            self.TOTAL[lane_nb] = total
+
+
+def parse_demux_summary(path, top=50, chunk_size=4 * 1024 * 1024):
+    """Streams a single DemuxSummaryF1L?.txt file in large chunks.
+
+    Returns an OrderedDict of the `top` most frequent index sequences
+    (ties keep file order) and the total hit count of the lane.
+    """
+    heap = []
+    total = 0
+    seen = 0
+    undetermined_part = False
+    remainder = ''
+    with open(path, newline='') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            text = remainder + chunk
+            if chunk:
+                # keep the trailing partial line for the next chunk
+                cut = text.rfind('\n') + 1
+                text, remainder = text[:cut], text[cut:]
+            if not undetermined_part:
+                start = text.find("### Columns:")
+                if start == -1:
+                    text = ''
+                else:
+                    undetermined_part = True
+                    text = text[text.find('\n', start) + 1:]
+            # it means I am reading the index_Sequence  Hit_Count
+            fields = text.split()
+            counts = list(map(int, fields[1::2]))
+            total += sum(counts)
+            # only counts above the smallest kept one can enter the heap
+            threshold = heap[0][0] if heap and len(heap) >= top else -1
+            for position, count in enumerate(counts):
+                if count > threshold and top > 0:
+                    item = (count, -(seen + position), fields[2 * position])
+                    if len(heap) < top:
+                        heapq.heappush(heap, item)
                     else:
-                        # it means I am readng the index_Sequence  Hit_Count
-                        components = line.rstrip().split('\t')
-                        if len(self.result[lane_nb].keys()) < 50:
-                            self.result[lane_nb][components[0]] = int(components[1])
-                        self.TOTAL[lane_nb] += int(components[1])
+                        heapq.heapreplace(heap, item)
+                    if len(heap) >= top:
+                        threshold = heap[0][0]
+            seen += len(counts)
+            if not chunk:
+                break
+    top_indexes = OrderedDict()
+    for count, _, index in sorted(heap, reverse=True):
+        top_indexes[index] = count
+    return top_indexes, total
 
 
 class LaneBarcodeParser(object):
-    def __init__(self, path):
+    """Parses the laneBarcode.html and lane.html bcl2fastq reports.
+
+    .flowcell_data : a dict of the Flowcell Summary table
+    .sample_data : a list of dicts, one per row of the Lane Summary table
+    .columns : with columnar=True, the Lane Summary table as LaneStatistics,
+        sample_data is then built from it when accessed
+    """
+    def __init__(self, path, columnar=False):
         if os.path.exists(path):
             self.path = path
+            self.columnar = columnar
+            self.columns = None
             self.parse()
         else:
             raise os.error("LaneBarcode.html cannot be found at {0}".format(path))
 
     def parse(self):
-        self.sample_data = []
-        self.flowcell_data = {}
+        extractor = ReportTableExtractor()
+        if self.columnar:
+            self.columns = LaneStatistics(extractor.lane_keys)
+            extractor.add_row = self.columns.append
         with open(self.path, newline='') as htmlfile:
-            bsoup = BeautifulSoup(htmlfile, 'html.parser')
-            flowcell_table = bsoup.find_all('table')[1]
-            lane_table = bsoup.find_all('table')[2]
-
-            flowcell_keys = []
-            flowcell_values = []
-            for th in flowcell_table.find_all('th'):
-                flowcell_keys.append(th.text)
-            for td in flowcell_table.find_all('td'):
-                flowcell_values.append(td.text)
-
-            self.flowcell_data = dict(zip(flowcell_keys, flowcell_values))
-
-            lane_keys = []
-            lane_rows = lane_table.find_all('tr')
-            for row in lane_rows[0:]:
-                if len(row.find_all('th')):
-                    # this is the header row
-                    for th in row.find_all('th'):
-                        key = th.text.replace(
-                            '<br/>', ' ').replace(
-                                '&gt;', '>')
-                        lane_keys.append(key)
-                elif len(row.find_all('td')):
-                    lane_values = []
-                    for td in row.find_all('td'):
-                        lane_values.append(td.text.replace('NaN', '0') if td.text else '0')
-
-                    d = dict(zip(lane_keys, lane_values))
-                    self.sample_data.append(d)
+            for chunk in iter(lambda: htmlfile.read(64 * 1024), ''):
+                extractor.feed(chunk)
+        extractor.close()
+        self.flowcell_data = dict(zip(extractor.flowcell_keys,
+                                      extractor.flowcell_values))
+        if self.columnar:
+            self.columns.finish()
+        else:
+            self._sample_data = extractor.sample_data
+
+    @property
+    def sample_data(self):
+        if self.columnar:
+            return self.columns.to_records()
+        return self._sample_data
+
+
+class LaneStatistics(object):
+    """The Lane Summary table of a bcl2fastq report, one column per header.
+
+    Numeric columns are converted once to array('q') or array('d'), the
+    text of the report being kept only for the cells that cannot be
+    rebuilt from the number, such as NaN written as '0' in a column of
+    percentages. Other columns are lists sharing repeated strings.
+
+    .keys : the headers, in the order of the cells
+    .columns : OrderedDict of header -> array or list. As in sample_data,
+        a repeated header refers to its last column.
+    """
+    def __init__(self, keys):
+        self.keys = keys
+        self.columns = OrderedDict()
+        self.rows = 0
+        self._columns = []
+        self._formats = []
+        self._overrides = []
+
+    def append(self, values):
+        """Adds a row of cell texts, in the order of keys"""
+        for _ in self.keys[len(self._columns):]:
+            # a header row after data rows adds columns
+            self._columns.append([None] * self.rows)
+        for position, column in enumerate(self._columns):
+            column.append(values[position] if position < len(values) else None)
+        self.rows += 1
+
+    def finish(self):
+        """Converts the columns collected by append to their final type"""
+        self.columns = OrderedDict()
+        self._formats = []
+        self._overrides = []
+        for position, texts in enumerate(self._columns):
+            column, spec, overrides = _typed_column(texts)
+            self._columns[position] = column
+            self._formats.append(spec)
+            self._overrides.append(overrides)
+            self.columns[self.keys[position]] = column
+
+    def to_records(self):
+        """The table as LaneBarcodeParser.sample_data: a list of dicts of
+        the report's text"""
+        texts = []
+        for column, spec, overrides in zip(self._columns, self._formats, self._overrides):
+            if spec is None:
+                texts.append(column)
+            else:
+                texts.append([overrides.get(row, format(value, spec))
+                              for row, value in enumerate(column)])
+        return [dict((key, value) for key, value in zip(self.keys, row) if value is not None)
+                for row in zip(*texts)]
+
+    def aggregate(self, by, columns, how='sum'):
+        """Sums, or averages with how='mean', numeric columns by the values
+        of the column by. Returns an OrderedDict, in order of first
+        appearance, of value -> {column: result}"""
+        groups = self.columns[by]
+        counts = OrderedDict()
+        for group in groups:
+            counts[group] = counts.get(group, 0) + 1
+        result = OrderedDict((group, OrderedDict()) for group in counts)
+        for column in columns:
+            if not isinstance(self.columns[column], array):
+                raise ValueError("{0} is not a numeric column".format(column))
+            totals = dict.fromkeys(counts, 0)
+            for group, value in zip(groups, self.columns[column]):
+                totals[group] += value
+            for group, total in totals.items():
+                result[group][column] = total / counts[group] if how == 'mean' else total
+        return result
+
+    def per_lane(self, columns, how='sum'):
+        return self.aggregate('Lane', columns, how)
+
+    def per_project(self, columns, how='sum'):
+        return self.aggregate('Project', columns, how)
+
+
+NUMBER_RE = re.compile(r'-?\d[\d,]*(\.\d+)?$')
+
+
+def _number(text):
+    """int or float of a report cell, None if it is not a number"""
+    if not text:
+        return None
+    m = NUMBER_RE.match(text)
+    if m is None:
+        return None
+    plain = text.replace(',', '')
+    return float(plain) if m.group(1) else int(plain)
+
+
+def _typed_column(texts):
+    """(column, format spec, {row: text}) for a list of cell texts. The
+    spec is None for text columns."""
+    numbers = [_number(text) for text in texts]
+    if not texts or None in numbers:
+        shared = {}
+        return [shared.setdefault(text, text) for text in texts], None, {}
+    if all(isinstance(n, int) for n in numbers):
+        column = array('q', numbers)
+        decimals = None
+    else:
+        column = array('d', numbers)
+        # the most common number of decimals in the column
+        decimal_counts = {}
+        for text in texts:
+            decimals = len(text.split('.')[1]) if '.' in text else 0
+            decimal_counts[decimals] = decimal_counts.get(decimals, 0) + 1
+        decimals = max(decimal_counts, key=decimal_counts.get)
+    best = None
+    for spec in (',', ''):
+        spec = spec + ('.{0}f'.format(decimals) if decimals is not None else 'd')
+        overrides = dict((row, text) for row, (text, number)
+                         in enumerate(zip(texts, column)) if format(number, spec) != text)
+        if best is None or len(overrides) < len(best[1]):
+            best = (spec, overrides)
+    return column, best[0], best[1]
+
+
+class ReportTableExtractor(HTMLParser):
+    """Event based extractor for the tables of the bcl2fastq html reports.
+
+    The second table of the page is the Flowcell Summary and the third one
+    the Lane Summary. Cells are collected as the parser streams through the
+    file, no document tree is built.
+    """
+    FLOWCELL_TABLE = 1
+    LANE_TABLE = 2
+
+    def __init__(self):
+        HTMLParser.__init__(self, convert_charrefs=True)
+        self.flowcell_keys = []
+        self.flowcell_values = []
+        self.lane_keys = []
+        self.sample_data = []
+        self._tables_seen = 0
+        self._open_tables = []
+        self._cells = []
+        self._row_keys = []
+        self._row_values = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'table':
+            self._open_tables.append(self._tables_seen)
+            self._tables_seen += 1
+        elif tag in ('th', 'td') and self._in_table():
+            self._cells.append([])
+        elif tag == 'tr' and self.LANE_TABLE in self._open_tables:
+            self._row_keys = []
+            self._row_values = []
+
+    def handle_endtag(self, tag):
+        if tag == 'table':
+            if self._open_tables:
+                self._open_tables.pop()
+        elif tag in ('th', 'td') and self._cells:
+            text = ''.join(self._cells.pop())
+            if self.FLOWCELL_TABLE in self._open_tables:
+                if tag == 'th':
+                    self.flowcell_keys.append(text)
+                else:
+                    self.flowcell_values.append(text)
+            if self.LANE_TABLE in self._open_tables:
+                if tag == 'th':
+                    self._row_keys.append(
+                        text.replace('<br/>', ' ').replace('&gt;', '>'))
+                else:
+                    self._row_values.append(
+                        text.replace('NaN', '0') if text else '0')
+        elif tag == 'tr' and self.LANE_TABLE in self._open_tables:
+            if self._row_keys:
+                # this is the header row
+                self.lane_keys.extend(self._row_keys)
+            elif self._row_values:
+                self.add_row(self._row_values)
+            self._row_keys = []
+            self._row_values = []
+
+    def handle_data(self, data):
+        # text belongs to every cell it is nested in
+        for cell in self._cells:
+            cell.append(data)
+
+    def add_row(self, values):
+        """Called with the cell texts of each row of the Lane Summary"""
+        self.sample_data.append(dict(zip(self.lane_keys, values)))
+
+    def _in_table(self):
+        return (self.FLOWCELL_TABLE in self._open_tables or
+                self.LANE_TABLE in self._open_tables)
 
 
 class SampleSheetParser(object):
@@ -231,9 +774,19 @@ class SampleSheetParser(object):
 
     .header : a dict containing the info located under the [Header] section
     .settings : a dict containing the data from the [Settings] section
+        ([BCLConvert_Settings] in v2 samplesheets)
     .reads : a list of the values in the [Reads] section
     .data : a list of the values under the [Data] section
-    .datafields : a list of field names for the data section"""
+        ([BCLConvert_Data] in v2 samplesheets)
+    .datafields : a list of field names for the data section
+    .cloud_data, .cloud_datafields : same for the v2 [Cloud_Data] section
+    .sections : the lines of any other section, split, by section name
+    .rows_by_lane, .rows_by_project, .rows_by_sample, .rows_by_index : the
+        rows of data by value of their lane, project, sample id and index
+        fields, see rows() for queries"""
+    SETTINGS_SECTIONS = ('Settings', 'BCLConvert_Settings')
+    DATA_SECTIONS = ('Data', 'BCLConvert_Data')
+
     def __init__(self, path):
         self.log = logging.getLogger(__name__)
         if os.path.exists(path):
@@ -245,62 +798,151 @@ class SampleSheetParser(object):
         header = {}
         reads = []
         settings = {}
-        csvlines = []
+        sections = OrderedDict()
         data = []
-        flag = 'data'  # in case of HiSeq samplesheet only data section is present
-        separator = ","
+        cloud_data = []
+        self.datafields = None
+        self.cloud_datafields = None
         with open(path, newline='') as csvfile:
-            # Ignore empty lines (for instance the Illumina Experiment Manager
-            # generates sample sheets with empty lines
-            lines = [nonempty_line for nonempty_line
-                     in (line.rstrip() for line in csvfile) if nonempty_line]
-            # Now parse the file
-            for line in lines:
-                if '[Header]' in line:
-                    flag = 'HEADER'
-                elif '[Reads]' in line:
-                    flag = 'READS'
-                elif '[Settings]' in line:
-                    flag = 'SETTINGS'
-                elif '[Data]' in line:
-                    flag = 'data'
-                else:
-                    tokens = line.split(separator)
-                    if flag == 'HEADER':
-                        if len(tokens) < 2:
-                            self.log.error("file {} does not have a",
-                                           "correct format.".format(path))
-                            raise RuntimeError("Could not parse the",
-                                               "samplesheet, the file does",
-                                               "not seem to have a correct format.")
+            for section, line in samplesheet_lines(csvfile):
+                if section in self.DATA_SECTIONS:
+                    if self.datafields is None:
+                        self.datafields = split_csv_line(line)
+                        indexes = self._set_datafields()
+                        continue
+                    values = line.split(',') if '"' not in line else split_csv_line(line)
+                    if len(values) >= len(self.datafields):
+                        row = dict(zip(self.datafields, values))
+                    else:
+                        row = csv_row(self.datafields, values)
+                    data.append(row)
+                    for field, rows in indexes:
+                        rows.setdefault(row[field], []).append(row)
+                    continue
+                if section == 'Cloud_Data':
+                    if self.cloud_datafields is None:
+                        self.cloud_datafields = split_csv_line(line)
+                    else:
+                        cloud_data.append(csv_row(self.cloud_datafields,
+                                                  split_csv_line(line)))
+                    continue
+                tokens = line.split(',')
+                if section == 'Header' or section in self.SETTINGS_SECTIONS:
+                    if len(tokens) < 2:
+                        self.log.error("file {0} does not have a "
+                                       "correct format.".format(path))
+                        raise RuntimeError("Could not parse the samplesheet, the file "
+                                           "does not seem to have a correct format.")
+                    if section == 'Header':
                         header[tokens[0]] = tokens[1]
-                    elif flag == 'READS':
-                        reads.append(tokens[0])
-                    elif flag == 'SETTINGS':
-                        if len(tokens) < 2:
-                            self.log.error("file {} does not have a",
-                                           "correct format.".format(path))
-                            raise RuntimeError("Could not parse the",
-                                               "samplesheet, the file does",
-                                               "not seem to have a correct format.")
+                    else:
                         settings[tokens[0]] = tokens[1]
-                    elif flag == 'data':
-                        csvlines.append(line)
-            reader = csv.DictReader(csvlines)
-            for row in reader:
-                linedict = {}
-                for field in reader.fieldnames:
-                    linedict[field] = row[field]
-                data.append(linedict)
-
-            self.datafields = reader.fieldnames
-            self.dfield_sid = self._get_pattern_datafield(r'sample_?id')
-            self.dfield_snm = self._get_pattern_datafield(r'sample_?name')
-            self.dfield_proj = self._get_pattern_datafield(r'.*?project')
-            self.data = data
-            self.settings = settings
-            self.header = header
-            self.reads = reads
+                elif section == 'Reads':
+                    reads.append(tokens[0])
+                else:
+                    sections.setdefault(section, []).append(tokens)
+        if self.datafields is None:
+            self.datafields = []
+            self._set_datafields()
+        self.data = data
+        self.cloud_data = cloud_data
+        self.cloud_datafields = self.cloud_datafields or []
+        self.sections = sections
+        self.settings = settings
+        self.header = header
+        self.reads = reads
+
+    def _set_datafields(self):
+        self.dfield_sid = self._get_pattern_datafield(r'sample_?id')
+        self.dfield_snm = self._get_pattern_datafield(r'sample_?name')
+        self.dfield_proj = self._get_pattern_datafield(r'.*?project')
+        self.dfield_lane = self._get_pattern_datafield(r'^lane$')
+        self.dfield_index = self._get_pattern_datafield(r'^index$')
+        self.dfield_index2 = self._get_pattern_datafield(r'^index2$')
+        self.rows_by_lane = {}
+        self.rows_by_project = {}
+        self.rows_by_sample = {}
+        self.rows_by_index = {}
+        # (field, index) pairs to fill for each row
+        return [(field, rows) for field, rows in ((self.dfield_lane, self.rows_by_lane),
+                                                  (self.dfield_proj, self.rows_by_project),
+                                                  (self.dfield_sid, self.rows_by_sample),
+                                                  (self.dfield_index, self.rows_by_index))
+                if field]
+
+    def rows(self, lane=None, project=None, sample_id=None, index=None):
+        """Rows of data matching all the given values, in samplesheet order.
+        The rows are looked up in the most selective index, then filtered."""
+        criteria = [(field, rows, value) for field, rows, value in (
+            (self.dfield_sid, self.rows_by_sample, sample_id),
+            (self.dfield_index, self.rows_by_index, index),
+            (self.dfield_proj, self.rows_by_project, project),
+            (self.dfield_lane, self.rows_by_lane, None if lane is None else str(lane)))
+            if value is not None]
+        if not criteria:
+            return list(self.data)
+        if not all(field for field, _, _ in criteria):
+            return []
+        candidates = min((rows.get(value, []) for _, rows, value in criteria), key=len)
+        return [row for row in candidates
+                if all(row[field] == value for field, _, value in criteria)]
+
+    def lanes(self):
+        return list(self.rows_by_lane)
+
+    def projects(self, lane=None):
+        """Projects of the samplesheet, or of one lane, in samplesheet order"""
+        rows = self.data if lane is None else self.rows_by_lane.get(str(lane), [])
+        return list(OrderedDict.fromkeys(row[self.dfield_proj] for row in rows
+                                         if self.dfield_proj))
+
+    def barcodes(self, row):
+        """Index sequences of a row, one per index read. Old samplesheets
+        with a single index field write dual indexes as i7-i5."""
+        index = (row.get(self.dfield_index) or '') if self.dfield_index else ''
+        if self.dfield_index2:
+            return (index, row.get(self.dfield_index2) or '')
+        return tuple(index.split('-'))
+
+    def barcode_collisions(self, mismatches=1):
+        """Pairs of samples of a lane that cannot be told apart when
+        demultiplexing with that many mismatches per index read: the
+        distance between their barcodes is at most 2 * mismatches for
+        every index read. Returns (lane, sample id, sample id, distances)
+        tuples, distances having one hamming distance per index read.
+
+        Barcodes are split in 2 * mismatches + 1 segments per index read.
+        Two colliding barcodes share at least one segment of each read, so
+        only the barcodes sharing a combination of segments are compared.
+        Barcodes of different lengths are never compared."""
+        max_distance = 2 * mismatches
+        groups = OrderedDict()
+        for row in self.data:
+            barcode = self.barcodes(row)
+            if not any(barcode):
+                continue
+            lane = row.get(self.dfield_lane) if self.dfield_lane else None
+            key = (lane, tuple(len(sequence) for sequence in barcode))
+            groups.setdefault(key, []).append((row, barcode))
+        collisions = []
+        for (lane, _), rows in groups.items():
+            buckets = {}
+            for position, (row, barcode) in enumerate(rows):
+                segments = [_segments(sequence, max_distance + 1) for sequence in barcode]
+                for key in itertools.product(*segments):
+                    buckets.setdefault(key, []).append(position)
+            pairs = set()
+            for positions in buckets.values():
+                for i, first in enumerate(positions):
+                    for second in positions[i + 1:]:
+                        pairs.add((first, second))
+            for first, second in sorted(pairs):
+                distances = tuple(_hamming(a, b) for a, b
+                                  in zip(rows[first][1], rows[second][1]))
+                if max(distances) <= max_distance:
+                    collisions.append((lane, rows[first][0].get(self.dfield_sid),
+                                       rows[second][0].get(self.dfield_sid), distances))
+        return collisions
 
     def _get_pattern_datafield(self, pattern):
         for fld in self.datafields:
@@ -309,6 +951,108 @@ class SampleSheetParser(object):
         return ''
 
 
+def _segments(sequence, count):
+    """(position, segment) of a sequence cut in count parts. Short
+    sequences give empty segments, which match any other."""
+    size, extra = divmod(len(sequence), count)
+    segments = []
+    start = 0
+    for position in range(count):
+        end = start + size + (1 if position < extra else 0)
+        segments.append((position, sequence[start:end]))
+        start = end
+    return segments
+
+
+def _hamming(first, second):
+    return sum(1 for a, b in zip(first, second) if a != b)
+
+
+def samplesheet_lines(lines):
+    """Yields (section, line) for the lines of a samplesheet, without their
+    trailing whitespace and of the byte order mark Excel writes. Empty lines
+    and the [Section] lines themselves are skipped. Lines before any section
+    are in 'Data', as HiSeq samplesheets only have the data."""
+    section = 'Data'
+    for line in lines:
+        line = line.rstrip().lstrip('\ufeff')
+        if not line:
+            # for instance the Illumina Experiment Manager generates sample
+            # sheets with empty lines
+            continue
+        stripped = line.lstrip()
+        if stripped[0] == '[' and ']' in stripped:
+            section = stripped[1:stripped.index(']')]
+            continue
+        yield section, line
+
+
+def split_csv_line(line):
+    """Fields of a csv line, only going through the csv module for quotes"""
+    if '"' not in line:
+        return line.split(',')
+    return next(csv.reader([line]))
+
+
+def csv_row(fields, values):
+    """dict of a row like csv.DictReader makes, missing values being None
+    and extra ones dropped"""
+    row = dict(zip(fields, values))
+    if len(values) < len(fields):
+        for field in fields[len(values):]:
+            row.setdefault(field, None)
+    return row
+
+
+class DemultiplexingStatsParser(object):
+    """Parses DemultiplexingStats.xml with iterparse, dropping each element
+    once it is read so memory stays flat whatever the number of samples.
+
+    .data : {'flowcell': flowcell id,
+             'columns': {'project': [...], 'sample': [...], 'barcode': [...],
+                         'lane': [...], 'BarcodeCount': [...],
+                         'PerfectBarcodeCount': [...],
+                         'OneMismatchBarcodeCount': [...]}}
+    one row per project/sample/barcode/lane, 'all' rows included.
+    """
+    COUNTS = ('BarcodeCount', 'PerfectBarcodeCount', 'OneMismatchBarcodeCount')
+
+    def __init__(self, path):
+        if os.path.exists(path):
+            self.path = path
+            self.data = {}
+            self.parse()
+        else:
+            raise os.error("DemultiplexingStats.xml cannot be found at {0}".format(path))
+
+    def parse(self):
+        columns = OrderedDict((name, []) for name in
+                              ('project', 'sample', 'barcode', 'lane') + self.COUNTS)
+        flowcell = None
+        names = {}
+        elements = []
+        for event, elem in ET.iterparse(self.path, events=('start', 'end')):
+            if event == 'start':
+                elements.append(elem)
+                if elem.tag == 'Flowcell':
+                    flowcell = elem.get('flowcell-id')
+                elif elem.tag in ('Project', 'Sample', 'Barcode'):
+                    names[elem.tag] = elem.get('name')
+                continue
+            elements.pop()
+            if elem.tag == 'Lane':
+                columns['project'].append(names.get('Project'))
+                columns['sample'].append(names.get('Sample'))
+                columns['barcode'].append(names.get('Barcode'))
+                columns['lane'].append(int(elem.get('number')))
+                for count in self.COUNTS:
+                    columns[count].append(int(elem.findtext(count, 0)))
+            if elem.tag in ('Lane', 'Barcode', 'Sample', 'Project') and elements:
+                # the element is fully read, drop it from its parent
+                elements[-1].remove(elem)
+        self.data = {'flowcell': flowcell, 'columns': columns}
+
+
 class RunInfoParser(object):
     """Parses  RunInfo.xml.
     Should be instancied with the file path as an argument.
@@ -331,7 +1075,51 @@ class RunInfoParser(object):
         else:
             raise os.error("Run info cannot be found at {0}".format(path))
 
+    FIELDS = ('Id', 'Number', 'Instrument', 'Flowcell', 'Date', 'Reads', 'FlowcellLayout')
+
     def parse(self):
+        data = self._parse_head()
+        if data is None:
+            # unusual layout, read the whole tree
+            data = self._parse_tree()
+        self.data = data
+        self.recipe = make_run_recipe(self.data.get('Reads', {}))
+
+    def _parse_head(self):
+        """Reads the fields with iterparse and stops as soon as all have been
+        seen, usually at the FlowcellLayout start tag, before the tiles.
+        Returns None if some field is missing."""
+        data = {}
+        reads = None
+        depth = 0
+        with open(self.path, 'rb') as f:
+            for event, elem in ET.iterparse(f, events=('start', 'end')):
+                if event == 'start':
+                    depth += 1
+                    if depth == 2 and elem.tag == 'Run':
+                        data['Id'] = elem.get('Id')
+                        data['Number'] = elem.get('Number')
+                    elif depth == 3 and elem.tag == 'FlowcellLayout':
+                        data.setdefault('FlowcellLayout', elem.attrib)
+                    elif depth == 3 and elem.tag == 'Reads' and 'Reads' not in data:
+                        reads = []
+                    elif depth == 4 and elem.tag == 'Read' and reads is not None:
+                        reads.append(elem.attrib)
+                else:
+                    depth -= 1
+                    if depth == 2 and elem.tag in ('Instrument', 'Flowcell', 'Date'):
+                        data.setdefault(elem.tag, elem.text)
+                    elif depth == 2 and elem.tag == 'Reads' and reads is not None:
+                        data['Reads'] = reads
+                        reads = None
+                if len(data) == len(self.FIELDS):
+                    break
+        if len(data) < len(self.FIELDS):
+            return None
+        data['Date'] = run_date_to_yymmdd(data['Date'])
+        return data
+
+    def _parse_tree(self):
         data = {}
         tree = ET.parse(self.path)
         root = tree.getroot()
@@ -341,23 +1129,13 @@ class RunInfoParser(object):
         data['Instrument'] = run.find('Instrument').text
         data['Flowcell'] = run.find('Flowcell').text
 
-        # Change Novaseq date format from
-        # 10/17/2017 10:59:16 AM to 171017 (yymmdd)
-        if len(run.find('Date').text) > 6:
-            try:
-                data['Date'] = datetime.strptime(run.find('Date').text.split(" ")[0],
-                                             "%m/%d/%Y").strftime("%y%m%d")
-            except ValueError:
-                data['Date'] = datetime.strptime(run.find('Date').text, "%Y-%m-%dT%H:%M:%SZ").strftime("%y%m%d")
-        else:
-            data['Date'] = run.find('Date').text
+        data['Date'] = run_date_to_yymmdd(run.find('Date').text)
         data['Reads'] = []
         for read in run.find('Reads').findall('Read'):
             data['Reads'].append(read.attrib)
         layout = run.find('FlowcellLayout')
         data['FlowcellLayout'] = layout.attrib
-        self.data = data
-        self.recipe = make_run_recipe(self.data.get('Reads', {}))
+        return data
 
     def get_read_configuration(self):
         """return a list of dicts containig the Read Configuration
@@ -421,47 +1199,115 @@ def make_run_recipe(reads):
 
 
 def xml_to_dict(root):
-    current = None
-
-    children = list(root)
-    if children:
-        current = {}
-        duplicates = {}
-        for child in children:
-            if len(root.findall(child.tag)) > 1:
-                if child.tag not in duplicates:
-                    duplicates[child.tag] = []
-                lower = xml_to_dict(child)
-                duplicates[child.tag].extend(list(lower.values()))
-                current.update(duplicates)
-            else:
-                lower = xml_to_dict(child)
-                current.update(lower)
-    if root.attrib:
+    """Converts an element tree to nested dicts: {tag: value}.
+
+    A leaf is its text (or None), attributes are merged in the element's dict,
+    and tags repeated among siblings become lists. Walks the tree with an
+    explicit stack, counting the sibling tags once per element.
+    """
+    stack = [_xml_frame(root)]
+    while True:
+        elem, children, counts, current = stack[-1]
+        child = next(children, None)
+        if child is not None:
+            stack.append(_xml_frame(child))
+            continue
+        stack.pop()
+        value = _xml_value(elem, current)
+        if not stack:
+            return {elem.tag: value}
+        _, _, parent_counts, parent = stack[-1]
+        if parent_counts[elem.tag] > 1:
+            parent.setdefault(elem.tag, []).append(value)
+        else:
+            parent[elem.tag] = value
+
+
+def _xml_frame(elem):
+    """(element, children iterator, tag counts, dict) for xml_to_dict"""
+    children = list(elem)
+    counts = {}
+    for child in children:
+        counts[child.tag] = counts.get(child.tag, 0) + 1
+    return elem, iter(children), counts, {} if children else None
+
+
+def _xml_value(elem, current):
+    if elem.attrib:
         if current:
-            if [x in current for x in root.attrib]:
-                current.update(root.attrib)
-            else:
-                current.update({'attribs': root.attribs})
+            current.update(elem.attrib)
         else:
-            current = root.attrib
-    if root.text and root.text.strip() != "":
+            current = dict(elem.attrib)
+    if elem.text and elem.text.strip() != "":
         if current:
             if 'text' not in current:
-                current['text'] = root.text
+                current['text'] = elem.text
             else:
                 # you're really pushing here, pal
-                current['xml_text'] = root.text
+                current['xml_text'] = elem.text
         else:
-            current = root.text
-    return {root.tag: current}
+            current = elem.text
+    return current
+
+
+CYCLE_TIMES_FORMAT = '%m/%d/%Y-%H:%M:%S.%f'
+
+
+@lru_cache(maxsize=64)
+def _cycle_date(date):
+    """A CycleTimes.txt date, 5/20/2019, as (year, month, day).
+    All records of a day share it, so it is only parsed once."""
+    parsed = datetime.strptime(date, '%m/%d/%Y')
+    return parsed.year, parsed.month, parsed.day
+
+
+def parse_cycle_timestamp(date, time):
+    """Same as datetime.strptime(date + '-' + time, CYCLE_TIMES_FORMAT),
+    but decodes the usual HH:MM:SS.fff layout by slicing"""
+    if 9 < len(time) < 16 and time[2] == ':' and time[5] == ':' and time[8] == '.':
+        try:
+            year, month, day = _cycle_date(date)
+            fraction = time[9:]
+            return datetime(year, month, day, int(time[0:2]), int(time[3:5]),
+                            int(time[6:8]), int(fraction) * 10 ** (6 - len(fraction)))
+        except ValueError:
+            pass
+    return datetime.strptime("{0}-{1}".format(date, time), CYCLE_TIMES_FORMAT)
+
+
+def run_date_to_yymmdd(date):
+    """Converts the Date of a RunInfo.xml to yymmdd. Handles
+    150424 (yymmdd, kept as is),
+    10/17/2017 10:59:16 AM (NovaSeq) and
+    2021-03-02T10:59:16Z (NextSeq 2000, NovaSeqXPlus)"""
+    if len(date) <= 6:
+        return date
+    if '/' in date:
+        month, day, year = date.split(" ")[0].split('/')
+    elif date[4:5] == '-' and date[7:8] == '-' and date[10:11] == 'T' and date.endswith('Z'):
+        year, month, day = date[0:4], date[5:7], date[8:10]
+    else:
+        raise ValueError("Unknown RunInfo date format {0}".format(date))
+    # datetime validates the fields
+    parsed = datetime(int(year), int(month), int(day))
+    return "{0:02d}{1:02d}{2:02d}".format(parsed.year % 100, parsed.month, parsed.day)
 
 
 class CycleTimesParser(object):
+    """Parses Logs/CycleTimes.txt.
+
+    .cycles : a list of dicts with the cycle_number, start and end of each
+              cycle
+
+    The parser remembers how far it has read, update() only parses the
+    lines appended since the last call and updates .cycles in place, which
+    makes it cheap to poll during a run.
+    """
     def __init__(self, path):
         if os.path.exists(path):
             self.path = path
             self.cycles = []
+            self.offset = 0
             self.parse()
         else:
             raise os.error("file {0} cannot be found".format(path))
@@ -475,68 +1321,111 @@ class CycleTimesParser(object):
         parser goes over records and saves the first record of each cycle as
         start time and the last record of each cycle as end time
         """
-        data = []
-        date_format = '%m/%d/%Y-%H:%M:%S.%f'
-        with open(self.path, 'r') as file:
-            cycle_times = file.readlines()
-            # if file is empty, return
-            if not cycle_times:
-                return
+        self.cycles = []
+        self.offset = 0
+        self.update()
 
+    def update(self):
+        """Parses the records appended since the last call.
+        Returns the number of new records"""
+        with open(self.path, 'rb') as file:
+            file.seek(0, os.SEEK_END)
+            if file.tell() < self.offset:
+                # the file was truncated or replaced, start over
+                self.cycles = []
+                self.offset = 0
+            file.seek(self.offset)
+            appended = file.read()
+        # only complete lines move the offset forward
+        complete = appended.rfind(b'\n') + 1
+        lines = appended[:complete].decode('utf-8').splitlines()
+        if self.offset == 0 and complete:
             # first line is header, don't read it
-            for cycle_line in cycle_times[1:]:
-                # split line into strings
-                cycle_list = cycle_line.split()
-                cycle_time_obj = {}
-                # parse datetime
-                cycle_time_obj['datetime'] = datetime.strptime(
-                    "{date}-{time}".format(
-                        date=cycle_list[0],
-                        time=cycle_list[1]),
-                    date_format)
-                # parse cycle number
-                cycle_time_obj['cycle'] = int(cycle_list[3])
-                # add object in the list
-                data.append(cycle_time_obj)
-
-        # take the first record as current cycle
-        current_cycle = {
-            'cycle_number': data[0]['cycle'],
-            'start': data[0]['datetime'],
-            'end': data[0]['datetime']
-        }
-        # compare each record with current cycle (except the first one)
-        for record in data[1:]:
-            # if we are at the same cycle
-            if record['cycle'] == current_cycle['cycle_number']:
-                # override end of cycle with current record
-                current_cycle['end'] = record['datetime']
-            # if a new cycle starts
-            else:
-                # save previous cycle
-                self.cycles.append(current_cycle)
-                # initialize new current_cycle
-                current_cycle = {
-                    'cycle_number': record['cycle'],
-                    'start': record['datetime'],
-                    'end': record['datetime']
-                }
-        # the last records is not saved inside the loop
-        if current_cycle not in self.cycles:
-            self.cycles.append(current_cycle)
+            lines = lines[1:]
+        self.offset += complete
+        records = 0
+        for cycle_line in lines:
+            records += self._add_record(cycle_line.split())
+        # A trailing line without newline may still be being written.
+        # It is used if its cycle field is complete, and read again on the
+        # next call, which does not change the cycles it already updated
+        if self.offset:
+            tokens = appended[complete:].decode('utf-8', 'ignore').split()
+            if len(tokens) >= 5:
+                records += self._add_record(tokens)
+        return records
+
+    def _add_record(self, cycle_list):
+        if len(cycle_list) < 4:
+            return 0
+        # parse datetime
+        timestamp = parse_cycle_timestamp(cycle_list[0], cycle_list[1])
+        # parse cycle number
+        cycle_number = int(cycle_list[3])
+        current_cycle = self.cycles[-1] if self.cycles else None
+        # if we are at the same cycle
+        if current_cycle and current_cycle['cycle_number'] == cycle_number:
+            # override end of cycle with current record
+            current_cycle['end'] = timestamp
+        else:
+            # a new cycle starts
+            self.cycles.append({
+                'cycle_number': cycle_number,
+                'start': timestamp,
+                'end': timestamp
+            })
+        return 1
 
 
 class StatsParser(object):
+    """Parses Demultiplexing/Stats/Stats.json.
 
-    def __init__(self, path):
+    By default the whole file is loaded in .data. With fields, a list of
+    dotted paths such as DEFAULT_STATS_FIELDS, the file is streamed and
+    .data only holds the selected parts, and with top_unknown only the
+    most frequent unknown barcodes of each lane are kept. Memory then
+    stays bounded whatever the size of the file, but streaming is about
+    10 times slower than json.load (some 6 MB/s, where json.loads reads
+    a 19 MB file in 0.3 s): use it to save memory, not time.
+    """
+
+    def __init__(self, path, fields=None, top_unknown=None):
         if os.path.exists(path):
             self.path = path
             self.cycles = []
             self.data = None
+            self.fields = fields
+            self.top_unknown = top_unknown
             self.parse()
         else:
             raise os.error("file {0} cannot be found".format(path))
 
     def parse(self):
         with open(self.path) as data:
-            self.data = json.load(data)
+            if self.fields is None and self.top_unknown is None:
+                self.data = json.load(data)
+            else:
+                top_counts = {}
+                if self.top_unknown is not None:
+                    top_counts['UnknownBarcodes.item.Barcodes'] = self.top_unknown
+                self.data = jsonstream.extract(data, self.fields or [], top_counts)
+
+
+# Per-lane totals, per-sample yields and the unknown barcodes lanes,
+# for StatsParser(path, DEFAULT_STATS_FIELDS, top_unknown=50)
+DEFAULT_STATS_FIELDS = [
+    'Flowcell',
+    'RunNumber',
+    'RunId',
+    'ConversionResults.item.LaneNumber',
+    'ConversionResults.item.TotalClustersRaw',
+    'ConversionResults.item.TotalClustersPF',
+    'ConversionResults.item.Yield',
+    'ConversionResults.item.DemuxResults.item.SampleId',
+    'ConversionResults.item.DemuxResults.item.SampleName',
+    'ConversionResults.item.DemuxResults.item.NumberReads',
+    'ConversionResults.item.DemuxResults.item.Yield',
+    'ConversionResults.item.Undetermined.NumberReads',
+    'ConversionResults.item.Undetermined.Yield',
+    'UnknownBarcodes.item.Lane',
+]
@@ -1,23 +1,264 @@
 import couchdb
+import hashlib
+import json
 import logging
+import threading
+import time
+import weakref
+
+from collections import OrderedDict, deque
 
 log = logging.getLogger(__name__)
 
 
-def setupServer(conf):
+class PooledConnectionPool(couchdb.http.ConnectionPool):
+    """couchdb's connection pool, keeping at most size idle keep-alive
+    connections per host and counting the connections it opens"""
+    def __init__(self, timeout, size, disable_ssl_verification=False):
+        super(PooledConnectionPool, self).__init__(
+            timeout, disable_ssl_verification=disable_ssl_verification)
+        self.size = size
+        self.opened = 0
+        self._known = weakref.WeakSet()
+
+    def get(self, url):
+        conn = super(PooledConnectionPool, self).get(url)
+        with self.lock:
+            if conn not in self._known:
+                self._known.add(conn)
+                self.opened += 1
+        return conn
+
+    def release(self, url, conn):
+        scheme, host = couchdb.util.urlsplit(url, 'http', False)[:2]
+        with self.lock:
+            idle = self.conns.setdefault((scheme, host), [])
+            if len(idle) < self.size:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def idle(self):
+        with self.lock:
+            return sum(len(conns) for conns in self.conns.values())
+
+
+class PooledSession(couchdb.http.Session):
+    """couchdb.http.Session sharing up to pool_size keep-alive connections
+    per host between threads, and keeping request statistics.
+
+    timeout is the socket timeout in seconds, None for no timeout.
+    """
+    def __init__(self, pool_size=10, timeout=None, **kwargs):
+        super(PooledSession, self).__init__(timeout=timeout, **kwargs)
+        self.pool_size = pool_size
+        self.connection_pool = PooledConnectionPool(timeout, pool_size)
+        self._stats_lock = threading.Lock()
+        self.reset_stats()
+
+    def disable_ssl_verification(self):
+        self._disable_ssl_verification = True
+        self.connection_pool = PooledConnectionPool(self._timeout, self.pool_size,
+                                                    disable_ssl_verification=True)
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self._requests = 0
+            self._errors = 0
+            self._seconds = 0.0
+            self._max_seconds = 0.0
+            # latencies of the latest requests, for the percentiles
+            self._latencies = deque(maxlen=1024)
+
+    def request(self, *args, **kwargs):
+        start = time.perf_counter()
+        failed = True
+        try:
+            response = super(PooledSession, self).request(*args, **kwargs)
+            failed = False
+            return response
+        finally:
+            seconds = time.perf_counter() - start
+            with self._stats_lock:
+                self._requests += 1
+                self._errors += failed
+                self._seconds += seconds
+                self._max_seconds = max(self._max_seconds, seconds)
+                self._latencies.append(seconds)
+
+    def stats(self):
+        """Number of requests, of requests that raised (including the 404
+        and 409 replies), of connections opened and idle, and the latency
+        in seconds until the response headers: mean and max over all
+        requests, median and 95th percentile of the latest ones"""
+        with self._stats_lock:
+            latencies = sorted(self._latencies)
+            stats = {'requests': self._requests,
+                     'errors': self._errors,
+                     'mean_seconds': self._seconds / self._requests if self._requests else 0.0,
+                     'max_seconds': self._max_seconds}
+        stats['connections_opened'] = self.connection_pool.opened
+        stats['connections_idle'] = self.connection_pool.idle()
+        for name, fraction in (('p50_seconds', 0.5), ('p95_seconds', 0.95)):
+            stats[name] = (latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+                           if latencies else 0.0)
+        return stats
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def shared_session(pool_size=10, timeout=None):
+    """The PooledSession shared by all callers asking for the same pool
+    size and timeout"""
+    with _sessions_lock:
+        key = (pool_size, timeout)
+        if key not in _sessions:
+            _sessions[key] = PooledSession(pool_size=pool_size, timeout=timeout)
+        return _sessions[key]
+
+
+def session_stats():
+    """stats() of the shared sessions, keyed by (pool_size, timeout)"""
+    with _sessions_lock:
+        sessions = dict(_sessions)
+    return dict((key, session.stats()) for key, session in sessions.items())
+
+
+def setupServer(conf, session=None):
+    """couchdb.Server for the statusdb section of conf. Servers share their
+    connections through shared_session, sized by the optional pool_size and
+    timeout settings of the section, unless a session is given."""
     db_conf = conf['statusdb']
     url = "https://{0}:{1}@{2}".format(
         db_conf['username'],
         db_conf['password'],
         db_conf['url'])
-    return couchdb.Server(url)
+    if session is None:
+        session = shared_session(db_conf.get('pool_size', 10), db_conf.get('timeout'))
+    return couchdb.Server(url, session=session)
+
+
+# Name of the field holding the hash of the parsed document, and the
+# lightweight view returning it by flowcell name. The view has a design
+# document of its own: adding it to the shared info one would have CouchDB
+# rebuild info/name and every other view of that design document.
+HASH_FIELD = 'content_hash'
+NAME_HASH_VIEW = 'flowcell_parser/name_hash'
+NAME_HASH_MAP = """function(doc) {
+    if (doc.name) {
+        emit(doc.name, {'_rev': doc._rev, 'content_hash': doc.content_hash || null});
+    }
+}"""
+
+
+def doc_hash(obj):
+    """Stable hash of a parsed document: sha256 of its canonical json,
+    leaving out _id, _rev and the hash field itself"""
+    content = dict((k, v) for k, v in obj.items()
+                   if k not in ('_id', '_rev', HASH_FIELD))
+    canonical = json.dumps(content, sort_keys=True, separators=(',', ':'),
+                           ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+# Update handler applying a doc_diff to the stored document, refusing it
+# if the document changed since the revision the diff was made against
+PATCH_HANDLER = 'info/patch'
+PATCH_FUNCTION = """function(doc, req) {
+    if (!doc) {
+        return [null, {code: 404, json: {error: 'not_found', reason: 'missing'}}];
+    }
+    var body = JSON.parse(req.body);
+    if (body.rev !== doc._rev) {
+        return [null, {code: 409, json: {error: 'conflict',
+                                         reason: 'Document update conflict.'}}];
+    }
+    body.ops.forEach(function(op) {
+        var parent = doc;
+        for (var i = 0; i < op.path.length - 1; i++) {
+            var child = parent[op.path[i]];
+            // a number as next step is a list index
+            var isList = typeof op.path[i + 1] === 'number';
+            if (typeof child !== 'object' || child === null || Array.isArray(child) !== isList) {
+                child = parent[op.path[i]] = isList ? [] : {};
+            }
+            parent = child;
+        }
+        var key = op.path[op.path.length - 1];
+        if (op.op === 'set') {
+            parent[key] = op.value;
+        } else if (op.op === 'append') {
+            parent[key] = (parent[key] || []).concat(op.values);
+        } else if (op.op === 'delete') {
+            delete parent[key];
+        }
+    });
+    return [doc, {json: {ok: true}}];
+}"""
+
 
+def install_hash_view(db):
+    """Adds the name_hash view to its design document if missing"""
+    design_id = '_design/{0}'.format(NAME_HASH_VIEW.split('/')[0])
+    view_name = NAME_HASH_VIEW.split('/')[1]
+    design = db.get(design_id) or {'_id': design_id, 'language': 'javascript'}
+    views = design.setdefault('views', {})
+    if views.get(view_name, {}).get('map') != NAME_HASH_MAP:
+        views[view_name] = {'map': NAME_HASH_MAP}
+        db.save(design)
 
-def update_doc(db, obj, over_write_db_entry=False):
+
+def install_patch_handler(db):
+    """Adds the patch update handler to the info design document if missing"""
+    design_id = '_design/{0}'.format(PATCH_HANDLER.split('/')[0])
+    handler_name = PATCH_HANDLER.split('/')[1]
+    design = db.get(design_id) or {'_id': design_id, 'language': 'javascript'}
+    updates = design.setdefault('updates', {})
+    if updates.get(handler_name) != PATCH_FUNCTION:
+        updates[handler_name] = PATCH_FUNCTION
+        db.save(design)
+
+
+def _hash_rows(db, **options):
+    """Rows of the name_hash view, [] if the view is not installed"""
+    try:
+        return list(db.view(NAME_HASH_VIEW, **options))
+    except couchdb.http.ResourceNotFound:
+        log.warning("{0} is missing in {1}, see install_hash_view, "
+                    "comparing whole documents instead".format(NAME_HASH_VIEW, db.name))
+        return []
+
+
+def update_doc(db, obj, over_write_db_entry=False, skip_unchanged=False):
+    """Uploads a parsed document, merging it into the existing document with
+    the same name unless over_write_db_entry is set.
+
+    The hash of the parsed document is stored in it. With skip_unchanged the
+    stored hash is first read from the name_hash view, and documents whose
+    parsed content did not change are skipped without pulling them. Without
+    that view (see install_hash_view) documents are compared as a whole.
+    """
+    obj[HASH_FIELD] = doc_hash(obj)
+    if skip_unchanged:
+        hash_rows = _hash_rows(db, key=obj['name'])
+        if len(hash_rows) == 1:
+            if hash_rows[0].value[HASH_FIELD] == obj[HASH_FIELD]:
+                log.debug("{0} is unchanged".format(obj['name']))
+                return
+            if over_write_db_entry:
+                # nothing to merge, the view has all we need
+                obj['_id'] = hash_rows[0].id
+                obj['_rev'] = hash_rows[0].value['_rev']
+                db[obj['_id']] = obj
+                log.info("updating {0}".format(obj['name']))
+                return
     view = db.view('info/name')
+    rows = view[obj['name']].rows
     # If there is already a flowcell with that name in the DB
-    if len(view[obj['name']].rows) == 1:
-        remote_doc = view[obj['name']].rows[0].value
+    if len(rows) == 1:
+        remote_doc = rows[0].value
         # remove id and rev for comparison
         doc_id = remote_doc.pop('_id')
         doc_rev = remote_doc.pop('_rev')
@@ -25,12 +266,15 @@ def update_doc(db, obj, over_write_db_entry=False):
             # if they are different, merge the old into the new
             if not over_write_db_entry:
                 # do not merge if over_write option is specified
-                obj = merge(obj, remote_doc)
+                changes = []
+                obj = merge(obj, remote_doc, changes)
+                log.debug("{0} changed at {1}".format(
+                    obj['name'], ', '.join('.'.join(map(str, path)) for path, _ in changes)))
             obj['_id'] = doc_id
             obj['_rev'] = doc_rev
             db[doc_id] = obj
             log.info("updating {0}".format(obj['name']))
-    elif len(view[obj['name']].rows) == 0:
+    elif len(rows) == 0:
         # it is a new doc, upload it
         db.save(obj)
         log.info("saving {0}".format(obj['name']))
@@ -38,23 +282,281 @@ def update_doc(db, obj, over_write_db_entry=False):
         log.warn("more than one row with name {0} found".format(obj['name']))
 
 
+def bulk_update_docs(db, objs, over_write_db_entry=False, batch_size=100,
+                     skip_unchanged=False):
+    """Same as update_doc for many documents at once.
+
+    For each batch the existing documents are fetched with a single
+    keys= query on the info/name view, merged locally and written back
+    with a single _bulk_docs request. With skip_unchanged, a keys= query
+    on the name_hash view first drops the documents whose hash did not
+    change, and only the remaining ones are pulled, all of them if the
+    view is not installed.
+    Objects of a batch sharing a name are merged into one first, the later
+    ones taking precedence as if written one after the other.
+    Returns a dict name -> status, the status being one of 'saved',
+    'updated', 'unchanged', 'duplicate', 'conflict' or 'error'.
+    """
+    status = {}
+    for start in range(0, len(objs), batch_size):
+        batch = _merge_same_names(objs[start:start + batch_size], over_write_db_entry)
+        for obj in batch:
+            obj[HASH_FIELD] = doc_hash(obj)
+        to_write = []
+        actions = []
+        if skip_unchanged:
+            stored = {}
+            names = list(OrderedDict.fromkeys(obj['name'] for obj in batch))
+            for row in _hash_rows(db, keys=names):
+                stored.setdefault(row.key, []).append(row)
+            remaining = []
+            for obj in batch:
+                hash_rows = stored.get(obj['name'], [])
+                if len(hash_rows) == 1 and hash_rows[0].value[HASH_FIELD] == obj[HASH_FIELD]:
+                    status[obj['name']] = 'unchanged'
+                elif len(hash_rows) == 1 and over_write_db_entry:
+                    obj['_id'] = hash_rows[0].id
+                    obj['_rev'] = hash_rows[0].value['_rev']
+                    to_write.append(obj)
+                    actions.append('updated')
+                else:
+                    remaining.append(obj)
+            batch = remaining
+        remote_docs = {}
+        names = list(OrderedDict.fromkeys(obj['name'] for obj in batch))
+        if names:
+            for row in db.view('info/name', keys=names):
+                remote_docs.setdefault(row.key, []).append(row.value)
+        for obj in batch:
+            rows = remote_docs.get(obj['name'], [])
+            if len(rows) == 1:
+                remote_doc = dict(rows[0])
+                # remove id and rev for comparison
+                doc_id = remote_doc.pop('_id')
+                doc_rev = remote_doc.pop('_rev')
+                if remote_doc == obj:
+                    status[obj['name']] = 'unchanged'
+                    continue
+                if not over_write_db_entry:
+                    obj = merge(obj, remote_doc)
+                obj['_id'] = doc_id
+                obj['_rev'] = doc_rev
+                to_write.append(obj)
+                actions.append('updated')
+            elif len(rows) == 0:
+                to_write.append(obj)
+                actions.append('saved')
+            else:
+                log.warning("more than one row with name {0} found".format(obj['name']))
+                status[obj['name']] = 'duplicate'
+        if not to_write:
+            continue
+        results = db.update(to_write)
+        for obj, action, (success, doc_id, rev_or_exc) in zip(to_write, actions, results):
+            if success:
+                status[obj['name']] = action
+                log.info("{0} {1}".format("updating" if action == 'updated' else "saving",
+                                          obj['name']))
+            elif isinstance(rev_or_exc, couchdb.http.ResourceConflict):
+                status[obj['name']] = 'conflict'
+                log.warning("conflict when writing {0}".format(obj['name']))
+            else:
+                status[obj['name']] = 'error'
+                log.error("could not write {0}: {1}".format(obj['name'], rev_or_exc))
+    return status
+
+
+def _merge_same_names(objs, over_write_db_entry=False):
+    """One object per name, as writing objs one after the other would store"""
+    by_name = OrderedDict()
+    for obj in objs:
+        if obj['name'] in by_name and not over_write_db_entry:
+            obj = merge(obj, by_name[obj['name']])
+        by_name[obj['name']] = obj
+    return list(by_name.values())
+
+
+def doc_diff(old, new, deletes=False):
+    """Changes turning document old into new, as a list of json operations:
+    {'op': 'set', 'path': [...], 'value': ...} for new or changed values,
+    {'op': 'append', 'path': [...], 'values': [...]} for lists that grew at
+    their end, and, with deletes, {'op': 'delete', 'path': [...]} for keys
+    that are gone. Lists keeping most of their items, such as time cycles
+    where only the end of the last cycle moves, are changed item by item,
+    an integer in the path being a list index.
+    Without deletes, applying the changes to old gives merge(new, old).
+    _id and _rev are left out."""
+    ops = []
+    stack = [(old, new, [])]
+    while stack:
+        a, b, path = stack.pop()
+        for key in b:
+            if not path and key in ('_id', '_rev'):
+                continue
+            value_b = b[key]
+            if key not in a:
+                ops.append({'op': 'set', 'path': path + [key], 'value': value_b})
+                continue
+            value_a = a[key]
+            if value_a is value_b:
+                continue
+            try:
+                if value_a == value_b:
+                    continue
+            except RecursionError:
+                pass
+            if isinstance(value_a, dict) and isinstance(value_b, dict):
+                stack.append((value_a, value_b, path + [key]))
+            elif isinstance(value_a, list) and isinstance(value_b, list):
+                ops.extend(_list_diff(value_a, value_b, path + [key]))
+            else:
+                ops.append({'op': 'set', 'path': path + [key], 'value': value_b})
+        if deletes:
+            for key in a:
+                if key not in b and (path or key not in ('_id', '_rev')):
+                    ops.append({'op': 'delete', 'path': path + [key]})
+    return ops
+
+
+def _list_diff(a, b, path):
+    """doc_diff operations turning list a into list b"""
+    if len(b) < len(a):
+        return [{'op': 'set', 'path': path, 'value': b}]
+    changed = [i for i in range(len(a)) if a[i] is not b[i] and a[i] != b[i]]
+    if len(changed) * 2 > len(a):
+        # most items changed, the whole list is as short
+        return [{'op': 'set', 'path': path, 'value': b}]
+    ops = [{'op': 'set', 'path': path + [i], 'value': b[i]} for i in changed]
+    if len(b) > len(a):
+        ops.append({'op': 'append', 'path': path, 'values': b[len(a):]})
+    return ops
+
+
+def apply_diff(doc, ops):
+    """New document with the doc_diff operations applied to doc, as the
+    patch update handler does. doc is left as it is and the parts of it
+    that are not changed are shared with the result."""
+    result = dict(doc)
+    # dicts and lists of the result already copied from doc, by id
+    copied = set([id(result)])
+    for op in ops:
+        parent = result
+        path = op['path']
+        for depth, key in enumerate(path[:-1]):
+            # an integer as next step is a list index
+            container = list if isinstance(path[depth + 1], int) else dict
+            child = parent[key] if isinstance(parent, list) else parent.get(key)
+            if not isinstance(child, container):
+                child = container()
+            elif id(child) not in copied:
+                child = container(child)
+            copied.add(id(child))
+            parent[key] = child
+            parent = child
+        key = path[-1]
+        if op['op'] == 'set':
+            parent[key] = op['value']
+        elif op['op'] == 'append':
+            parent[key] = (parent.get(key) or []) + op['values']
+        elif op['op'] == 'delete':
+            parent.pop(key, None)
+    return result
+
+
+def patch_doc(db, obj, previous=None, over_write_db_entry=False, retries=3):
+    """Uploads a parsed document as its changes from the stored one, for
+    documents uploaded again and again while their run goes on.
+
+    previous is the document as stored, with its _id and _rev, usually the
+    value returned by the previous call. Without it, the stored document
+    is read from the info/name view. The changes are sent to the patch
+    update handler, so that only they go over the wire. If the handler is
+    not installed, the stored document with the changes applied is written
+    back without reading it again. When the stored document changed since
+    previous, it is read again and the changes recomputed, up to retries
+    times. Nothing is written when nothing changed.
+
+    Keys missing from obj are kept, as update_doc does, unless
+    over_write_db_entry is set. Returns the document as now stored.
+    """
+    obj[HASH_FIELD] = doc_hash(obj)
+    if previous is None:
+        rows = db.view('info/name')[obj['name']].rows
+        if len(rows) > 1:
+            log.warning("more than one row with name {0} found".format(obj['name']))
+            return None
+        if not rows:
+            doc_id, doc_rev = db.save(obj)
+            log.info("saving {0}".format(obj['name']))
+            return dict(obj, _id=doc_id, _rev=doc_rev)
+        previous = rows[0].value
+    for attempt in range(retries + 1):
+        ops = doc_diff(previous, obj, deletes=over_write_db_entry)
+        if not ops:
+            log.debug("{0} is unchanged".format(obj['name']))
+            return previous
+        try:
+            try:
+                headers, _ = db.update_doc(PATCH_HANDLER, previous['_id'],
+                                           body={'rev': previous['_rev'], 'ops': ops})
+                doc_rev = headers['X-Couch-Update-NewRev']
+            except couchdb.http.ResourceNotFound:
+                # no handler, or the document is gone
+                doc_rev = db.save(apply_diff(previous, ops))[1]
+        except couchdb.http.ResourceConflict:
+            log.debug("conflict when patching {0}, attempt {1}".format(
+                obj['name'], attempt + 1))
+            previous = db.get(previous['_id'])
+            if previous is None:
+                break
+            continue
+        log.info("patching {0}: {1} changes".format(obj['name'], len(ops)))
+        return dict(apply_diff(previous, ops), _rev=doc_rev)
+    log.warning("conflict when patching {0}".format(obj['name']))
+    return None
+
+
 # merges d2 in d1, keeps values from d1
 # taken from scilifelab
-def merge(d1, d2):
+def merge(d1, d2, changes=None):
     """ Will merge dictionary d2 into dictionary d1.
     On the case of finding the same key, the one in d1 will be used.
+    Subtrees that are the same object, or equal, in d1 and d2 are skipped
+    without walking them, and nesting is walked with an explicit stack.
     :param d1: Dictionary object
-    :param s2: Dictionary object
+    :param d2: Dictionary object
+    :param changes: optional list, gets a (path, value) pair appended for
+        every key where the merged dictionary differs from d2, path being
+        the tuple of keys leading to it and value the one from d1
     """
-    for key in d2:
-        if key in d1:
-            if isinstance(d1[key], dict) and isinstance(d2[key], dict):
-                merge(d1[key], d2[key])
-            elif d1[key] == d2[key]:
-                pass  # same leaf value
+    stack = [(d1, d2, ())]
+    while stack:
+        a, b, path = stack.pop()
+        if changes is not None:
+            for key in a:
+                if key not in b:
+                    changes.append((path + (key,), a[key]))
+        for key in b:
+            if key not in a:
+                a[key] = b[key]
+                continue
+            value_a = a[key]
+            value_b = b[key]
+            if value_a is value_b:
+                continue
+            # equality is checked in C and stops at the first difference,
+            # much cheaper than walking an identical subtree here, unless
+            # the subtree is nested too deep for it
+            try:
+                if value_a == value_b:
+                    continue
+            except RecursionError:
+                pass
+            if isinstance(value_a, dict) and isinstance(value_b, dict):
+                stack.append((value_a, value_b, path + (key,)))
             else:
-                log.debug("Values for key {key} in d1 and d2 differ,",
+                log.debug("Values for key {key} in d1 and d2 differ, "
                           "using d1's value".format(key=key))
-        else:
-            d1[key] = d2[key]
+                if changes is not None:
+                    changes.append((path + (key,), value_a))
     return d1
@@ -0,0 +1,188 @@
+"""Persistent index of the run folders on a sequencer share.
+
+Scanning reads each folder holding a file RunParser needs once with
+os.scandir, instead of a stat per file, and records the run folders with
+their instrument and the files present in them, with their mtime and size,
+in a SQLite file. RunParser and the batch ingestion then query the index
+instead of probing every path.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from flowcell_parser.classes import parse_run_folder_name, run_folder_artifacts
+
+log = logging.getLogger(__name__)
+
+
+def scan_run_folder(path, demultiplexing_dir='Demultiplexing'):
+    """{path: (mtime_ns, size)} of the files of run_folder_artifacts present
+    in a run folder. Folders, such as the Stats folder, get the same
+    fingerprint as in flowcell_parser.cache: their latest mtime and the
+    total size of the files they contain."""
+    wanted = set()
+    for exists in (lambda p: True, lambda p: False):
+        wanted.update(p for _, _, p in run_folder_artifacts(path, demultiplexing_dir, exists))
+    listings = {}
+
+    def listing(folder):
+        if folder not in listings:
+            try:
+                with os.scandir(folder) as entries:
+                    listings[folder] = dict((entry.path, entry) for entry in entries)
+            except OSError:
+                listings[folder] = {}
+        return listings[folder]
+
+    present = {}
+    for artifact_path in sorted(wanted):
+        entry = listing(os.path.dirname(artifact_path)).get(artifact_path)
+        if entry is None:
+            continue
+        stat = entry.stat()
+        if not entry.is_dir():
+            present[artifact_path] = (stat.st_mtime_ns, stat.st_size)
+            continue
+        mtime = stat.st_mtime_ns
+        size = 0
+        for child in listing(artifact_path).values():
+            if child.is_file():
+                child_stat = child.stat()
+                mtime = max(mtime, child_stat.st_mtime_ns)
+                size += child_stat.st_size
+        present[artifact_path] = (mtime, size)
+    return present
+
+
+class RunFolderIndex(object):
+    """SQLite backed index of run folders.
+
+    What the index knows of a run folder is as old as its last scan, while
+    the files of runs in progress keep appearing and changing. artifacts()
+    scans a run folder again when its scan is older than max_age seconds,
+    None to trust the index whatever its age. Callers keeping an index
+    around for runs in progress should keep max_age short or scan() the
+    roots again before each round of parsing.
+
+    .demultiplexing_dir : the demultiplexing folder the files are looked up in
+    """
+    def __init__(self, path, demultiplexing_dir='Demultiplexing', max_age=300):
+        self.path = path
+        self.demultiplexing_dir = demultiplexing_dir
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS runs ("
+                " path TEXT PRIMARY KEY,"
+                " root TEXT NOT NULL,"
+                " name TEXT NOT NULL,"
+                " run_date TEXT NOT NULL,"
+                " instrument TEXT NOT NULL,"
+                " instrument_type TEXT,"
+                " flowcell TEXT NOT NULL,"
+                " scanned REAL NOT NULL)")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                " run TEXT NOT NULL,"
+                " path TEXT NOT NULL,"
+                " mtime_ns INTEGER NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " PRIMARY KEY (run, path))")
+
+    def scan(self, root):
+        """Indexes root if it is a run folder, otherwise the run folders
+        directly under it, and drops the runs indexed under root that are
+        gone. Returns the paths of the run folders found."""
+        root = os.path.abspath(root)
+        if parse_run_folder_name(os.path.basename(root)):
+            parent = os.path.dirname(root)
+            run_folders = [root]
+        else:
+            parent = root
+            with os.scandir(root) as entries:
+                run_folders = sorted(entry.path for entry in entries
+                                     if entry.is_dir() and parse_run_folder_name(entry.name))
+        scanned = [(run_folder, scan_run_folder(run_folder, self.demultiplexing_dir))
+                   for run_folder in run_folders]
+        with self._lock, self._connection:
+            if parent == root:
+                indexed = self._connection.execute(
+                    "SELECT path FROM runs WHERE root = ?", (root,)).fetchall()
+                self._delete([path for path, in indexed if path not in run_folders])
+            self._delete(run_folders)
+            for run_folder, files in scanned:
+                name = os.path.basename(run_folder)
+                run = parse_run_folder_name(name)
+                self._connection.execute(
+                    "INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (run_folder, parent, name, run['date'], run['instrument'],
+                     run['instrument_type'], run['flowcell'], time.time()))
+                self._connection.executemany(
+                    "INSERT INTO files VALUES (?, ?, ?, ?)",
+                    [(run_folder, path, mtime, size) for path, (mtime, size) in files.items()])
+        log.info("indexed {0} run folders in {1}".format(len(run_folders), root))
+        return run_folders
+
+    def _delete(self, run_folders):
+        for table, column in (('runs', 'path'), ('files', 'run')):
+            self._connection.executemany(
+                "DELETE FROM {0} WHERE {1} = ?".format(table, column),
+                [(run_folder,) for run_folder in run_folders])
+
+    def run(self, run_folder):
+        """What is known of a run folder, None if it is not indexed"""
+        run_folder = os.path.abspath(run_folder)
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT name, run_date, instrument, instrument_type, flowcell, scanned"
+                " FROM runs WHERE path = ?", (run_folder,)).fetchone()
+            if row is None:
+                return None
+            files = self._connection.execute(
+                "SELECT path, mtime_ns, size FROM files WHERE run = ?", (run_folder,)).fetchall()
+        run = dict(zip(('name', 'date', 'instrument', 'instrument_type', 'flowcell',
+                        'scanned'), row))
+        run['files'] = dict((path, (mtime, size)) for path, mtime, size in files)
+        return run
+
+    def runs(self, instrument_type=None, root=None):
+        """Paths of the indexed run folders, optionally of one instrument
+        type or under one root"""
+        query = "SELECT path FROM runs WHERE 1"
+        args = []
+        if instrument_type is not None:
+            query += " AND instrument_type = ?"
+            args.append(instrument_type)
+        if root is not None:
+            query += " AND root = ?"
+            args.append(os.path.abspath(root))
+        with self._lock:
+            rows = self._connection.execute(query + " ORDER BY path", args).fetchall()
+        return [path for path, in rows]
+
+    def artifacts(self, run_folder):
+        """Same as run_folder_artifacts, without touching the disk if the run
+        folder was scanned less than max_age seconds ago, scanning it
+        otherwise. Returns (artifacts, attributes of the missing ones,
+        {path: (mtime_ns, size)} of the present ones)"""
+        run_folder = os.path.abspath(run_folder)
+        run = self.run(run_folder)
+        if run is None or self.is_stale(run):
+            self.scan(run_folder)
+            run = self.run(run_folder)
+        files = run['files']
+        artifacts = run_folder_artifacts(run_folder, self.demultiplexing_dir,
+                                         files.__contains__)
+        missing = set(attribute for attribute, _, path in artifacts if path not in files)
+        return artifacts, missing, files
+
+    def is_stale(self, run):
+        """Whether a run, as returned by run(), should be scanned again"""
+        return self.max_age is not None and time.time() - run['scanned'] > self.max_age
+
+    def close(self):
+        self._connection.close()
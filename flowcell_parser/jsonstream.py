@@ -0,0 +1,192 @@
+"""Incremental json reading for large files such as bcl2fastq's Stats.json.
+
+iter_events() tokenizes a file chunk by chunk and yields events in the
+style of ijson: (prefix, event, value), the prefix being the dotted path
+of the value, with 'item' standing for array elements, e.g.
+ConversionResults.item.DemuxResults.item.Yield.
+
+extract() uses the events to rebuild only the selected parts of the
+document, so memory depends on what is kept and not on the file size.
+"""
+import heapq
+import re
+
+from collections import OrderedDict
+from json.decoder import scanstring
+
+TOKEN_RE = re.compile(r"""[ \t\n\r]*(?:
+    ([{}\[\],:])                                 # structure
+    |"([^"\\]*(?:\\.[^"\\]*)*)"                   # string
+    |(-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][-+]?\d+)? # number
+      |-?Infinity|NaN)                            # not json, accepted by json.load
+    |(true|false|null))""", re.VERBOSE)
+WHITESPACE_RE = re.compile(r'[ \t\n\r]*')
+LITERALS = {'true': ('boolean', True),
+            'false': ('boolean', False),
+            'null': ('null', None)}
+SPECIAL_NUMBERS = {'NaN': float('nan'),
+                   'Infinity': float('inf'),
+                   '-Infinity': float('-inf')}
+
+
+def _tokens(fileobj, chunk_size):
+    """Yields (token, value), token being one of {}[],: or the name of a
+    scalar event. The buffer only grows past chunk_size to hold a single
+    token spanning chunks."""
+    buf = ''
+    pos = 0
+    eof = False
+    while True:
+        match = TOKEN_RE.match(buf, pos)
+        if match is None or (not eof and len(buf) - match.end() < 3):
+            # the next token may continue in the next chunk, e.g. a number
+            # cut right before its fraction or exponent
+            if eof:
+                if WHITESPACE_RE.match(buf, pos).end() == len(buf):
+                    return
+                raise ValueError("Invalid json at {0!r}".format(buf[pos:pos + 20]))
+            chunk = fileobj.read(chunk_size)
+            buf = buf[pos:] + chunk
+            pos = 0
+            eof = not chunk
+            continue
+        pos = match.end()
+        structure, string, number, literal = match.groups()
+        if structure:
+            yield structure, None
+        elif string is not None:
+            if '\\' in string:
+                string = scanstring(string + '"', 0)[0]
+            yield 'string', string
+        elif number:
+            if number in SPECIAL_NUMBERS:
+                yield 'number', SPECIAL_NUMBERS[number]
+            elif '.' in number or 'e' in number or 'E' in number:
+                yield 'number', float(number)
+            else:
+                yield 'number', int(number)
+        else:
+            yield LITERALS[literal]
+
+
+def iter_events(fileobj, chunk_size=64 * 1024):
+    """Yields (prefix, event, value) for a json document read from fileobj.
+    Events are start_map, map_key, end_map, start_array, end_array, string,
+    number, boolean and null."""
+    # one [type, prefix, current key] per open container
+    containers = []
+    expect_key = False
+    for token, value in _tokens(fileobj, chunk_size):
+        if token == ',':
+            expect_key = containers[-1][0] == 'map'
+            continue
+        if token == ':':
+            continue
+        if token == '}' or token == ']':
+            container = containers.pop()
+            expect_key = False
+            yield container[1], 'end_map' if token == '}' else 'end_array', None
+            continue
+        if expect_key:
+            containers[-1][2] = value
+            expect_key = False
+            yield containers[-1][1], 'map_key', value
+            continue
+        if not containers:
+            prefix = ''
+        else:
+            kind, parent, key = containers[-1]
+            child = key if kind == 'map' else 'item'
+            prefix = parent + '.' + child if parent else child
+        if token == '{':
+            containers.append(['map', prefix, None])
+            expect_key = True
+            yield prefix, 'start_map', None
+        elif token == '[':
+            containers.append(['array', prefix, None])
+            yield prefix, 'start_array', None
+        else:
+            yield prefix, token, value
+
+
+class _TopCounts(object):
+    """Stands in for a map of counts, only keeping the n largest"""
+    def __init__(self, n):
+        self.n = n
+        self.heap = []
+        self.seen = 0
+
+    def __setitem__(self, key, count):
+        self.seen += 1
+        item = (count, -self.seen, key)
+        if len(self.heap) < self.n:
+            heapq.heappush(self.heap, item)
+        elif self.n > 0 and item > self.heap[0]:
+            heapq.heapreplace(self.heap, item)
+
+    def result(self):
+        return OrderedDict((key, count) for count, _, key
+                           in sorted(self.heap, reverse=True))
+
+
+def extract(fileobj, fields, top_counts=None, chunk_size=64 * 1024):
+    """Rebuilds the parts of a json document selected by fields, a list of
+    prefixes which are kept with everything below them. The maps and arrays
+    leading to them are kept too, with only the selected content.
+
+    top_counts maps prefixes of {key: count} maps to the number of largest
+    counts to keep from them, e.g. {'UnknownBarcodes.item.Barcodes': 50}.
+    """
+    top_counts = top_counts or {}
+    fields = set(fields) | set(top_counts)
+    ancestors = set([''])
+    for field in fields:
+        parts = field.split('.')
+        for end in range(1, len(parts)):
+            ancestors.add('.'.join(parts[:end]))
+
+    root = None
+    # one [container, current key, keep everything, parent, key in parent]
+    stack = []
+    skip = 0
+    for prefix, event, value in iter_events(fileobj, chunk_size):
+        if skip:
+            if event == 'start_map' or event == 'start_array':
+                skip += 1
+            elif event == 'end_map' or event == 'end_array':
+                skip -= 1
+            continue
+        if event == 'map_key':
+            stack[-1][1] = value
+            continue
+        if event == 'end_map' or event == 'end_array':
+            container, _, _, parent, key = stack.pop()
+            if isinstance(container, _TopCounts):
+                parent[key] = container.result()
+            continue
+        keep_all = (stack and stack[-1][2]) or prefix in fields
+        if not keep_all and prefix not in ancestors:
+            if event == 'start_map' or event == 'start_array':
+                skip = 1
+            continue
+        if event == 'start_map':
+            if prefix in top_counts:
+                value = _TopCounts(top_counts[prefix])
+                keep_all = True
+            else:
+                value = {}
+        elif event == 'start_array':
+            value = []
+        if not stack:
+            root = value
+            key = None
+        elif isinstance(stack[-1][0], list):
+            key = len(stack[-1][0])
+            stack[-1][0].append(value)
+        else:
+            key = stack[-1][1]
+            stack[-1][0][key] = value
+        if event == 'start_map' or event == 'start_array':
+            parent = stack[-1][0] if stack else None
+            stack.append([value, None, keep_all, parent, key])
+    return root
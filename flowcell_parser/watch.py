@@ -0,0 +1,360 @@
+"""Watch mode: keeps the documents of the run folders under sequencer roots
+up to date as their files change.
+
+Changes to the files RunParser reads (see run_folder_artifacts) are seen
+with inotify where it is available. Otherwise, and on NFS where inotify
+misses the changes made by other hosts, the run folders are polled with
+flowcell_parser.index.scan_run_folder. Only the parsers whose files
+changed are run again, and the updated documents are written to a sink
+(see flowcell_parser.batch).
+
+    flowcell_parser_watch --couchdb ~/.taca/taca.yaml --patch /data/NovaSeq
+"""
+import argparse
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import time
+
+from flowcell_parser.batch import add_sink_arguments, sink_from_arguments
+from flowcell_parser.classes import RunParser, parse_run_folder_name, run_folder_artifacts
+from flowcell_parser.index import scan_run_folder
+
+log = logging.getLogger(__name__)
+
+# from sys/inotify.h
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify(object):
+    """Minimal ctypes binding of the Linux inotify API, watching
+    directories for files being written, created, moved or deleted.
+    Raises OSError where inotify is not available."""
+    MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        try:
+            self._add_watch = libc.inotify_add_watch
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except AttributeError:
+            raise OSError(errno.ENOSYS, "inotify is not supported on this platform")
+        if fd < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code))
+        self.fd = fd
+        # watch descriptor -> directory, and back
+        self._directories = {}
+        self._watches = {}
+
+    def watch(self, directory):
+        """Watches a directory, returns False if it does not exist"""
+        if directory in self._watches:
+            return True
+        wd = self._add_watch(self.fd, os.fsencode(directory), self.MASK)
+        if wd < 0:
+            code = ctypes.get_errno()
+            if code in (errno.ENOENT, errno.ENOTDIR):
+                return False
+            raise OSError(code, os.strerror(code), directory)
+        self._directories[wd] = directory
+        self._watches[directory] = wd
+        return True
+
+    def read(self, timeout):
+        """Paths that changed, waiting at most timeout seconds for them.
+        None stands for events lost when the kernel queue overflowed."""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        paths = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                paths.append(None)
+            elif mask & IN_IGNORED:
+                # the directory is gone
+                directory = self._directories.pop(wd, None)
+                self._watches.pop(directory, None)
+            elif wd in self._directories:
+                directory = self._directories[wd]
+                paths.append(os.path.join(directory, os.fsdecode(name)) if name else directory)
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+def artifact_paths(run_folder):
+    """(attribute, path) of the files RunParser reads, with both locations
+    of the files that can be in two places"""
+    paths = set()
+    for exists in (lambda p: True, lambda p: False):
+        paths.update((attribute, path) for attribute, _, path
+                     in run_folder_artifacts(run_folder, exists=exists))
+    return sorted(paths)
+
+
+def affected_attributes(run_folder, path):
+    """Parser attributes of a run folder to parse again after path changed:
+    the one reading that file, otherwise those reading from below it or
+    from a folder holding it, such as the Stats folder"""
+    artifacts = artifact_paths(run_folder)
+    exact = set(attribute for attribute, artifact in artifacts if artifact == path)
+    if exact:
+        return exact
+    return set(attribute for attribute, artifact in artifacts
+               if path.startswith(artifact + os.sep) or artifact.startswith(path + os.sep))
+
+
+def watched_directories(run_folder):
+    """Folders to watch for the files of a run folder: the ones holding them,
+    or their closest existing parent in the run folder, to see them appear"""
+    directories = set()
+    for _, path in artifact_paths(run_folder):
+        for directory in (path, os.path.dirname(path)):
+            while not os.path.isdir(directory) and directory != run_folder:
+                directory = os.path.dirname(directory)
+            directories.add(directory)
+    return sorted(directories)
+
+
+class RunFolderWatcher(object):
+    """Writes the documents of the run folders under roots to a sink, then
+    again each time the files they are parsed from change.
+
+    With poll, or where inotify is not available, the run folders are
+    scanned every interval seconds. Changes are handled once no other
+    change has been seen for settle seconds, so that files being written
+    are parsed once complete.
+
+    .parsers : RunParser by run folder
+    """
+    def __init__(self, roots, sink, poll=False, interval=10.0, settle=2.0, cache=None,
+                 parser_options=None):
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.sink = sink
+        self.interval = interval
+        self.settle = settle
+        self.cache = cache
+        self.parser_options = parser_options
+        self.parsers = {}
+        self.inotify = None
+        if not poll:
+            try:
+                self.inotify = Inotify()
+            except OSError as e:
+                log.warning("inotify is not available ({0}), polling every {1}s".format(
+                    e, interval))
+        # run folder -> scan_run_folder fingerprints, when polling
+        self._fingerprints = {}
+        # run folder -> attributes to parse again, None for new run folders
+        self._pending = {}
+        self._last_change = None
+        self._stopped = False
+
+    def start(self):
+        """Parses the run folders under the roots and writes their documents"""
+        for root in self.roots:
+            if self.inotify is not None:
+                self.inotify.watch(root)
+            for run_folder in self._run_folders(root):
+                self._add_run(run_folder)
+        self._flush()
+
+    def run_once(self, timeout=None):
+        """Waits for changes for at most timeout seconds, interval by
+        default, and handles those that settled.
+        Returns the (run folder, attributes parsed again) updated."""
+        if timeout is None:
+            timeout = self.interval
+        if self._pending:
+            timeout = min(timeout, max(0, self._last_change + self.settle - time.monotonic()))
+        if self.inotify is not None:
+            paths = self.inotify.read(timeout)
+        else:
+            time.sleep(timeout)
+            paths = self._poll()
+        now = time.monotonic()
+        for path in paths:
+            self._dispatch(path)
+            self._last_change = now
+        if self._pending and now - self._last_change >= self.settle:
+            return self._update()
+        return []
+
+    def run_forever(self):
+        self.start()
+        while not self._stopped:
+            self.run_once()
+
+    def stop(self):
+        self._stopped = True
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+
+    def _run_folders(self, root):
+        try:
+            with os.scandir(root) as entries:
+                return sorted(entry.path for entry in entries
+                              if entry.is_dir() and parse_run_folder_name(entry.name))
+        except OSError as e:
+            log.error("cannot list {0}: {1}".format(root, e))
+            return []
+
+    def _add_run(self, run_folder):
+        # watch first, not to miss what changes while parsing
+        if self.inotify is not None:
+            self._watch_run(run_folder)
+        else:
+            self._fingerprints[run_folder] = scan_run_folder(run_folder)
+        try:
+            parser = RunParser(run_folder, cache=self.cache,
+                               parser_options=self.parser_options)
+        except Exception as e:
+            log.error("cannot parse {0}: {1}".format(run_folder, e))
+            return
+        self.parsers[run_folder] = parser
+        self._write(parser)
+
+    def _watch_run(self, run_folder):
+        for directory in watched_directories(run_folder):
+            self.inotify.watch(directory)
+
+    def _poll(self):
+        paths = []
+        for root in self.roots:
+            paths.extend(run_folder for run_folder in self._run_folders(root)
+                         if run_folder not in self._fingerprints)
+        for run_folder, previous in list(self._fingerprints.items()):
+            if not os.path.isdir(run_folder):
+                paths.append(run_folder)
+                continue
+            current = scan_run_folder(run_folder)
+            self._fingerprints[run_folder] = current
+            paths.extend(sorted(path for path in set(previous) | set(current)
+                                if previous.get(path) != current.get(path)))
+        return paths
+
+    def _dispatch(self, path):
+        if path is None:
+            log.warning("inotify events were lost, parsing everything again")
+            for run_folder in self.parsers:
+                self._pending[run_folder] = set(a for a, _ in artifact_paths(run_folder))
+            for root in self.roots:
+                for run_folder in self._run_folders(root):
+                    self._pending.setdefault(run_folder, None)
+            return
+        if os.path.dirname(path) in self.roots:
+            if path in self.parsers or path in self._fingerprints:
+                if not os.path.isdir(path):
+                    log.info("{0} is gone".format(path))
+                    self.parsers.pop(path, None)
+                    self._fingerprints.pop(path, None)
+                    self._pending.pop(path, None)
+            elif parse_run_folder_name(os.path.basename(path)) and os.path.isdir(path):
+                self._pending[path] = None
+            return
+        for root in self.roots:
+            if path.startswith(root + os.sep):
+                run_folder = os.path.join(root, path[len(root) + 1:].split(os.sep)[0])
+                break
+        else:
+            return
+        if run_folder not in self.parsers:
+            return
+        if self.inotify is not None and os.path.isdir(path):
+            # watch the folders that appeared on the way to the files
+            self._watch_run(run_folder)
+        attributes = affected_attributes(run_folder, path)
+        if attributes and self._pending.get(run_folder, set()) is not None:
+            self._pending.setdefault(run_folder, set()).update(attributes)
+
+    def _update(self):
+        pending, self._pending = self._pending, {}
+        updated = []
+        for run_folder, attributes in sorted(pending.items()):
+            if attributes is None:
+                self._add_run(run_folder)
+                if run_folder in self.parsers:
+                    updated.append((run_folder, set(a for a, _ in artifact_paths(run_folder))))
+                continue
+            parser = self.parsers[run_folder]
+            try:
+                parser.update(attributes)
+            except Exception as e:
+                log.error("cannot parse {0} again: {1}".format(run_folder, e))
+                continue
+            log.info("parsed {0} of {1} again".format(', '.join(sorted(attributes)),
+                                                       run_folder))
+            self._write(parser)
+            updated.append((run_folder, attributes))
+        self._flush()
+        return updated
+
+    def _write(self, parser):
+        try:
+            self.sink.write(parser.obj)
+        except Exception as e:
+            log.error("cannot write {0}: {1}".format(parser.path, e))
+
+    def _flush(self):
+        if hasattr(self.sink, 'flush'):
+            try:
+                self.sink.flush()
+            except Exception as e:
+                log.error("cannot flush the documents: {0}".format(e))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Watch sequencer roots and write the documents of their run folders "
+        "to a sink as their files change")
+    parser.add_argument('roots', nargs='+', help="folders holding run folders")
+    parser.add_argument('--poll', action='store_true',
+                        help="poll instead of using inotify, e.g. on NFS")
+    parser.add_argument('--interval', type=float, default=10.0,
+                        help="seconds between polls")
+    parser.add_argument('--settle', type=float, default=2.0,
+                        help="seconds without changes before parsing changed files again")
+    add_sink_arguments(parser)
+    args = parser.parse_args(args)
+    logging.basicConfig(level=logging.INFO)
+
+    try:
+        sink = sink_from_arguments(args)
+    except ValueError as e:
+        parser.error(str(e))
+    watcher = RunFolderWatcher(args.roots, sink, poll=args.poll, interval=args.interval,
+                               settle=args.settle)
+    try:
+        watcher.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+        sink.close()
+    return 0
@@ -17,4 +17,11 @@ setup(name="flowcell_parser",
       pushes it into statusdb",
       packages=find_packages(),
       scripts=glob.glob('scripts/*.py'),
-      install_requires=install_requires)
+      entry_points={
+          'console_scripts': [
+              'flowcell_parser_batch = flowcell_parser.batch:main',
+              'flowcell_parser_watch = flowcell_parser.watch:main',
+          ],
+      },
+      install_requires=install_requires,
+      extras_require={'async': ['aiohttp']})
@@ -0,0 +1,293 @@
+"""In-process stand-in for the parts of the CouchDB HTTP API used by
+flowcell_parser.db, for the tests.
+
+Views are python functions taking a document and returning a list of
+(key, value) pairs, registered under their 'design/view' name.
+
+.delay slows every request down to stand in for network latency, and
+.max_in_flight records how many requests were handled at the same time.
+.conflicts holds changes that another client makes to a document right
+before the next writes to it, one per write, so that they conflict.
+With .chunked, replies are sent with chunked transfer encoding.
+
+Update handlers are python functions taking the stored document, or None,
+and the request body, and returning (document to store or None, status,
+reply), registered under their 'design/handler' name. They only run if
+the design document lists them, as CouchDB would. .received counts the
+bytes of the request bodies.
+"""
+import json
+import threading
+import time
+import uuid
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+
+def name_view(doc):
+    if 'name' in doc:
+        return [(doc['name'], doc)]
+    return []
+
+
+def name_hash_view(doc):
+    if 'name' in doc:
+        return [(doc['name'], {'_rev': doc['_rev'],
+                               'content_hash': doc.get('content_hash')})]
+    return []
+
+
+def patch_update(doc, body):
+    """Python version of flowcell_parser.db.PATCH_FUNCTION"""
+    if doc is None:
+        return None, 404, {'error': 'not_found', 'reason': 'missing'}
+    body = json.loads(body)
+    if body['rev'] != doc['_rev']:
+        return None, 409, {'error': 'conflict', 'reason': 'Document update conflict.'}
+    for op in body['ops']:
+        parent = doc
+        for depth, key in enumerate(op['path'][:-1]):
+            container = list if isinstance(op['path'][depth + 1], int) else dict
+            child = parent[key] if isinstance(parent, list) else parent.get(key)
+            if not isinstance(child, container):
+                parent[key] = container()
+            parent = parent[key]
+        key = op['path'][-1]
+        if op['op'] == 'set':
+            parent[key] = op['value']
+        elif op['op'] == 'append':
+            parent[key] = (parent.get(key) or []) + op['values']
+        elif op['op'] == 'delete':
+            parent.pop(key, None)
+    return doc, 201, {'ok': True}
+
+
+class CouchDBStub(object):
+
+    def __init__(self, views=None, updates=None):
+        self.databases = {}
+        self.views = {'info/name': name_view, 'flowcell_parser/name_hash': name_hash_view}
+        self.views.update(views or {})
+        self.updates = {'info/patch': patch_update}
+        self.updates.update(updates or {})
+        self.received = 0
+        self.requests = []
+        self.lock = threading.Lock()
+        self.delay = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.conflicts = []
+        self.chunked = False
+        stub = self
+
+        class Handler(RequestHandler):
+            couch = stub
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={'poll_interval': 0.01})
+        self.thread.daemon = True
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{0}/".format(self.server.server_address[1])
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def create(self, name):
+        self.databases.setdefault(name, {})
+
+    def docs(self, db_name):
+        return dict((doc_id, dict(doc))
+                    for doc_id, doc in self.databases[db_name].items()
+                    if not doc_id.startswith('_design/'))
+
+    def count(self, method=None, suffix=''):
+        return len([r for r in self.requests
+                    if (method is None or r[0] == method) and r[1].endswith(suffix)])
+
+    def put(self, db_name, doc):
+        """Stores a doc, returns (status, body) like CouchDB would"""
+        documents = self.databases[db_name]
+        doc_id = doc.get('_id') or uuid.uuid4().hex
+        current = documents.get(doc_id)
+        if current is not None and current['_rev'] != doc.get('_rev'):
+            return 409, {'error': 'conflict', 'reason': 'Document update conflict.',
+                         'id': doc_id}
+        if current is None and doc.get('_rev'):
+            return 409, {'error': 'conflict', 'reason': 'Document update conflict.',
+                         'id': doc_id}
+        generation = int(current['_rev'].split('-')[0]) + 1 if current else 1
+        stored = dict(doc)
+        stored['_id'] = doc_id
+        stored['_rev'] = "{0}-{1}".format(generation, uuid.uuid4().hex)
+        documents[doc_id] = stored
+        return 201, {'ok': True, 'id': doc_id, 'rev': stored['_rev']}
+
+    def query(self, db_name, view, keys=None, key=None):
+        rows = []
+        for doc_id, doc in sorted(self.databases[db_name].items()):
+            if doc_id.startswith('_design/'):
+                continue
+            for row_key, value in self.views[view](json.loads(json.dumps(doc))):
+                rows.append({'id': doc_id, 'key': row_key, 'value': value})
+        if key is not None:
+            rows = [row for row in rows if row['key'] == key]
+        if keys is not None:
+            rows = [row for k in keys for row in rows if row['key'] == k]
+        else:
+            rows.sort(key=lambda row: json.dumps(row['key']))
+        return {'total_rows': len(rows), 'offset': 0, 'rows': rows}
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    couch = None
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_HEAD(self):
+        self.dispatch('HEAD')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    def reply(self, status, body, headers=None):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if self.couch.chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        if self.couch.chunked:
+            half = len(payload) // 2
+            for chunk in (payload[:half], payload[half:], b''):
+                self.wfile.write("{0:x}\r\n".format(len(chunk)).encode('ascii') +
+                                 chunk + b'\r\n')
+        else:
+            self.wfile.write(payload)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return None
+        with self.couch.lock:
+            self.couch.received += length
+        return self.rfile.read(length).decode('utf-8')
+
+    def dispatch(self, method):
+        couch = self.couch
+        url = urlsplit(self.path)
+        query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        parts = [unquote(part) for part in url.path.strip('/').split('/') if part]
+        body = self.read_body() if method in ('PUT', 'POST') else None
+        with couch.lock:
+            couch.in_flight += 1
+            couch.max_in_flight = max(couch.max_in_flight, couch.in_flight)
+        try:
+            if couch.delay:
+                time.sleep(couch.delay)
+            with couch.lock:
+                couch.requests.append((method, url.path))
+                if len(parts) > 3 and parts[1:4:2] == ['_design', '_update']:
+                    result = self.update(couch, parts, body)
+                else:
+                    body = json.loads(body) if body else None
+                    result = self.route(couch, method, parts, query, body)
+        finally:
+            with couch.lock:
+                couch.in_flight -= 1
+        self.reply(*result)
+
+    def update(self, couch, parts, body):
+        db_name = parts[0]
+        if db_name not in couch.databases:
+            return 404, {'error': 'not_found', 'reason': 'Database does not exist.'}
+        documents = couch.databases[db_name]
+        design = documents.get('_design/' + parts[2], {})
+        if len(parts) != 6 or parts[4] not in design.get('updates', {}):
+            return 404, {'error': 'not_found', 'reason': 'missing update function'}
+        handler = couch.updates['{0}/{1}'.format(parts[2], parts[4])]
+        stored = documents.get(parts[5])
+        doc, status, reply = handler(json.loads(json.dumps(stored)) if stored else None, body)
+        if doc is None:
+            return status, reply
+        status, saved = couch.put(db_name, doc)
+        if status != 201:
+            return status, saved
+        return 201, reply, {'X-Couch-Update-NewRev': saved['rev']}
+
+    def route(self, couch, method, parts, query, body):
+        if not parts:
+            return 200, {'couchdb': 'Welcome', 'version': '3.3.0'}
+        db_name = parts[0]
+        if len(parts) == 1:
+            if method == 'PUT':
+                couch.create(db_name)
+                return 201, {'ok': True}
+            if db_name not in couch.databases:
+                return 404, {'error': 'not_found', 'reason': 'Database does not exist.'}
+            if method == 'POST':
+                return couch.put(db_name, body)
+            return 200, {'db_name': db_name, 'doc_count': len(couch.databases[db_name])}
+        if db_name not in couch.databases:
+            return 404, {'error': 'not_found', 'reason': 'Database does not exist.'}
+        documents = couch.databases[db_name]
+        if parts[1] == '_bulk_docs':
+            results = []
+            for doc in body['docs']:
+                if couch.conflicts and doc.get('_id') in documents:
+                    changed = dict(documents[doc['_id']], **couch.conflicts.pop(0))
+                    couch.put(db_name, changed)
+                status, result = couch.put(db_name, doc)
+                results.append(result)
+            return 201, results
+        if parts[1] == '_design' and len(parts) == 5 and parts[3] == '_view':
+            view = '{0}/{1}'.format(parts[2], parts[4])
+            if view not in couch.views:
+                return 404, {'error': 'not_found', 'reason': 'missing_named_view'}
+            keys = (body or {}).get('keys')
+            if keys is None and 'keys' in query:
+                keys = json.loads(query['keys'])
+            key = json.loads(query['key']) if 'key' in query else None
+            return 200, couch.query(db_name, view, keys=keys, key=key)
+        doc_id = '/'.join(parts[1:])
+        if method in ('GET', 'HEAD'):
+            if doc_id not in documents:
+                return 404, {'error': 'not_found', 'reason': 'missing'}
+            return 200, documents[doc_id]
+        if method == 'PUT':
+            if couch.conflicts and doc_id in documents:
+                # another client got there first
+                changed = dict(documents[doc_id], **couch.conflicts.pop(0))
+                couch.put(db_name, changed)
+            body['_id'] = doc_id
+            return couch.put(db_name, body)
+        if method == 'DELETE':
+            documents.pop(doc_id, None)
+            return 200, {'ok': True}
+        return 405, {'error': 'method_not_allowed', 'reason': method}
@@ -0,0 +1,108 @@
+import asyncio
+import copy
+import unittest
+
+from flowcell_parser import aiodb, db
+from couchdb_stub import CouchDBStub
+
+
+@unittest.skipIf(aiodb.aiohttp is None, "aiohttp is not installed")
+class AsyncCouchDBTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.couch = CouchDBStub().start()
+        self.addCleanup(self.couch.stop)
+        self.couch.create('x_flowcells')
+
+    def docs_by_name(self):
+        return dict((doc['name'], doc) for doc in self.couch.docs('x_flowcells').values())
+
+    def update_docs(self, objs, max_connections=4, **kwargs):
+        async def run():
+            async with aiodb.AsyncCouchDB(self.couch.url, 'x_flowcells',
+                                          max_connections=max_connections) as client:
+                status = await aiodb.update_docs(client, objs, **kwargs)
+                return status, client.connections
+        return asyncio.run(run())
+
+
+class TestUpdateDocs(AsyncCouchDBTestCase):
+
+    def test_update_docs_new_and_merge(self):
+        status, _ = self.update_docs([{'name': 'fc_1', 'RunInfo': {'Id': 'a'}},
+                                      {'name': 'fc_2', 'run_setup': '2x51'}])
+        assert status == {'fc_1': 'saved', 'fc_2': 'saved'}
+        status, _ = self.update_docs([{'name': 'fc_1', 'run_setup': '2x151'},
+                                      {'name': 'fc_2', 'run_setup': '2x51'}])
+        assert status == {'fc_1': 'updated', 'fc_2': 'unchanged'}
+        docs = self.docs_by_name()
+        assert docs['fc_1']['RunInfo'] == {'Id': 'a'}
+        assert docs['fc_1']['run_setup'] == '2x151'
+        assert docs['fc_1']['content_hash'] == db.doc_hash({'name': 'fc_1',
+                                                            'run_setup': '2x151'})
+        # new documents get their id here and are PUT, so that sending
+        # them again can not create a second document
+        assert self.couch.count('POST', '/x_flowcells') == 0
+
+    def test_update_docs_leaves_objs_as_given(self):
+        self.update_docs([{'name': 'fc_1', 'nested': {'a': 1}}])
+        obj = {'name': 'fc_1', 'nested': {'b': 2}}
+        given = copy.deepcopy(obj)
+        self.update_docs([obj])
+        del obj['content_hash']
+        assert obj == given
+        assert self.docs_by_name()['fc_1']['nested'] == {'a': 1, 'b': 2}
+
+    def test_update_docs_runs_concurrently_over_few_connections(self):
+        self.couch.delay = 0.02
+        objs = [{'name': 'fc_{0}'.format(i)} for i in range(20)]
+        status, connections = self.update_docs(objs, max_connections=4, concurrency=8)
+        assert set(status.values()) == set(['saved'])
+        assert len(self.docs_by_name()) == 20
+        assert self.couch.max_in_flight == 4
+        assert connections == 4
+
+    def test_same_name_is_written_once(self):
+        status, _ = self.update_docs([{'name': 'fc_1', 'a': 1}, {'name': 'fc_1', 'b': 2}])
+        docs = self.couch.docs('x_flowcells')
+        assert len(docs) == 1
+        doc = list(docs.values())[0]
+        assert (doc['a'], doc['b']) == (1, 2)
+
+    def test_conflicts_are_retried_with_a_merge(self):
+        self.update_docs([{'name': 'fc_1', 'a': 1}])
+        self.couch.conflicts = [{'other': 'x'}, {'other': 'y'}]
+        status, _ = self.update_docs([{'name': 'fc_1', 'a': 2}], backoff=0.001)
+        assert status == {'fc_1': 'updated'}
+        doc = self.docs_by_name()['fc_1']
+        assert (doc['a'], doc['other']) == (2, 'y')
+        assert doc['_rev'].startswith('4-')
+
+    def test_conflicts_give_up_after_the_retries(self):
+        self.update_docs([{'name': 'fc_1', 'a': 1}])
+        self.couch.conflicts = [{'other': n} for n in range(3)]
+        status, _ = self.update_docs([{'name': 'fc_1', 'a': 2}], retries=2, backoff=0.001)
+        assert status == {'fc_1': 'conflict'}
+
+    def test_skip_unchanged_and_chunked_replies(self):
+        self.couch.chunked = True
+        self.update_docs([{'name': 'fc_1', 'a': 1}])
+        self.couch.requests = []
+        status, _ = self.update_docs([{'name': 'fc_1', 'a': 1}], skip_unchanged=True)
+        assert status == {'fc_1': 'unchanged'}
+        assert self.couch.requests == [('GET', '/x_flowcells/_design/flowcell_parser/_view/name_hash')]
+        status, _ = self.update_docs([{'name': 'fc_1', 'a': 2}], skip_unchanged=True,
+                                     over_write_db_entry=True)
+        assert status == {'fc_1': 'updated'}
+        assert self.couch.count('GET', '/_view/name') == 0
+        assert self.docs_by_name()['fc_1']['a'] == 2
+
+    def test_skip_unchanged_without_hash_view(self):
+        del self.couch.views['flowcell_parser/name_hash']
+        self.update_docs([{'name': 'fc_1', 'a': 1}], skip_unchanged=True)
+        status, _ = self.update_docs([{'name': 'fc_1', 'a': 1}], skip_unchanged=True)
+        assert status == {'fc_1': 'unchanged'}
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from unittest import mock
+
+import couchdb
+
+from flowcell_parser import batch
+from couchdb_stub import CouchDBStub
+
+TEST_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../test_data')
+
+
+class TestIngest(unittest.TestCase):
+
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+        self.run_folders = [os.path.join(TEST_DATA, '150424_ST-E00214_0031_BH2WY7CCXX'),
+                            os.path.join(TEST_DATA, '191023_ST-E00214_0031_BH2WY7CCXX'),
+                            os.path.join(TEST_DATA, 'missing-191023_ST-E00214_0031_BH2WY7CCXX')]
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def test_ingest_json_lines(self):
+        jsonl = os.path.join(self.out_dir, 'flowcells.jsonl')
+        sink = batch.JsonLinesSink(jsonl)
+        report = batch.ingest(self.run_folders, sink, workers=2)
+        sink.close()
+        with open(jsonl) as f:
+            names = sorted(json.loads(line)['name'] for line in f)
+        assert names == ['150424_BH2WY7CCXX', '191023_BH2WY7CCXX']
+        assert report['runs'] == 3
+        assert report['written'] == 2
+        assert list(report['failures']) == [self.run_folders[2]]
+        assert 'Flowcell cannot be found' in report['failures'][self.run_folders[2]]
+
+    def test_ingest_directory_glob(self):
+        sink = batch.DirectorySink(os.path.join(self.out_dir, 'docs'))
+        report = batch.ingest([os.path.join(TEST_DATA, '1*_ST-E00214_*')], sink, workers=1)
+        assert report['runs'] == 3
+        assert report['failures'] == {}
+        assert sorted(os.listdir(sink.path)) == ['150424_BH2WY7CCXX.json',
+                                                 '191018_BH2WY7CCXX.json',
+                                                 '191023_BH2WY7CCXX.json']
+
+    def test_main_report(self):
+        report_path = os.path.join(self.out_dir, 'report.json')
+        status = batch.main(['--jsonl', os.path.join(self.out_dir, 'flowcells.jsonl'),
+                             '--report', report_path] + self.run_folders)
+        assert status == 1
+        with open(report_path) as f:
+            report = json.load(f)
+        assert report['written'] == 2
+        assert self.run_folders[2] in report['failures']
+
+
+class TestExpandRunFolders(unittest.TestCase):
+
+    def test_same_folder_given_differently(self):
+        run_folder = os.path.join(TEST_DATA, '150424_ST-E00214_0031_BH2WY7CCXX')
+        relative = os.path.relpath(run_folder)
+        assert batch.expand_run_folders([run_folder, run_folder + '/',
+                                         os.path.join('.', relative),
+                                         os.path.join(TEST_DATA, '150424_*')]) == [run_folder]
+
+
+class TestCouchDBSink(unittest.TestCase):
+
+    def test_couchdb_sink_uploads_in_batches(self):
+        couch = CouchDBStub().start()
+        self.addCleanup(couch.stop)
+        couch.create('x_flowcells')
+        sink = batch.CouchDBSink(couchdb.Server(couch.url)['x_flowcells'], batch_size=2)
+        batch.ingest([os.path.join(TEST_DATA, '1*_ST-E00214_*')], sink, workers=1)
+        sink.close()
+        assert sink.status == {'150424_BH2WY7CCXX': 'saved',
+                               '191018_BH2WY7CCXX': 'saved',
+                               '191023_BH2WY7CCXX': 'saved'}
+        assert couch.count('POST', '/_bulk_docs') == 2
+
+
+    def test_ingest_reports_upload_failures(self):
+        couch = CouchDBStub().start()
+        self.addCleanup(couch.stop)
+        couch.create('x_flowcells')
+        database = couchdb.Server(couch.url)['x_flowcells']
+        database.save({'name': '150424_BH2WY7CCXX'})
+        database.save({'name': '150424_BH2WY7CCXX'})
+        sink = batch.CouchDBSink(database, batch_size=10)
+        run_folders = [os.path.join(TEST_DATA, '150424_ST-E00214_0031_BH2WY7CCXX'),
+                       os.path.join(TEST_DATA, '191023_ST-E00214_0031_BH2WY7CCXX')]
+        report = batch.ingest(run_folders, sink, workers=1)
+        # uploaded before ingest returns, not when the sink is closed
+        assert sink.pending == []
+        assert report['written'] == 1
+        assert list(report['failures']) == [run_folders[0]]
+        assert 'duplicate' in report['failures'][run_folders[0]]
+
+    def test_failed_flush_reports_every_document(self):
+        couch = CouchDBStub().start()
+        self.addCleanup(couch.stop)
+        # the database does not exist, the upload raises
+        sink = batch.CouchDBSink(couchdb.Database(couch.url + 'x_flowcells'), batch_size=10)
+        report = batch.ingest([os.path.join(TEST_DATA, '1*_ST-E00214_*')], sink, workers=1)
+        assert report['written'] == 0
+        assert len(report['failures']) == 3
+        assert set(sink.status.values()) == set(['error'])
+
+
+class TestSinkArguments(unittest.TestCase):
+
+    def test_skip_unchanged_installs_the_hash_view(self):
+        couch = CouchDBStub().start()
+        self.addCleanup(couch.stop)
+        couch.create('x_flowcells')
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        config = os.path.join(tmp, 'statusdb.yaml')
+        with open(config, 'w') as config_file:
+            json.dump({'statusdb': {}}, config_file)
+        parser = argparse.ArgumentParser()
+        batch.add_sink_arguments(parser)
+        args = parser.parse_args(['--couchdb', config, '--skip-unchanged'])
+        with mock.patch.object(batch.db, 'setupServer',
+                               return_value=couchdb.Server(couch.url)):
+            sink = batch.sink_from_arguments(args)
+        assert sink.skip_unchanged
+        design = couch.databases['x_flowcells']['_design/flowcell_parser']
+        assert 'name_hash' in design['views']
+
+    def test_skip_unchanged_rejects_patch(self):
+        with self.assertRaises(SystemExit):
+            batch.main(['--couchdb', 'statusdb.yaml', '--skip-unchanged', '--patch', 'run'])
+
+
+class TestCouchDBPatchSink(unittest.TestCase):
+
+    def test_patch_sink_sends_changes(self):
+        couch = CouchDBStub().start()
+        self.addCleanup(couch.stop)
+        couch.create('x_flowcells')
+        sink = batch.CouchDBPatchSink(couchdb.Server(couch.url)['x_flowcells'])
+        sink.write({'name': 'fc_1', 'time cycles': [{'cycle': '1'}]})
+        sink.write({'name': 'fc_1', 'time cycles': [{'cycle': '1'}, {'cycle': '2'}]})
+        sink.write({'name': 'fc_1', 'time cycles': [{'cycle': '1'}, {'cycle': '2'}]})
+        doc = list(couch.docs('x_flowcells').values())[0]
+        assert sink.previous['fc_1'] == doc
+        assert doc['_rev'].startswith('2-')
+        assert len(doc['time cycles']) == 2
+        # the view is only read for the first write
+        assert couch.count('GET', '/_view/name') == 1
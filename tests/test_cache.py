@@ -0,0 +1,58 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from flowcell_parser.cache import ParseCache
+from flowcell_parser.classes import RunParser, RunInfoParser
+
+TEST_RUN = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        '../test_data/150424_ST-E00214_0031_BH2WY7CCXX')
+
+
+class TestParseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.run_path = os.path.join(self.tmp_dir, os.path.basename(TEST_RUN))
+        shutil.copytree(TEST_RUN, self.run_path)
+        self.cache = ParseCache(os.path.join(self.tmp_dir, 'cache.sqlite'))
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_reuses_unchanged_files(self):
+        first = RunParser(self.run_path, cache=self.cache)
+        assert self.cache.stats() == {'hits': 0, 'misses': 7, 'entries': 7}
+        second = RunParser(self.run_path, cache=self.cache)
+        assert self.cache.hits == 7
+        assert second.obj == first.obj
+        assert second.obj == RunParser(self.run_path).obj
+
+    def test_reparses_changed_files(self):
+        RunParser(self.run_path, cache=self.cache)
+        cycle_times = os.path.join(self.run_path, 'Logs', 'CycleTimes.txt')
+        with open(cycle_times, 'a') as f:
+            f.write("5/20/2019\t15:50:00.000\tH2KYVCCX2\t3\tStart chemistry\n")
+        parsed_run = RunParser(self.run_path, cache=self.cache)
+        assert self.cache.hits == 6
+        assert self.cache.misses == 8
+        assert parsed_run.obj['time cycles'][-1]['cycle_number'] == '3'
+
+    def test_version_change_invalidates(self):
+        run_info = os.path.join(self.run_path, 'RunInfo.xml')
+        parser, fingerprint = self.cache.get(RunInfoParser, run_info)
+        self.cache.put(RunInfoParser(run_info), run_info, fingerprint)
+        assert self.cache.get(RunInfoParser, run_info)[0].data['Flowcell'] == 'H2WY7CCXX'
+        newer_cache = ParseCache(self.cache.path, version='999.0.0')
+        self.addCleanup(newer_cache.close)
+        assert newer_cache.get(RunInfoParser, run_info)[0] is None
+
+    def test_evict(self):
+        RunParser(self.run_path, cache=self.cache)
+        assert self.cache.evict(max_age=3600) == 0
+        os.remove(os.path.join(self.run_path, 'RunInfo.xml'))
+        assert self.cache.evict() == 1
+        assert self.cache.evict(max_age=0) == 6
+        assert self.cache.stats()['entries'] == 0
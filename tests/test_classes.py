@@ -2,6 +2,12 @@ import unittest
 import flowcell_parser.classes as classes
 import os
 import datetime
+import json
+import shutil
+import tempfile
+import tracemalloc
+
+from bs4 import BeautifulSoup
 
 
 class TestSampleSheetParser(unittest.TestCase):
@@ -39,6 +45,124 @@ class TestSampleSheetParser(unittest.TestCase):
                     'SampleSheet_with_bad_header.csv'))
 
 
+    def test_sample_sheet_with_byte_order_mark(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        sample_sheet = os.path.join(tmp_dir, 'SampleSheet.csv')
+        with open(sample_sheet, 'w', encoding='utf-8-sig') as f:
+            f.write("[Header],,\nDate,2015-04-23,\n[Data],,\n"
+                    "Lane,Sample_ID,Sample_Project\n1,P1775_147,J_Lundeberg_14_24\n")
+        parsed_sample_sheet = classes.SampleSheetParser(sample_sheet)
+        assert parsed_sample_sheet.header == {'Date': '2015-04-23'}
+        assert parsed_sample_sheet.datafields == ['Lane', 'Sample_ID', 'Sample_Project']
+        assert parsed_sample_sheet.data == [{'Lane': '1', 'Sample_ID': 'P1775_147',
+                                             'Sample_Project': 'J_Lundeberg_14_24'}]
+        assert list(parsed_sample_sheet.rows_by_lane) == ['1']
+
+    def test_sample_sheet_data_same_as_dictreader(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        sample_sheet = os.path.join(tmp_dir, 'SampleSheet.csv')
+        with open(sample_sheet, 'w') as f:
+            f.write("[Header],,\nDate,2015-04-23,\n\n[Data],,\n"
+                    "Lane,Sample_ID,Sample_Project,Description\n"
+                    '1,S1,P1,"plain, with comma"\n'
+                    "2,S2,P1\n"
+                    "3,S3,P2,d,extra\n")
+        parsed_sample_sheet = classes.SampleSheetParser(sample_sheet)
+        with open(sample_sheet) as f:
+            reader = classes.csv.DictReader(f.read().split('[Data],,\n')[1].splitlines())
+            expected = [dict((field, row[field]) for field in reader.fieldnames)
+                        for row in reader]
+        assert parsed_sample_sheet.data == expected
+        assert parsed_sample_sheet.data[0]['Description'] == 'plain, with comma'
+        assert parsed_sample_sheet.header == {'Date': '2015-04-23'}
+        assert parsed_sample_sheet.dfield_proj == 'Sample_Project'
+
+    def test_sample_sheet_indexes(self):
+        path = os.path.dirname(os.path.abspath(__file__))
+        parsed_sample_sheet = classes.SampleSheetParser(os.path.join(
+            path, '../test_data/150424_ST-E00214_0031_BH2WY7CCXX/SampleSheet.csv'))
+        assert sorted(parsed_sample_sheet.rows_by_lane) == [str(lane) for lane in range(1, 9)]
+        assert parsed_sample_sheet.rows_by_lane['2'][0]['SampleName'] == 'P1775_155'
+        assert len(parsed_sample_sheet.rows_by_project['J_Lundeberg_14_24']) == 8
+        assert parsed_sample_sheet.rows_by_sample['Sample_P1775_108'][0]['Lane'] == '8'
+
+    def test_sample_sheet_v2(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        sample_sheet = os.path.join(tmp_dir, 'SampleSheet.csv')
+        with open(sample_sheet, 'w') as f:
+            f.write("[Header]\nFileFormatVersion,2\nRunName,run\n"
+                    "[Reads]\nRead1Cycles,151\nIndex1Cycles,10\n"
+                    "[Sequencing_Settings]\nLibraryPrepKits,kit\n"
+                    "[BCLConvert_Settings]\nSoftwareVersion,4.1.7\nAdapterRead1,CTGTCT\n"
+                    "[BCLConvert_Data]\nLane,Sample_ID,index,index2\n"
+                    "1,S1,ACGTACGTAC,TTGGCCAAGG\n2,S2,GGTTAACCGG,AACCGGTTAA\n"
+                    "[Cloud_Settings]\nGeneratedVersion,1\n"
+                    "[Cloud_Data]\nSample_ID,ProjectName,LibraryName\nS1,P1,L1\nS2,P2,L2\n")
+        parsed_sample_sheet = classes.SampleSheetParser(sample_sheet)
+        assert parsed_sample_sheet.header == {'FileFormatVersion': '2', 'RunName': 'run'}
+        assert parsed_sample_sheet.reads == ['Read1Cycles', 'Index1Cycles']
+        assert parsed_sample_sheet.settings == {'SoftwareVersion': '4.1.7',
+                                                'AdapterRead1': 'CTGTCT'}
+        assert parsed_sample_sheet.datafields == ['Lane', 'Sample_ID', 'index', 'index2']
+        assert parsed_sample_sheet.data[1] == {'Lane': '2', 'Sample_ID': 'S2',
+                                               'index': 'GGTTAACCGG', 'index2': 'AACCGGTTAA'}
+        assert parsed_sample_sheet.cloud_data == [
+            {'Sample_ID': 'S1', 'ProjectName': 'P1', 'LibraryName': 'L1'},
+            {'Sample_ID': 'S2', 'ProjectName': 'P2', 'LibraryName': 'L2'}]
+        assert parsed_sample_sheet.sections == {
+            'Sequencing_Settings': [['LibraryPrepKits', 'kit']],
+            'Cloud_Settings': [['GeneratedVersion', '1']]}
+        assert parsed_sample_sheet.rows_by_sample['S1'][0]['Lane'] == '1'
+        assert parsed_sample_sheet.rows_by_project == {}
+
+    def test_sample_sheet_queries(self):
+        path = os.path.dirname(os.path.abspath(__file__))
+        parsed_sample_sheet = classes.SampleSheetParser(os.path.join(
+            path, '../test_data/150424_ST-E00214_0031_BH2WY7CCXX/SampleSheet.csv'))
+        assert parsed_sample_sheet.lanes() == [str(lane) for lane in range(1, 9)]
+        assert parsed_sample_sheet.projects() == ['J_Lundeberg_14_24']
+        assert parsed_sample_sheet.projects(lane=9) == []
+        rows = parsed_sample_sheet.rows(lane=3, project='J_Lundeberg_14_24')
+        assert [row['SampleID'] for row in rows] == ['Sample_P1775_163']
+        assert parsed_sample_sheet.rows(index='ATTACTCG')[0]['Lane'] == '8'
+        assert parsed_sample_sheet.rows(index='ATTACTCG', lane=1) == []
+        assert parsed_sample_sheet.rows(sample_id='missing') == []
+        assert parsed_sample_sheet.rows() == parsed_sample_sheet.data
+        assert parsed_sample_sheet.barcode_collisions() == []
+
+    def test_sample_sheet_barcode_collisions(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        sample_sheet = os.path.join(tmp_dir, 'SampleSheet.csv')
+        with open(sample_sheet, 'w') as f:
+            f.write("[Data]\nLane,Sample_ID,index,index2\n"
+                    "1,S1,AAAAAAAA,CCCCCCCC\n"
+                    "1,S2,AAAAAATT,CCCCCCCG\n"  # 2 and 1 mismatches from S1
+                    "1,S3,AAAAATTT,CCCCCCCC\n"  # 3 mismatches from S1
+                    "2,S4,AAAAAAAA,CCCCCCCC\n"  # same barcode as S1, other lane
+                    "2,S5,AAAAAAAA,CCCCCCCC\n"
+                    "2,S6,AAAAAAAAAA,CCCCCCCC\n")  # different length
+        parsed_sample_sheet = classes.SampleSheetParser(sample_sheet)
+        assert parsed_sample_sheet.barcode_collisions() == [
+            ('1', 'S1', 'S2', (2, 1)), ('1', 'S2', 'S3', (1, 1)), ('2', 'S4', 'S5', (0, 0))]
+        assert parsed_sample_sheet.barcode_collisions(mismatches=0) == [
+            ('2', 'S4', 'S5', (0, 0))]
+
+    def test_sample_sheet_single_index_field(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        sample_sheet = os.path.join(tmp_dir, 'SampleSheet.csv')
+        with open(sample_sheet, 'w') as f:
+            f.write("FCID,Lane,SampleID,index\n"
+                    "FC,1,S1,ACGTACGT-TTTTTTTT\nFC,1,S2,ACGTACGA-TTTTTTTA\nFC,1,S3,\n")
+        parsed_sample_sheet = classes.SampleSheetParser(sample_sheet)
+        assert parsed_sample_sheet.barcodes(parsed_sample_sheet.data[0]) == ('ACGTACGT',
+                                                                             'TTTTTTTT')
+        assert parsed_sample_sheet.barcode_collisions() == [('1', 'S1', 'S2', (1, 1))]
+
 class TestRunInfoParser(unittest.TestCase):
 
     def test_run_info_valid_case(self):
@@ -68,6 +192,49 @@ class TestRunInfoParser(unittest.TestCase):
         assert parsed_run_info.data == expected_data
         assert parsed_run_info.recipe == "2x151"
 
+    def test_run_info_date_formats(self):
+        assert classes.run_date_to_yymmdd('150424') == '150424'
+        assert classes.run_date_to_yymmdd('10/17/2017 10:59:16 AM') == '171017'
+        assert classes.run_date_to_yymmdd('3/2/2021') == '210302'
+        assert classes.run_date_to_yymmdd('2023-05-24T08:12:45Z') == '230524'
+        with self.assertRaises(ValueError):
+            classes.run_date_to_yymmdd('24 May 2023')
+
+    def test_run_info_stops_before_tiles(self):
+        path = os.path.dirname(os.path.abspath(__file__))
+        run_info = os.path.join(path, '../test_data/150424_ST-E00214_0031_BH2WY7CCXX/RunInfo.xml')
+        parsed_run_info = classes.RunInfoParser(run_info)
+        assert parsed_run_info.data == parsed_run_info._parse_tree()
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        truncated = os.path.join(tmp_dir, 'RunInfo.xml')
+        with open(run_info) as f:
+            head = f.read().split('<TileSet')[0]
+        with open(truncated, 'w') as f:
+            # unclosed tags and garbage after FlowcellLayout are never read
+            f.write(head + '<TileSet>' + 'x' * 100000 + '<<<')
+        assert classes.RunInfoParser(truncated).data == parsed_run_info.data
+
+    def test_run_info_unusual_order(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        run_info = os.path.join(tmp_dir, 'RunInfo.xml')
+        with open(run_info, 'w') as f:
+            f.write('<RunInfo><Run Id="run" Number="2"><Flowcell>FC</Flowcell>'
+                    '<FlowcellLayout LaneCount="1"/><Reads><Read Number="1" NumCycles="51" IsIndexedRead="N"/>'
+                    '</Reads><Instrument>M01</Instrument><Date>3/2/2021</Date></Run></RunInfo>')
+        parsed_run_info = classes.RunInfoParser(run_info)
+        assert parsed_run_info.data == {'Id': 'run', 'Number': '2', 'Flowcell': 'FC',
+                                        'FlowcellLayout': {'LaneCount': '1'},
+                                        'Reads': [{'Number': '1', 'NumCycles': '51',
+                                                   'IsIndexedRead': 'N'}],
+                                        'Instrument': 'M01', 'Date': '210302'}
+        with open(run_info, 'w') as f:
+            f.write('<RunInfo><Run Id="run" Number="2"><Flowcell>FC</Flowcell>'
+                    '<FlowcellLayout LaneCount="1"/><Reads/></Run></RunInfo>')
+        with self.assertRaises(AttributeError):
+            classes.RunInfoParser(run_info)
+
     def test_run_info_file_missing(self):
         path = os.path.dirname(os.path.abspath(__file__))
         with self.assertRaises(OSError):
@@ -124,6 +291,73 @@ class TestRunParametersParser(unittest.TestCase):
                         'missing_runParameters.xml'))
 
 
+def recursive_xml_to_dict(root):
+    """The recursive xml_to_dict, kept as a reference for the iterative one"""
+    current = None
+    children = list(root)
+    if children:
+        current = {}
+        duplicates = {}
+        for child in children:
+            if len(root.findall(child.tag)) > 1:
+                if child.tag not in duplicates:
+                    duplicates[child.tag] = []
+                lower = recursive_xml_to_dict(child)
+                duplicates[child.tag].extend(list(lower.values()))
+                current.update(duplicates)
+            else:
+                lower = recursive_xml_to_dict(child)
+                current.update(lower)
+    if root.attrib:
+        if current:
+            current.update(root.attrib)
+        else:
+            current = dict(root.attrib)
+    if root.text and root.text.strip() != "":
+        if current:
+            if 'text' not in current:
+                current['text'] = root.text
+            else:
+                current['xml_text'] = root.text
+        else:
+            current = root.text
+    return {root.tag: current}
+
+
+class TestXmlToDict(unittest.TestCase):
+
+    def test_same_as_recursive_on_test_data(self):
+        path = os.path.dirname(os.path.abspath(__file__))
+        xml_files = []
+        for root, dirs, files in os.walk(os.path.join(path, '../test_data')):
+            xml_files.extend(os.path.join(root, f) for f in files if f.endswith('.xml'))
+        assert xml_files
+        for xml_file in xml_files:
+            tree = classes.ET.parse(xml_file).getroot()
+            converted = classes.xml_to_dict(tree)
+            assert converted == recursive_xml_to_dict(tree)
+            assert json.dumps(converted) == json.dumps(recursive_xml_to_dict(tree))
+
+    def test_same_as_recursive_on_edge_cases(self):
+        tree = classes.ET.fromstring(
+            '<Root id="1">root text<Read Number="1"/><Lane>1</Lane><Read Number="2">x</Read>'
+            '<text>child</text><Empty/><Lane>2</Lane><Read/>'
+            '<Kit ID="Y"><Name>kit</Name></Kit><Leaf name="a">value</Leaf></Root>')
+        converted = classes.xml_to_dict(tree)
+        assert converted == recursive_xml_to_dict(tree)
+        assert list(converted['Root']) == ['Read', 'Lane', 'text', 'Empty', 'Kit', 'Leaf',
+                                           'id', 'xml_text']
+        assert converted['Root']['Read'] == [{'Number': '1'}, {'Number': '2', 'text': 'x'}, None]
+
+    def test_deep_nesting(self):
+        depth = 5000
+        tree = classes.ET.fromstring('<a>' * depth + 'leaf' + '</a>' * depth)
+        converted = classes.xml_to_dict(tree)
+        for _ in range(depth - 1):
+            converted = converted['a']
+        assert converted == {'a': 'leaf'}
+
+
 class TestLaneBarcodeParser(unittest.TestCase):
 
     def test_lane_barcode_valid_case(self):
@@ -180,6 +414,168 @@ class TestLaneBarcodeParser(unittest.TestCase):
                 'Reports/html/H2WY7CCXX/all/all/all/missing_file.html'))
 
 
+    def test_lane_barcode_parity_with_beautifulsoup(self):
+        path = os.path.dirname(os.path.abspath(__file__))
+        report_dir = os.path.join(
+            path,
+            '../test_data/150424_ST-E00214_0031_BH2WY7CCXX/Demultiplexing/',
+            'Reports/html/H2WY7CCXX/all/all/all/')
+        for report in ('laneBarcode.html', 'lane.html'):
+            parsed = classes.LaneBarcodeParser(os.path.join(report_dir, report))
+            flowcell_data, sample_data = bsoup_lane_barcode(
+                os.path.join(report_dir, report))
+            assert parsed.flowcell_data == flowcell_data
+            assert parsed.sample_data == sample_data
+
+    def test_lane_barcode_parity_edge_cells(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        report = os.path.join(tmp_dir, 'laneBarcode.html')
+        with open(report, 'w') as f:
+            f.write("<html><body><table><tr><td>FC</td></tr></table>"
+                    "<table><tr><th>Clusters &gt; Q30</th></tr>"
+                    "<tr><td>1,000</td></tr></table>"
+                    "<table><tr><th>Lane</th><th>% of the<br>lane</th>"
+                    "<th>Mean <i>Quality</i></th></tr>"
+                    "<tr><td>1</td><td>NaN</td><td></td></tr>"
+                    "<tr><td>2</td><td>&amp;</td><td><b>35.1</b></td></tr>"
+                    "</table></body></html>")
+        parsed = classes.LaneBarcodeParser(report)
+        flowcell_data, sample_data = bsoup_lane_barcode(report)
+        assert parsed.flowcell_data == flowcell_data
+        assert parsed.sample_data == sample_data
+        assert parsed.sample_data[0] == {'Lane': '1', '% of thelane': '0',
+                                         'Mean Quality': '0'}
+
+
+    def test_lane_barcode_columnar(self):
+        path = os.path.dirname(os.path.abspath(__file__))
+        report_dir = os.path.join(
+            path,
+            '../test_data/150424_ST-E00214_0031_BH2WY7CCXX/Demultiplexing/',
+            'Reports/html/H2WY7CCXX/all/all/all/')
+        for report in ('laneBarcode.html', 'lane.html'):
+            parsed = classes.LaneBarcodeParser(os.path.join(report_dir, report))
+            columnar = classes.LaneBarcodeParser(os.path.join(report_dir, report),
+                                                 columnar=True)
+            assert columnar.flowcell_data == parsed.flowcell_data
+            assert columnar.sample_data == parsed.sample_data
+
+    def test_lane_barcode_columnar_aggregations(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        report = os.path.join(tmp_dir, 'laneBarcode.html')
+        rows = [('1', 'P1', 'P1_101', '1,200,000', '50.00', 'NaN'),
+                ('1', 'P2', 'P2_101', '1,200,000', '50.00', '35.10'),
+                ('2', 'P1', 'P1_102', '800', '100.00', '34.90'),
+                ('2', 'P1', 'P1_103', '', '', 'NaN')]
+        with open(report, 'w') as f:
+            f.write("<html><body><table></table><table><tr><th>Yield</th></tr>"
+                    "<tr><td>10</td></tr></table><table><tr><th>Lane</th><th>Project</th>"
+                    "<th>Sample</th><th>PF Clusters</th><th>% of the<br>lane</th>"
+                    "<th>Mean Quality<br>Score</th></tr>")
+            for row in rows:
+                f.write("<tr>" + "".join("<td>{0}</td>".format(cell) for cell in row) + "</tr>")
+            f.write("</table></body></html>")
+        parsed = classes.LaneBarcodeParser(report)
+        columnar = classes.LaneBarcodeParser(report, columnar=True)
+        columns = columnar.columns.columns
+        assert columnar.sample_data == parsed.sample_data
+        assert list(columns['Lane']) == [1, 1, 2, 2]
+        assert list(columns['PF Clusters']) == [1200000, 1200000, 800, 0]
+        assert columns['PF Clusters'].typecode == 'q'
+        assert list(columns['Mean QualityScore']) == [0.0, 35.1, 34.9, 0.0]
+        assert columns['Project'] == ['P1', 'P2', 'P1', 'P1']
+        assert columnar.columns.per_lane(['PF Clusters', '% of thelane']) == {
+            1: {'PF Clusters': 2400000, '% of thelane': 100.0},
+            2: {'PF Clusters': 800, '% of thelane': 100.0}}
+        assert columnar.columns.per_project(['PF Clusters'], how='mean') == {
+            'P1': {'PF Clusters': 1200800 / 3.0}, 'P2': {'PF Clusters': 1200000.0}}
+        with self.assertRaises(ValueError):
+            columnar.columns.per_lane(['Sample'])
+
+    def test_lane_barcode_columnar_in_run_parser(self):
+        path = os.path.dirname(os.path.abspath(__file__))
+        run_path = os.path.join(path, '../test_data/150424_ST-E00214_0031_BH2WY7CCXX')
+        parsed_run = classes.RunParser(run_path, parser_options={
+            'lanebarcodes': {'columnar': True}, 'lanes': {'columnar': True}})
+        assert parsed_run.lanebarcodes.columns is not None
+        assert parsed_run.obj == classes.RunParser(run_path).obj
+
+
+def bsoup_lane_barcode(path):
+    """BeautifulSoup based reference for LaneBarcodeParser"""
+    with open(path, newline='') as htmlfile:
+        bsoup = BeautifulSoup(htmlfile, 'html.parser')
+    flowcell_table = bsoup.find_all('table')[1]
+    lane_table = bsoup.find_all('table')[2]
+    flowcell_data = dict(zip([th.text for th in flowcell_table.find_all('th')],
+                             [td.text for td in flowcell_table.find_all('td')]))
+    sample_data = []
+    lane_keys = []
+    for row in lane_table.find_all('tr'):
+        if len(row.find_all('th')):
+            lane_keys.extend(th.text.replace('<br/>', ' ').replace('&gt;', '>')
+                             for th in row.find_all('th'))
+        elif len(row.find_all('td')):
+            lane_values = [td.text.replace('NaN', '0') if td.text else '0'
+                           for td in row.find_all('td')]
+            sample_data.append(dict(zip(lane_keys, lane_values)))
+    return flowcell_data, sample_data
+
+
+class TestDemuxSummaryParser(unittest.TestCase):
+
+    def setUp(self):
+        self.stats_dir = tempfile.mkdtemp()
+        header = ("### Most Popular Unknown Index Sequences\n"
+                  "### Columns: Index_Sequence Hit_Count\n")
+        with open(os.path.join(self.stats_dir, 'DemuxSummaryF1L1.txt'), 'w') as f:
+            f.write(header)
+            f.write("AAAAAAAA\t10\nCCCCCCCC\t30\nGGGGGGGG\t20\n"
+                    "TTTTTTTT\t30\nNNNNNNNN\t5\n")
+        with open(os.path.join(self.stats_dir, 'DemuxSummaryF1L2.txt'), 'w') as f:
+            f.write(header)
+            f.write("ACGTACGT\t7\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.stats_dir)
+
+    def test_demux_summary_keeps_most_frequent(self):
+        parsed_demux = classes.DemuxSummaryParser(self.stats_dir, top=3)
+        assert list(parsed_demux.result['1'].items()) == [('CCCCCCCC', 30),
+                                                          ('TTTTTTTT', 30),
+                                                          ('GGGGGGGG', 20)]
+        assert parsed_demux.result['2'] == {'ACGTACGT': 7}
+        assert parsed_demux.TOTAL == {'1': 95, '2': 7}
+
+    def test_demux_summary_small_chunks(self):
+        top_indexes, total = classes.parse_demux_summary(
+            os.path.join(self.stats_dir, 'DemuxSummaryF1L1.txt'),
+            top=2, chunk_size=7)
+        assert list(top_indexes) == ['CCCCCCCC', 'TTTTTTTT']
+        assert total == 95
+
+    def test_demux_summary_parallel_lanes(self):
+        serial = classes.DemuxSummaryParser(self.stats_dir, workers=1)
+        parallel = classes.DemuxSummaryParser(self.stats_dir, workers=2)
+        assert serial.result == parallel.result
+        assert serial.TOTAL == parallel.TOTAL
+
+    def test_demux_summary_workers_from_run_parser(self):
+        assert classes.DemuxSummaryParser(self.stats_dir).workers == 1
+        run_folder = os.path.join(self.stats_dir, '150424_ST-E00214_0031_BH2WY7CCXX')
+        shutil.copytree(self.stats_dir, os.path.join(run_folder, 'Demultiplexing', 'Stats'))
+        run = classes.RunParser(run_folder, sections=['undet'],
+                                parser_options={'undet': {'workers': 2}})
+        assert run.undet.workers == 2
+        assert run.undet.result == classes.DemuxSummaryParser(self.stats_dir).result
+
+    def test_demux_summary_folder_missing(self):
+        with self.assertRaises(OSError):
+            classes.DemuxSummaryParser(os.path.join(self.stats_dir, 'missing'))
+
+
 class TestCycleTimesParser(unittest.TestCase):
 
     def test_cycle_times_valid_case(self):
@@ -200,6 +596,19 @@ class TestCycleTimesParser(unittest.TestCase):
                                                                42, 14, 893000)}]
         assert parsed_cycle_times.cycles == expected_cycle_times_data
 
+    def test_cycle_timestamp_matches_strptime(self):
+        for date, time in [('5/20/2019', '15:03:22.011'),
+                           ('12/31/2019', '23:59:59.999999'),
+                           ('1/1/2020', '00:00:00.5'),
+                           ('5/20/2019', '9:03:22.011'),
+                           ('05/20/2019', '15:03:22.0111')]:
+            assert classes.parse_cycle_timestamp(date, time) == \
+                datetime.datetime.strptime(date + '-' + time, classes.CYCLE_TIMES_FORMAT)
+        with self.assertRaises(ValueError):
+            classes.parse_cycle_timestamp('5/20/2019', '15:03:22')
+        with self.assertRaises(ValueError):
+            classes.parse_cycle_timestamp('5/20/2019', '25:03:22.011')
+
     def test_cycle_times_file_empty(self):
         path = os.path.dirname(os.path.abspath(__file__))
         parsed_cycle_times = classes.CycleTimesParser(os.path.join(
@@ -217,6 +626,119 @@ class TestCycleTimesParser(unittest.TestCase):
                 'missing_CycleTimes.txt'))
 
 
+    def test_cycle_times_update_appended_lines(self):
+        path = os.path.dirname(os.path.abspath(__file__))
+        source = os.path.join(path, '../test_data/150424_ST-E00214_0031_BH2WY7CCXX/Logs/',
+                              'CycleTimes.txt')
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        cycle_times = os.path.join(tmp_dir, 'CycleTimes.txt')
+        with open(source) as f:
+            lines = f.readlines()
+        with open(cycle_times, 'w') as f:
+            f.writelines(lines[:4])
+            # a record still being written
+            f.write(lines[4][:10])
+        parsed_cycle_times = classes.CycleTimesParser(cycle_times)
+        first_cycle = parsed_cycle_times.cycles[0]
+        assert parsed_cycle_times.cycles == [{
+            'cycle_number': 1,
+            'start': datetime.datetime(2019, 5, 20, 15, 3, 22, 11000),
+            'end': datetime.datetime(2019, 5, 20, 15, 5, 56, 341000)}]
+        with open(cycle_times, 'a') as f:
+            f.write(lines[4][10:])
+            f.writelines(lines[5:])
+        assert parsed_cycle_times.update() == len(lines) - 4
+        assert parsed_cycle_times.update() == 0
+        assert parsed_cycle_times.cycles[0] is first_cycle
+        assert parsed_cycle_times.cycles == classes.CycleTimesParser(source).cycles
+
+
+class TestStatsParser(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.stats = {'Flowcell': 'H2WY7CCXX',
+                      'RunNumber': 31,
+                      'RunId': '150424_ST-E00214_0031_BH2WY7CCXX',
+                      'ConversionResults': [{
+                          'LaneNumber': 1,
+                          'TotalClustersRaw': 620815680,
+                          'TotalClustersPF': 395451350,
+                          'Yield': 119426,
+                          'DemuxResults': [{'SampleId': 'Sample_P1775_147',
+                                            'SampleName': 'P1775_147',
+                                            'NumberReads': 351637396,
+                                            'Yield': 106194,
+                                            'ReadMetrics': [{'ReadNumber': 1,
+                                                             'Yield': 53097}]}],
+                          'Undetermined': {'NumberReads': 43813954,
+                                           'Yield': 13232,
+                                           'ReadMetrics': []}}],
+                      'UnknownBarcodes': [{'Lane': 1,
+                                           'Barcodes': {'GGGGGGGG': 3,
+                                                        'NNNNNNNN': 30,
+                                                        'ACGTACGT': 20}}]}
+        self.path = os.path.join(self.tmp_dir, 'Stats.json')
+        with open(self.path, 'w') as f:
+            json.dump(self.stats, f)
+
+    def test_stats_full(self):
+        assert classes.StatsParser(self.path).data == self.stats
+
+    def test_stats_selected_fields(self):
+        parsed_stats = classes.StatsParser(self.path, classes.DEFAULT_STATS_FIELDS,
+                                           top_unknown=2)
+        lane = parsed_stats.data['ConversionResults'][0]
+        assert lane['DemuxResults'] == [{'SampleId': 'Sample_P1775_147',
+                                         'SampleName': 'P1775_147',
+                                         'NumberReads': 351637396,
+                                         'Yield': 106194}]
+        assert lane['Undetermined'] == {'NumberReads': 43813954, 'Yield': 13232}
+        assert parsed_stats.data['UnknownBarcodes'] == [
+            {'Lane': 1, 'Barcodes': {'NNNNNNNN': 30, 'ACGTACGT': 20}}]
+
+    def test_stats_options_from_run_parser(self):
+        path = os.path.dirname(os.path.abspath(__file__))
+        run_path = os.path.join(self.tmp_dir, '150424_ST-E00214_0031_BH2WY7CCXX')
+        shutil.copytree(os.path.join(path, '../test_data/150424_ST-E00214_0031_BH2WY7CCXX'),
+                        run_path)
+        os.makedirs(os.path.join(run_path, 'Demultiplexing', 'Stats'))
+        shutil.copy(self.path, os.path.join(run_path, 'Demultiplexing', 'Stats'))
+        parsed_run = classes.RunParser(
+            run_path, parser_options={'json_stats': {'fields': ['Flowcell']}})
+        assert parsed_run.obj['Json_Stats'] == {'Flowcell': 'H2WY7CCXX'}
+
+
+class TestDemultiplexingStatsParser(unittest.TestCase):
+
+    def test_demultiplexing_stats_valid_case(self):
+        path = os.path.dirname(os.path.abspath(__file__))
+        parsed_stats = classes.DemultiplexingStatsParser(os.path.join(
+            path, '../test_data/150424_ST-E00214_0031_BH2WY7CCXX/DemultiplexingStats.xml'))
+        columns = parsed_stats.data['columns']
+        assert parsed_stats.data['flowcell'] == 'H2WY7CCXX'
+        assert list(columns) == ['project', 'sample', 'barcode', 'lane', 'BarcodeCount',
+                                 'PerfectBarcodeCount', 'OneMismatchBarcodeCount']
+        assert len(set(len(column) for column in columns.values())) == 1
+        row = columns['sample'].index('P1775_147')
+        assert [columns[name][row] for name in columns] == [
+            'J_Lundeberg_14_24', 'P1775_147', 'GAATTCGT', 1, 351637396, 320616526, 31020870]
+        all_rows = [i for i, project in enumerate(columns['project']) if project == 'all']
+        assert [columns['lane'][i] for i in all_rows] == list(range(1, 9))
+
+    def test_demultiplexing_stats_in_run_obj(self):
+        path = os.path.dirname(os.path.abspath(__file__))
+        parsed_run = classes.RunParser(os.path.join(
+            path, '../test_data/150424_ST-E00214_0031_BH2WY7CCXX'))
+        assert parsed_run.obj['DemultiplexingStats']['flowcell'] == 'H2WY7CCXX'
+
+    def test_demultiplexing_stats_file_missing(self):
+        with self.assertRaises(OSError):
+            classes.DemultiplexingStatsParser('missing_DemultiplexingStats.xml')
+
+
 class TestRunParser(unittest.TestCase):
 
     def test_runfolder_valid_case(self):
@@ -241,6 +763,98 @@ class TestRunParser(unittest.TestCase):
         assert parsed_run.time_cycles is None
         assert parsed_run.json_stats is None
 
+    def test_runfolder_concurrent_parsers(self):
+        path = os.path.dirname(os.path.abspath(__file__))
+        run_path = os.path.join(path, '../test_data/150424_ST-E00214_0031_BH2WY7CCXX')
+        sequential_run = classes.RunParser(run_path)
+        threaded_run = classes.RunParser(run_path, workers=4)
+        process_run = classes.RunParser(run_path, workers=2, use_processes=True)
+        assert threaded_run.obj == sequential_run.obj
+        assert process_run.obj == sequential_run.obj
+        assert set(threaded_run.timings) == set(['runinfo', 'runparameters',
+                                                 'samplesheet', 'lanebarcodes',
+                                                 'lanes', 'undet', 'time_cycles',
+                                                 'json_stats', 'demultiplexing_stats'])
+
+    def test_runfolder_empty_concurrent(self):
+        path = os.path.dirname(os.path.abspath(__file__))
+        with self.assertLogs('flowcell_parser.classes', level='INFO') as logs:
+            parsed_run = classes.RunParser(os.path.join(
+                path, '../test_data/191023_ST-E00214_0031_BH2WY7CCXX'), workers=4)
+        assert parsed_run.obj == {'name': '191023_BH2WY7CCXX'}
+        assert parsed_run.runinfo is None
+        assert parsed_run.json_stats is None
+        assert len(logs.output) == 9
+
+    def test_runfolder_metrics(self):
+        path = os.path.dirname(os.path.abspath(__file__))
+        run_path = os.path.join(path, '../test_data/150424_ST-E00214_0031_BH2WY7CCXX')
+        exported = []
+        parsed_run = classes.RunParser(run_path, metrics_hook=exported.append)
+        assert exported == [parsed_run.metrics]
+        metrics = parsed_run.metrics['parsers']
+        assert set(metrics) == set(parsed_run.timings)
+        samplesheet = metrics['samplesheet']
+        assert samplesheet['source'] == 'parsed'
+        assert samplesheet['records'] == 8
+        assert samplesheet['bytes'] == os.path.getsize(os.path.join(run_path, 'SampleSheet.csv'))
+        assert samplesheet['seconds'] == parsed_run.timings['samplesheet']
+        assert metrics['runinfo']['records'] == 3
+        assert metrics['demultiplexing_stats']['records'] > 0
+        missing = dict(metrics['json_stats'], seconds=0.0)
+        assert missing == {'source': 'missing', 'seconds': 0.0, 'bytes': 0, 'records': 0,
+                           'process_peak_rss': None, 'peak_memory': None}
+        if classes.resource is not None:
+            assert samplesheet['process_peak_rss'] > 0
+        assert samplesheet['peak_memory'] is None
+        assert parsed_run.metrics['seconds'] >= sum(m['seconds'] for m in metrics.values())
+
+    def test_runfolder_trace_memory(self):
+        path = os.path.dirname(os.path.abspath(__file__))
+        run_path = os.path.join(path, '../test_data/150424_ST-E00214_0031_BH2WY7CCXX')
+        parsed_run = classes.RunParser(run_path, trace_memory=True)
+        metrics = parsed_run.metrics['parsers']
+        assert metrics['samplesheet']['peak_memory'] > 0
+        assert metrics['demultiplexing_stats']['peak_memory'] > 0
+        assert metrics['json_stats']['peak_memory'] is None
+        assert not tracemalloc.is_tracing()
+        # the threads share their allocations
+        parsed_run = classes.RunParser(run_path, workers=4, trace_memory=True)
+        assert parsed_run.metrics['parsers']['samplesheet']['peak_memory'] is None
+
+    def test_runfolder_metrics_hook_failure(self):
+        path = os.path.dirname(os.path.abspath(__file__))
+
+        def failing_hook(metrics):
+            raise ValueError("exporter down")
+        with self.assertLogs('flowcell_parser.classes', level='WARNING') as logs:
+            parsed_run = classes.RunParser(
+                os.path.join(path, '../test_data/150424_ST-E00214_0031_BH2WY7CCXX'),
+                metrics_hook=failing_hook)
+        assert 'exporter down' in logs.output[0]
+        assert parsed_run.obj['RunInfo']['Flowcell'] == 'H2WY7CCXX'
+
+    def test_runfolder_lazy(self):
+        path = os.path.dirname(os.path.abspath(__file__))
+        run_path = os.path.join(path, '../test_data/150424_ST-E00214_0031_BH2WY7CCXX')
+        parsed_run = classes.RunParser(run_path, lazy=True)
+        assert parsed_run.timings == {}
+        assert parsed_run.runinfo.data['Flowcell'] == 'H2WY7CCXX'
+        assert parsed_run.runinfo is parsed_run.runinfo
+        assert list(parsed_run.timings) == ['runinfo']
+        assert parsed_run.json_stats is None
+        assert parsed_run.obj == classes.RunParser(run_path).obj
+        with self.assertRaises(AttributeError):
+            parsed_run.not_a_parser
+
+    def test_runfolder_lazy_sections(self):
+        path = os.path.dirname(os.path.abspath(__file__))
+        parsed_run = classes.RunParser(
+            os.path.join(path, '../test_data/150424_ST-E00214_0031_BH2WY7CCXX'),
+            lazy=True, sections=['runinfo', 'samplesheet'])
+        assert sorted(parsed_run.obj) == ['RunInfo', 'name', 'run_setup', 'samplesheet_csv']
+        assert sorted(parsed_run.timings) == ['runinfo', 'samplesheet']
+
     def test_missing_runfolder(self):
         path = os.path.dirname(os.path.abspath(__file__))
         with self.assertRaises(OSError):
@@ -0,0 +1,312 @@
+import threading
+import unittest
+
+import couchdb
+
+from flowcell_parser import db
+from couchdb_stub import CouchDBStub
+
+
+class CouchDBTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.couch = CouchDBStub().start()
+        self.addCleanup(self.couch.stop)
+        self.couch.create('x_flowcells')
+        self.db = couchdb.Server(self.couch.url)['x_flowcells']
+
+    def docs_by_name(self):
+        return dict((doc['name'], doc) for doc in self.couch.docs('x_flowcells').values())
+
+
+class TestUpdateDoc(CouchDBTestCase):
+
+    def test_update_doc_new_and_merge(self):
+        db.update_doc(self.db, {'name': '150424_BH2WY7CCXX', 'RunInfo': {'Id': 'a'}})
+        db.update_doc(self.db, {'name': '150424_BH2WY7CCXX', 'run_setup': '2x151'})
+        docs = self.docs_by_name()
+        assert len(docs) == 1
+        assert docs['150424_BH2WY7CCXX']['RunInfo'] == {'Id': 'a'}
+        assert docs['150424_BH2WY7CCXX']['run_setup'] == '2x151'
+        assert docs['150424_BH2WY7CCXX']['_rev'].startswith('2-')
+
+
+class TestContentHash(CouchDBTestCase):
+
+    def test_doc_hash_is_canonical(self):
+        obj = {'name': 'fc_1', 'RunInfo': {'Id': 'a', 'Number': '1'}}
+        same = {'RunInfo': {'Number': '1', 'Id': 'a'}, 'name': 'fc_1',
+                '_id': 'x', '_rev': '1-a', 'content_hash': 'stale'}
+        assert db.doc_hash(obj) == db.doc_hash(same)
+        assert db.doc_hash(obj) != db.doc_hash({'name': 'fc_1'})
+
+    def test_update_doc_skips_unchanged(self):
+        db.update_doc(self.db, {'name': 'fc_1', 'run_setup': '2x151'})
+        self.couch.requests = []
+        db.update_doc(self.db, {'name': 'fc_1', 'run_setup': '2x151'}, skip_unchanged=True)
+        assert self.couch.requests == [('GET', '/x_flowcells/_design/flowcell_parser/_view/name_hash')]
+        db.update_doc(self.db, {'name': 'fc_1', 'run_setup': '2x51'}, skip_unchanged=True)
+        doc = self.docs_by_name()['fc_1']
+        assert doc['run_setup'] == '2x51'
+        assert doc['content_hash'] == db.doc_hash({'name': 'fc_1', 'run_setup': '2x51'})
+
+    def test_update_doc_over_write_uses_hash_view_only(self):
+        db.update_doc(self.db, {'name': 'fc_1', 'run_setup': '2x151', 'old': 1})
+        self.couch.requests = []
+        db.update_doc(self.db, {'name': 'fc_1', 'run_setup': '2x51'},
+                      over_write_db_entry=True, skip_unchanged=True)
+        assert self.couch.count('GET', '/_view/name') == 0
+        assert 'old' not in self.docs_by_name()['fc_1']
+
+    def test_bulk_update_docs_skips_unchanged(self):
+        db.update_doc(self.db, {'name': 'fc_1', 'run_setup': '2x151'})
+        self.couch.requests = []
+        status = db.bulk_update_docs(self.db, [{'name': 'fc_1', 'run_setup': '2x151'},
+                                               {'name': 'fc_2', 'run_setup': '2x151'}],
+                                     skip_unchanged=True)
+        assert status == {'fc_1': 'unchanged', 'fc_2': 'saved'}
+        assert self.couch.count('POST', '/_view/name_hash') == 1
+        assert self.couch.count('POST', '/_view/name') == 1
+
+    def test_skip_unchanged_without_hash_view(self):
+        del self.couch.views['flowcell_parser/name_hash']
+        db.update_doc(self.db, {'name': 'fc_1', 'a': 1}, skip_unchanged=True)
+        db.update_doc(self.db, {'name': 'fc_1', 'a': 1, 'b': 2}, skip_unchanged=True)
+        status = db.bulk_update_docs(self.db, [{'name': 'fc_1', 'a': 1, 'b': 2},
+                                               {'name': 'fc_2'}], skip_unchanged=True)
+        assert status == {'fc_1': 'unchanged', 'fc_2': 'saved'}
+        assert self.docs_by_name()['fc_1']['b'] == 2
+
+    def test_install_hash_view(self):
+        self.db.save({'_id': '_design/info', 'views': {'name': {'map': 'function(doc) {}'}}})
+        db.install_hash_view(self.db)
+        db.install_hash_view(self.db)
+        design = self.db['_design/flowcell_parser']
+        assert design['views']['name_hash']['map'] == db.NAME_HASH_MAP
+        assert design['_rev'].startswith('1-')
+        # the views of the shared design document are not rebuilt
+        info = self.db['_design/info']
+        assert list(info['views']) == ['name']
+        assert info['_rev'].startswith('1-')
+
+
+class TestBulkUpdateDocs(CouchDBTestCase):
+
+    def test_bulk_update_docs(self):
+        db.update_doc(self.db, {'name': 'fc_1', 'run_setup': '2x151'})
+        db.update_doc(self.db, {'name': 'fc_2', 'run_setup': '2x151'})
+        self.couch.requests = []
+        objs = [{'name': 'fc_1', 'run_setup': '2x151'},
+                {'name': 'fc_2', 'RunInfo': {'Id': 'b'}},
+                {'name': 'fc_3', 'run_setup': '1x51'},
+                {'name': 'fc_4', 'run_setup': '1x51'}]
+        status = db.bulk_update_docs(self.db, objs, batch_size=3)
+        assert status == {'fc_1': 'unchanged', 'fc_2': 'updated',
+                          'fc_3': 'saved', 'fc_4': 'saved'}
+        # one view query and one _bulk_docs per batch
+        assert self.couch.count('POST', '/_view/name') == 2
+        assert self.couch.count('POST', '/_bulk_docs') == 2
+        assert len(self.couch.requests) == 4
+        docs = self.docs_by_name()
+        assert docs['fc_2']['run_setup'] == '2x151'
+        assert docs['fc_2']['RunInfo'] == {'Id': 'b'}
+
+    def test_bulk_update_docs_over_write(self):
+        db.update_doc(self.db, {'name': 'fc_1', 'run_setup': '2x151'})
+        status = db.bulk_update_docs(self.db, [{'name': 'fc_1', 'run_setup': '2x51'}],
+                                     over_write_db_entry=True)
+        assert status == {'fc_1': 'updated'}
+        assert self.docs_by_name()['fc_1']['run_setup'] == '2x51'
+
+    def test_bulk_update_docs_reports_conflicts(self):
+        db.update_doc(self.db, {'name': 'fc_1', 'run_setup': '2x151'})
+        self.couch.conflicts = [{'other': 'x'}]
+        status = db.bulk_update_docs(self.db, [{'name': 'fc_1', 'run_setup': '2x51'}])
+        assert status == {'fc_1': 'conflict'}
+
+    def test_bulk_update_docs_same_name_in_a_batch(self):
+        status = db.bulk_update_docs(self.db, [{'name': 'fc_1', 'a': 1, 'c': 1},
+                                               {'name': 'fc_1', 'b': 2, 'c': 2}])
+        assert status == {'fc_1': 'saved'}
+        docs = self.couch.docs('x_flowcells')
+        assert len(docs) == 1
+        doc = list(docs.values())[0]
+        assert (doc['a'], doc['b'], doc['c']) == (1, 2, 2)
+
+    def test_bulk_update_docs_duplicates(self):
+        self.db.save({'name': 'fc_1'})
+        self.db.save({'name': 'fc_1'})
+        status = db.bulk_update_docs(self.db, [{'name': 'fc_1', 'run_setup': '2x51'}])
+        assert status == {'fc_1': 'duplicate'}
+
+
+class TestPooledSession(CouchDBTestCase):
+
+    def test_setup_server_shares_sessions(self):
+        conf = {'statusdb': {'username': 'u', 'password': 'p', 'url': 'db.example.org',
+                             'pool_size': 3, 'timeout': 30}}
+        first = db.setupServer(conf).resource.session
+        assert db.setupServer(conf).resource.session is first
+        assert (first.pool_size, first.connection_pool.timeout) == (3, 30)
+        assert db.session_stats()[(3, 30)]['requests'] == 0
+        session = db.PooledSession()
+        assert db.setupServer(conf, session=session).resource.session is session
+
+    def test_connections_are_reused_across_threads(self):
+        session = db.PooledSession(pool_size=2, timeout=10)
+        database = couchdb.Server(self.couch.url, session=session)['x_flowcells']
+
+        def save(number):
+            for i in range(5):
+                database.save({'name': 'fc_{0}_{1}'.format(number, i)})
+
+        threads = [threading.Thread(target=save, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert 'missing' not in database
+        stats = session.stats()
+        assert len(self.docs_by_name()) == 20
+        # the HEAD on the database, the lookup of 'missing' and the saves
+        assert stats['requests'] == 22
+        assert stats['errors'] == 1
+        assert stats['connections_opened'] <= 4
+        assert stats['connections_idle'] <= 2
+        assert 0 < stats['p50_seconds'] <= stats['p95_seconds'] <= stats['max_seconds']
+
+
+class TestPatchDoc(CouchDBTestCase):
+
+    def run_doc(self, cycles):
+        return {'name': 'fc_1', 'RunInfo': {'Id': 'a', 'Reads': [1, 2]},
+                'time cycles': [{'cycle': n} for n in range(cycles)]}
+
+    def test_doc_diff_and_apply_diff(self):
+        old = {'_id': 'x', '_rev': '1-a', 'a': 1, 'gone': 0, 'cycles': [1, 2],
+               'nested': {'x': {'y': 1}, 'same': {'z': 1}}}
+        new = {'a': 2, 'b': 3, 'cycles': [1, 2, 3], 'nested': {'x': {'y': 2}, 'same': {'z': 1}}}
+        ops = db.doc_diff(old, new)
+        assert sorted(ops, key=lambda op: op['path']) == [
+            {'op': 'set', 'path': ['a'], 'value': 2},
+            {'op': 'set', 'path': ['b'], 'value': 3},
+            {'op': 'append', 'path': ['cycles'], 'values': [3]},
+            {'op': 'set', 'path': ['nested', 'x', 'y'], 'value': 2}]
+        patched = db.apply_diff(old, ops)
+        assert patched == db.merge(dict(new, _id='x', _rev='1-a'), old)
+        assert old['nested']['x'] == {'y': 1}
+        assert patched['nested']['same'] is old['nested']['same']
+        deleted = db.doc_diff(old, new, deletes=True)
+        assert {'op': 'delete', 'path': ['gone']} in deleted
+        assert db.apply_diff(old, deleted) == dict(new, _id='x', _rev='1-a')
+
+    def cycles_doc(self, cycles, end):
+        # as RunParser.obj has them, the end of the last cycle moving on
+        time_cycles = [{'cycle_number': str(n), 'start': '2015-04-24 10:{0:02d}'.format(n),
+                        'end': '2015-04-24 10:{0:02d}:30'.format(n)} for n in range(cycles)]
+        time_cycles[-1]['end'] = end
+        return {'name': 'fc_1', 'time cycles': time_cycles}
+
+    def test_doc_diff_of_moving_cycles(self):
+        old = self.cycles_doc(300, '2015-04-24 11:00')
+        new = self.cycles_doc(301, '2015-04-24 11:01')
+        ops = db.doc_diff(old, new)
+        assert ops == [{'op': 'set', 'path': ['time cycles', 299],
+                        'value': new['time cycles'][299]},
+                       {'op': 'append', 'path': ['time cycles'],
+                        'values': [new['time cycles'][300]]}]
+        patched = db.apply_diff(old, ops)
+        assert patched == new
+        assert old['time cycles'][299]['end'] == '2015-04-24 11:00'
+        assert patched['time cycles'][0] is old['time cycles'][0]
+        # lists that shrank or mostly changed are set as a whole
+        assert db.doc_diff({'l': [1, 2]}, {'l': [1]}) == [
+            {'op': 'set', 'path': ['l'], 'value': [1]}]
+        assert db.doc_diff({'l': [1, 2]}, {'l': [3, 4, 5]}) == [
+            {'op': 'set', 'path': ['l'], 'value': [3, 4, 5]}]
+
+    def test_patch_doc_sends_the_changed_cycles(self):
+        db.install_patch_handler(self.db)
+        stored = db.patch_doc(self.db, self.cycles_doc(300, '2015-04-24 11:00'))
+        self.couch.received = 0
+        stored = db.patch_doc(self.db, self.cycles_doc(301, '2015-04-24 11:01'), stored)
+        assert self.couch.received < 600
+        doc = self.docs_by_name()['fc_1']
+        assert doc == stored
+        assert doc['time cycles'] == self.cycles_doc(301, '2015-04-24 11:01')['time cycles']
+
+    def test_patch_doc_sends_only_the_changes(self):
+        db.install_patch_handler(self.db)
+        stored = db.patch_doc(self.db, self.run_doc(300))
+        self.couch.requests = []
+        self.couch.received = 0
+        stored = db.patch_doc(self.db, self.run_doc(301), stored)
+        assert self.couch.requests == [('PUT', '/x_flowcells/_design/info/_update/patch/' +
+                                        stored['_id'])]
+        assert self.couch.received < 300
+        doc = self.docs_by_name()['fc_1']
+        assert doc == stored
+        assert doc['_rev'].startswith('2-')
+        assert len(doc['time cycles']) == 301
+        assert doc['content_hash'] == db.doc_hash(self.run_doc(301))
+        assert db.patch_doc(self.db, self.run_doc(301), stored) is stored
+        assert len(self.couch.requests) == 1
+
+    def test_patch_doc_without_handler(self):
+        stored = db.patch_doc(self.db, self.run_doc(3))
+        self.couch.requests = []
+        stored = db.patch_doc(self.db, self.run_doc(4), stored)
+        # the handler is tried, then the patched document written
+        assert self.couch.requests == [
+            ('PUT', '/x_flowcells/_design/info/_update/patch/' + stored['_id']),
+            ('PUT', '/x_flowcells/' + stored['_id'])]
+        assert self.docs_by_name()['fc_1'] == stored
+
+    def test_patch_doc_rebases_on_conflicts(self):
+        db.install_patch_handler(self.db)
+        stored = db.patch_doc(self.db, self.run_doc(3))
+        db.update_doc(self.db, {'name': 'fc_1', 'run_setup': '2x151'})
+        stored = db.patch_doc(self.db, self.run_doc(4), stored)
+        doc = self.docs_by_name()['fc_1']
+        assert doc == stored
+        assert doc['run_setup'] == '2x151'
+        assert len(doc['time cycles']) == 4
+
+    def test_patch_doc_reads_the_view_without_previous(self):
+        db.update_doc(self.db, dict(self.run_doc(3), run_setup='2x151'))
+        stored = db.patch_doc(self.db, self.run_doc(4))
+        assert stored['run_setup'] == '2x151'
+        assert self.docs_by_name()['fc_1'] == stored
+
+
+class TestMerge(unittest.TestCase):
+
+    def test_merge_keeps_d1_values(self):
+        d1 = {'a': 1, 'nested': {'x': 1}}
+        d2 = {'a': 2, 'b': 3, 'nested': {'x': 2, 'y': 3}}
+        assert db.merge(d1, d2) == {'a': 1, 'b': 3, 'nested': {'x': 1, 'y': 3}}
+
+    def test_merge_changes(self):
+        shared = {'big': list(range(10))}
+        d1 = {'a': 1, 'c': 4, 'same': {'x': 1}, 'shared': shared,
+              'nested': {'x': 1, 'deeper': {'z': [1], 'w': 0}}}
+        d2 = {'a': 2, 'b': 3, 'same': {'x': 1}, 'shared': shared,
+              'nested': {'x': 1, 'y': 3, 'deeper': {'z': [2], 'w': 0}}}
+        changes = []
+        merged = db.merge(d1, d2, changes)
+        assert sorted(changes) == [(('a',), 1), (('c',), 4), (('nested', 'deeper', 'z'), [1])]
+        assert merged['nested']['y'] == 3
+        assert merged['b'] == 3
+
+    def test_merge_deep_documents(self):
+        d1, d2 = {}, {}
+        inner1, inner2 = d1, d2
+        for _ in range(5000):
+            inner1['n'], inner2['n'] = {}, {}
+            inner1, inner2 = inner1['n'], inner2['n']
+        inner1['leaf'], inner2['leaf'], inner2['other'] = 1, 2, 3
+        changes = []
+        db.merge(d1, d2, changes)
+        assert len(changes) == 1
+        assert changes[0][0] == ('n',) * 5000 + ('leaf',)
+        assert inner1 == {'leaf': 1, 'other': 3}
@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from flowcell_parser import batch
+from flowcell_parser.classes import RunParser, run_folder_artifacts
+from flowcell_parser.index import RunFolderIndex, scan_run_folder
+
+TEST_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../test_data')
+TEST_RUN = '150424_ST-E00214_0031_BH2WY7CCXX'
+
+
+class TestRunFolderIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp_dir, 'sequencer')
+        shutil.copytree(TEST_DATA, self.root)
+        os.mkdir(os.path.join(self.root, 'not_a_run_folder'))
+        self.run_path = os.path.join(self.root, TEST_RUN)
+        self.index = RunFolderIndex(os.path.join(self.tmp_dir, 'index.sqlite'))
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_scan_classifies_run_folders(self):
+        run_folders = self.index.scan(self.root)
+        assert [os.path.basename(path) for path in run_folders] == [
+            '150424_ST-E00214_0031_BH2WY7CCXX', '191018_ST-E00214_0031_BH2WY7CCXX',
+            '191023_ST-E00214_0031_BH2WY7CCXX']
+        assert self.index.runs(instrument_type='HiSeqX') == run_folders
+        assert self.index.runs(instrument_type='MiSeq') == []
+        run = self.index.run(self.run_path)
+        assert (run['instrument'], run['flowcell'], run['date']) == ('ST-E00214', 'H2WY7CCXX',
+                                                                    '150424')
+
+    def test_scan_records_present_files(self):
+        self.index.scan(self.root)
+        expected = set(path for _, _, path in run_folder_artifacts(self.run_path)
+                       if os.path.exists(path))
+        files = self.index.run(self.run_path)['files']
+        assert set(files) == expected
+        run_info = os.path.join(self.run_path, 'RunInfo.xml')
+        assert files[run_info] == (os.stat(run_info).st_mtime_ns, os.stat(run_info).st_size)
+        assert scan_run_folder(self.run_path) == files
+
+    def test_rescan_drops_removed_run_folders(self):
+        self.index.scan(self.root)
+        shutil.rmtree(self.run_path)
+        assert len(self.index.scan(self.root)) == 2
+        assert self.index.run(self.run_path) is None
+        assert len(self.index.runs(root=self.root)) == 2
+
+    def test_index_is_persistent(self):
+        self.index.scan(self.root)
+        reopened = RunFolderIndex(self.index.path)
+        self.addCleanup(reopened.close)
+        assert reopened.runs() == self.index.runs()
+
+    def test_run_parser_with_index(self):
+        self.index.scan(self.root)
+        artifacts, missing, files = self.index.artifacts(self.run_path)
+        assert artifacts == run_folder_artifacts(self.run_path)
+        assert missing == set(['undet', 'json_stats'])
+        run_info = os.path.join(self.run_path, 'RunInfo.xml')
+        assert files[run_info] == (os.stat(run_info).st_mtime_ns, os.path.getsize(run_info))
+        parsed_run = RunParser(self.run_path, index=self.index)
+        assert parsed_run.obj == RunParser(self.run_path).obj
+        assert parsed_run.metrics['parsers']['runinfo']['bytes'] == files[run_info][1]
+        assert parsed_run.undet is None
+        assert parsed_run.timings['undet'] == 0.0
+
+    def test_stale_runs_are_scanned_again(self):
+        self.index.scan(self.root)
+        stats = os.path.join(self.run_path, 'Demultiplexing', 'Stats')
+        os.makedirs(stats)
+        with open(os.path.join(stats, 'Stats.json'), 'w') as f:
+            f.write('{"Flowcell": "H2WY7CCXX", "ConversionResults": [], "UnknownBarcodes": []}')
+        # fresh enough, the index is trusted
+        assert RunParser(self.run_path, index=self.index).json_stats is None
+        self.index.max_age = 0
+        time.sleep(0.01)
+        assert RunParser(self.run_path, index=self.index).json_stats is not None
+        assert os.path.join(stats, 'Stats.json') in self.index.run(self.run_path)['files']
+
+    def test_run_parser_indexes_unknown_run_folders(self):
+        parsed_run = RunParser(self.run_path, index=self.index)
+        assert parsed_run.runinfo.data['Flowcell'] == 'H2WY7CCXX'
+        assert self.index.runs() == [self.run_path]
+
+    def test_ingest_with_index(self):
+        sink = batch.DirectorySink(os.path.join(self.tmp_dir, 'docs'))
+        report = batch.ingest([self.root], sink, workers=1, index_path=self.index.path)
+        assert report['runs'] == 3
+        assert report['failures'] == {}
+        assert len(os.listdir(sink.path)) == 3
@@ -0,0 +1,70 @@
+import io
+import json
+import unittest
+
+from flowcell_parser import jsonstream
+
+DOC = {'Flowcell': 'H2WY7CCXX',
+       'RunNumber': 31,
+       'Ratio': 1.5e-3,
+       'Offset': -12,
+       'Flags': [True, False, None],
+       'Text': 'quote " backslash \\ unicode é',
+       'ConversionResults': [
+           {'LaneNumber': 1,
+            'TotalClustersPF': 10,
+            'DemuxResults': [{'SampleId': 'P1_101', 'Yield': 5, 'ReadMetrics': [1, 2]},
+                             {'SampleId': 'P1_102', 'Yield': 7}]},
+           {'LaneNumber': 2, 'DemuxResults': []}],
+       'UnknownBarcodes': [{'Lane': 1, 'Barcodes': {'AAAA': 5, 'CCCC': 9,
+                                                    'GGGG': 1, 'TTTT': 9}}],
+       'Empty': {}}
+
+
+class TestIterEvents(unittest.TestCase):
+
+    def test_events(self):
+        events = list(jsonstream.iter_events(io.StringIO('{"a": [1, {"b": null}]}')))
+        assert events == [('', 'start_map', None),
+                          ('', 'map_key', 'a'),
+                          ('a', 'start_array', None),
+                          ('a.item', 'number', 1),
+                          ('a.item', 'start_map', None),
+                          ('a.item', 'map_key', 'b'),
+                          ('a.item.b', 'null', None),
+                          ('a.item', 'end_map', None),
+                          ('a', 'end_array', None),
+                          ('', 'end_map', None)]
+
+
+class TestExtract(unittest.TestCase):
+
+    def test_extract_everything_any_chunk_size(self):
+        text = json.dumps(DOC, indent=2)
+        for chunk_size in (1, 2, 3, 7, 64 * 1024):
+            assert jsonstream.extract(io.StringIO(text), [''], chunk_size=chunk_size) == DOC
+
+    def test_extract_selected_fields(self):
+        data = jsonstream.extract(
+            io.StringIO(json.dumps(DOC)),
+            ['Flowcell',
+             'ConversionResults.item.LaneNumber',
+             'ConversionResults.item.DemuxResults.item.Yield',
+             'UnknownBarcodes.item.Lane'],
+            top_counts={'UnknownBarcodes.item.Barcodes': 2},
+            chunk_size=5)
+        assert data == {'Flowcell': 'H2WY7CCXX',
+                        'ConversionResults': [
+                            {'LaneNumber': 1, 'DemuxResults': [{'Yield': 5}, {'Yield': 7}]},
+                            {'LaneNumber': 2, 'DemuxResults': []}],
+                        'UnknownBarcodes': [{'Lane': 1, 'Barcodes': {'CCCC': 9, 'TTTT': 9}}]}
+        assert list(data['UnknownBarcodes'][0]['Barcodes']) == ['CCCC', 'TTTT']
+
+    def test_extract_no_top_counts(self):
+        data = jsonstream.extract(io.StringIO(json.dumps(DOC)), ['UnknownBarcodes.item.Lane'],
+                                  top_counts={'UnknownBarcodes.item.Barcodes': 0})
+        assert data == {'UnknownBarcodes': [{'Lane': 1, 'Barcodes': {}}]}
+
+    def test_extract_invalid_json(self):
+        with self.assertRaises(ValueError):
+            jsonstream.extract(io.StringIO('{"a": tru}'), [''])
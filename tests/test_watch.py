@@ -0,0 +1,115 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from flowcell_parser import watch
+
+TEST_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../test_data')
+RUN = '150424_ST-E00214_0031_BH2WY7CCXX'
+
+
+class ListSink(object):
+
+    def __init__(self):
+        self.docs = []
+
+    def write(self, obj):
+        self.docs.append(obj)
+
+
+class WatcherTestCase(unittest.TestCase):
+    poll = True
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.run_folder = os.path.join(self.root, RUN)
+        shutil.copytree(os.path.join(TEST_DATA, RUN), self.run_folder)
+        self.sink = ListSink()
+        self.watcher = watch.RunFolderWatcher([self.root], self.sink, poll=self.poll,
+                                              interval=0, settle=0)
+        self.addCleanup(self.watcher.close)
+        self.watcher.start()
+
+    def wait_for_update(self):
+        for _ in range(20):
+            updated = self.watcher.run_once(timeout=0.1)
+            if updated:
+                return updated
+        return []
+
+    def test_changed_file_is_parsed_again(self):
+        assert len(self.sink.docs) == 1
+        cycles = len(self.sink.docs[0]['time cycles'])
+        runinfo = self.watcher.parsers[self.run_folder].runinfo
+        with open(os.path.join(self.run_folder, 'Logs', 'CycleTimes.txt'), 'a') as f:
+            f.write("5/20/2019\t15:50:00.000\tH2KYVCCX2\t3\tStart Imaging\n"
+                    "5/20/2019\t15:55:00.000\tH2KYVCCX2\t3\tEnd Imaging\n")
+        assert self.wait_for_update() == [(self.run_folder, set(['time_cycles']))]
+        assert len(self.sink.docs) == 2
+        assert len(self.sink.docs[1]['time cycles']) == cycles + 1
+        assert self.watcher.parsers[self.run_folder].runinfo is runinfo
+
+    def test_cycle_times_are_followed(self):
+        parser = self.watcher.parsers[self.run_folder]
+        time_cycles = parser.time_cycles
+        offset = time_cycles.offset
+        appended = ("5/20/2019\t15:50:00.000\tH2KYVCCX2\t3\tStart Imaging\n"
+                    "5/20/2019\t15:55:00.000\tH2KYVCCX2\t3\tEnd Imaging\n")
+        with open(os.path.join(self.run_folder, 'Logs', 'CycleTimes.txt'), 'a') as f:
+            f.write(appended)
+        assert self.wait_for_update() == [(self.run_folder, set(['time_cycles']))]
+        # the same parser only read the appended lines
+        assert parser.time_cycles is time_cycles
+        assert time_cycles.offset == offset + len(appended)
+        metrics = parser.metrics['parsers']['time_cycles']
+        assert (metrics['source'], metrics['bytes'], metrics['records']) == (
+            'updated', len(appended), 2)
+        assert self.sink.docs[-1]['time cycles'][-1]['end'] == '2019-05-20 15:55:00'
+
+    def test_new_folders_are_seen(self):
+        stats = os.path.join(self.run_folder, 'Demultiplexing', 'Stats')
+        os.makedirs(stats)
+        with open(os.path.join(stats, 'DemuxSummaryF1L1.txt'), 'w') as f:
+            f.write("### Most Popular Unknown Index Sequences\n"
+                    "### Columns: Index_Sequence Hit_Count\nACGTACGT\t10\n")
+        updated = self.wait_for_update()
+        assert updated[0][0] == self.run_folder
+        assert 'undet' in updated[0][1]
+        assert self.sink.docs[-1]['Undetermined'] == {'1': {'ACGTACGT': 10}}
+
+    def test_new_run_folders_are_parsed(self):
+        other = os.path.join(self.root, '191023_ST-E00214_0031_BH2WY7CCXX')
+        shutil.copytree(os.path.join(TEST_DATA, os.path.basename(other)), other)
+        updated = self.wait_for_update()
+        assert [run_folder for run_folder, _ in updated] == [other]
+        assert self.sink.docs[-1]['name'] == '191023_BH2WY7CCXX'
+        assert other in self.watcher.parsers
+
+
+@unittest.skipIf(os.uname()[0] != 'Linux', "inotify is only on Linux")
+class TestInotifyWatcher(WatcherTestCase):
+    poll = False
+
+    def test_uses_inotify(self):
+        assert self.watcher.inotify is not None
+
+
+class TestAffectedAttributes(unittest.TestCase):
+
+    def test_affected_attributes(self):
+        run_folder = os.path.join(TEST_DATA, RUN)
+        stats = os.path.join(run_folder, 'Demultiplexing', 'Stats')
+        assert watch.affected_attributes(run_folder, os.path.join(stats, 'Stats.json')) == \
+            set(['json_stats'])
+        assert watch.affected_attributes(run_folder, os.path.join(stats, 'DemuxSummaryF1L1.txt')) \
+            == set(['undet'])
+        assert watch.affected_attributes(run_folder, os.path.join(run_folder, 'Logs')) == \
+            set(['time_cycles'])
+        assert watch.affected_attributes(run_folder, os.path.join(run_folder, 'other.txt')) == \
+            set()
+
+
+if __name__ == '__main__':
+    unittest.main()